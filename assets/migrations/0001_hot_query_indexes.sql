@@ -0,0 +1,27 @@
+-- no-transaction
+-- Индексы для горячих запросов. CONCURRENTLY не блокирует запись в таблицы при создании,
+-- поэтому миграция выполняется вне транзакции, по одному выражению.
+
+-- Уведомления и проверка истекших ключей: WHERE expiry_time <= $1 AND expiry_time > $2
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_keys_expiry_time ON keys (expiry_time);
+
+-- Подписки, просмотр ключа, поиск в админке: WHERE email = $1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_keys_email ON keys (email);
+
+-- update_key_expiry, delete_key, массовые обновления флагов: WHERE client_id = $1 / ANY($1)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_keys_client_id ON keys (client_id);
+
+-- Нагрузка кластеров и синхронизация: WHERE server_id = $1, GROUP BY server_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_keys_server_id ON keys (server_id);
+
+-- Статистика платежей за день, неделю и месяц
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_created_at ON payments (created_at);
+
+-- История платежей пользователя: WHERE tg_id = $1 ORDER BY created_at DESC LIMIT 3
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_tg_id_created_at ON payments (tg_id, created_at DESC);
+
+-- Статистика новых пользователей за день, неделю и месяц
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at ON users (created_at);
+
+-- Реферальная статистика: WHERE referrer_tg_id = $1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referrals_referrer_tg_id ON referrals (referrer_tg_id);
@@ -0,0 +1,7 @@
+-- Последний снимок статистики для админки: одна строка, обновляется фоновой задачей.
+CREATE TABLE IF NOT EXISTS stats_snapshot
+(
+    id           SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    data         JSONB                    NOT NULL,
+    refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
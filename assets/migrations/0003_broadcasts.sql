@@ -0,0 +1,31 @@
+-- Рассылки администратора: задание и список получателей со статусом доставки каждому.
+CREATE TABLE IF NOT EXISTS broadcasts
+(
+    id                  SERIAL PRIMARY KEY,
+    admin_tg_id         BIGINT                   NOT NULL,
+    text                TEXT                     NOT NULL,
+    audience            TEXT                     NOT NULL,
+    cluster_name        TEXT,
+    status              TEXT                     NOT NULL DEFAULT 'pending',
+    total               INTEGER                  NOT NULL DEFAULT 0,
+    sent                INTEGER                  NOT NULL DEFAULT 0,
+    failed              INTEGER                  NOT NULL DEFAULT 0,
+    blocked             INTEGER                  NOT NULL DEFAULT 0,
+    progress_chat_id    BIGINT,
+    progress_message_id BIGINT,
+    created_at          TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at         TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_active ON broadcasts (id) WHERE status IN ('pending', 'running');
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients
+(
+    broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+    tg_id        BIGINT  NOT NULL,
+    status       TEXT    NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (broadcast_id, tg_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+    ON broadcast_recipients (broadcast_id, tg_id) WHERE status = 'pending';
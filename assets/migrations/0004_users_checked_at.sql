@@ -0,0 +1,2 @@
+-- Время последней проверки, не заблокировал ли пользователь бота.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS checked_at TIMESTAMP WITH TIME ZONE;
@@ -108,6 +108,15 @@ CREATE TABLE IF NOT EXISTS temporary_data (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at);
+
 CREATE TABLE IF NOT EXISTS blocked_users (
     tg_id BIGINT PRIMARY KEY,
     blocked_at TIMESTAMP DEFAULT NOW()
@@ -1,103 +1,190 @@
+import asyncio
+import contextlib
+import functools
 import os
-import subprocess
+import time
 from datetime import datetime
 
-from aiogram.types import BufferedInputFile
+from aiogram.types import FSInputFile
 
+from client import xui_call
 from config import ADMIN_ID, BACK_DIR, DB_NAME, DB_PASSWORD, DB_USER, PG_HOST, PG_PORT
 from logger import logger
+from sender import send_limited
+from workers import is_leader
 
+try:
+    from config import BACKUP_PART_SIZE
+except ImportError:
+    # Telegram принимает от ботов файлы до 50 МБ
+    BACKUP_PART_SIZE = 45 * 1024 * 1024
 
-async def backup_database():
+try:
+    from config import BACKUP_COMPRESSION_LEVEL
+except ImportError:
+    BACKUP_COMPRESSION_LEVEL = 6
+
+try:
+    from config import BACKUP_RETENTION_DAYS
+except ImportError:
+    BACKUP_RETENTION_DAYS = 3
+
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
+
+async def backup_database(force: bool = False):
+    """
+    Создает бэкап базы данных и отправляет его администраторам.
+
+    Args:
+        force (bool, optional): Выполнить, даже если процесс не ведущий, например по кнопке в админке.
+    """
     from bot import bot
 
+    if not force and not await is_leader():
+        return
+
     try:
-        if backup_file_path := _create_database_backup():
-            await _send_backup_to_admin(bot, backup_file_path)
+        if backup_parts := await _create_database_backup():
+            await _send_backup_to_admin(bot, backup_parts)
             _cleanup_old_backups()
     except Exception as e:
         logger.error(f"Ошибка при создании или отправке бэкапа: {e}")
 
 
-def _create_database_backup():
-    USER = DB_USER
-    HOST = PG_HOST
-    PORT = PG_PORT
-    BACKUP_DIR = BACK_DIR
-    DATE = datetime.now().strftime("%Y-%m-%d-%H%M%S")
-    BACKUP_FILE = f"{BACKUP_DIR}/{DB_NAME}-backup-{DATE}.sql"
+async def _create_database_backup() -> list[str] | None:
+    """
+    Запускает pg_dump в сжатом формате custom и пишет его вывод на диск частями
+    не больше BACKUP_PART_SIZE, не загружая дамп в память.
+
+    Части — последовательные куски одного файла: `cat файл.part* > файл` восстанавливает дамп для pg_restore.
 
-    os.environ["PGPASSWORD"] = DB_PASSWORD
+    Returns:
+        list[str] | None: Пути к файлам бэкапа или None при ошибке
+    """
+    date = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    backup_file = os.path.join(BACK_DIR, f"{DB_NAME}-backup-{date}.dump")
 
+    process = await asyncio.create_subprocess_exec(
+        "pg_dump",
+        "-U",
+        DB_USER,
+        "-h",
+        PG_HOST,
+        "-p",
+        str(PG_PORT),
+        "-F",
+        "c",
+        "-Z",
+        str(BACKUP_COMPRESSION_LEVEL),
+        DB_NAME,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, "PGPASSWORD": DB_PASSWORD},
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+
+    parts: list[str] = []
+    part_file = None
+    part_written = 0
     try:
-        subprocess.run(
-            [
-                "pg_dump",
-                "-U",
-                USER,
-                "-h",
-                HOST,
-                "-p",
-                PORT,
-                "-F",
-                "c",
-                "-f",
-                BACKUP_FILE,
-                DB_NAME,
-            ],
-            check=True,
-        )
-        logger.info(f"Бэкап базы данных создан: {BACKUP_FILE}")
-        return BACKUP_FILE
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Ошибка при создании бэкапа базы данных: {e}")
+        while chunk := await process.stdout.read(BACKUP_CHUNK_SIZE):
+            while chunk:
+                if part_file is None or part_written >= BACKUP_PART_SIZE:
+                    if part_file is not None:
+                        part_file.close()
+                    part_path = f"{backup_file}.part{len(parts) + 1:03d}"
+                    part_file = await asyncio.to_thread(open, part_path, "wb")
+                    parts.append(part_path)
+                    part_written = 0
+                piece = chunk[: BACKUP_PART_SIZE - part_written]
+                await asyncio.to_thread(part_file.write, piece)
+                part_written += len(piece)
+                chunk = chunk[len(piece) :]
+    except BaseException as e:
+        # pg_dump иначе так и висит на заполненном канале, а неполные части остаются на диске
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        stderr_task.cancel()
+        if part_file is not None:
+            # При нехватке места close тоже падает, дописывая буфер
+            with contextlib.suppress(OSError):
+                part_file.close()
+            part_file = None
+        _remove_parts(parts)
+        if not isinstance(e, Exception):
+            raise
+        logger.error(f"Ошибка при записи бэкапа базы данных {backup_file}: {e}")
         return None
     finally:
-        del os.environ["PGPASSWORD"]
+        if part_file is not None:
+            part_file.close()
 
+    stderr = await stderr_task
+    if await process.wait() != 0:
+        logger.error(f"Ошибка при создании бэкапа базы данных: {stderr.decode(errors='replace').strip()}")
+        _remove_parts(parts)
+        return None
 
-async def _send_backup_to_admin(bot, backup_file_path):
-    try:
-        with open(backup_file_path, "rb") as backup_file:
-            backup_input_file = BufferedInputFile(
-                backup_file.read(), filename=os.path.basename(backup_file_path)
-            )
-            admin_ids: int | list[int] = ADMIN_ID
-            if isinstance(admin_ids, list):
-                for id in admin_ids:
-                    await bot.send_document(id, backup_input_file)
-                    logger.info(f"Бэкап базы данных отправлен админу: {id}")
-            else:
-                await bot.send_document(admin_ids, backup_input_file)
-                logger.info(f"Бэкап базы данных отправлен админу: {ADMIN_ID}")
-    except Exception as e:
-        logger.error(f"Ошибка при отправке бэкапа в Telegram: {e}")
+    if len(parts) == 1:
+        os.replace(parts[0], backup_file)
+        parts = [backup_file]
+
+    logger.info(f"Бэкап базы данных создан: {backup_file} (частей: {len(parts)})")
+    return parts
+
+
+def _remove_parts(parts: list[str]):
+    for part in parts:
+        try:
+            os.remove(part)
+        except OSError as e:
+            logger.error(f"Не удалось удалить неполный бэкап {part}: {e}")
+
+
+async def _send_backup_to_admin(bot, backup_parts: list[str]):
+    """
+    Загружает каждую часть бэкапа в Telegram один раз, остальным администраторам
+    отправляет ее по file_id.
+    """
+    admin_ids = ADMIN_ID if isinstance(ADMIN_ID, list) else [ADMIN_ID]
+
+    for part in backup_parts:
+        file_id = None
+        for admin_id in admin_ids:
+            try:
+                document = file_id or FSInputFile(part)
+                message = await send_limited(
+                    admin_id, functools.partial(bot.send_document, admin_id, document), kind="backup"
+                )
+                if file_id is None and message.document:
+                    file_id = message.document.file_id
+                logger.info(f"Бэкап базы данных {os.path.basename(part)} отправлен админу: {admin_id}")
+            except Exception as e:
+                logger.error(f"Ошибка при отправке бэкапа в Telegram админу {admin_id}: {e}")
 
 
 def _cleanup_old_backups():
+    """Удаляет файлы бэкапов базы старше BACKUP_RETENTION_DAYS дней."""
+    expire_before = time.time() - BACKUP_RETENTION_DAYS * 86400
+    removed = 0
     try:
-        subprocess.run(
-            [
-                "find",
-                BACK_DIR,
-                "-type",
-                "f",
-                "-name",
-                "*.sql",
-                "-mtime",
-                "+3",
-                "-exec",
-                "rm",
-                "{}",
-                ";",
-            ],
-            check=True,
-        )
-        logger.info("Старые бэкапы удалены.")
-    except subprocess.CalledProcessError as e:
+        with os.scandir(BACK_DIR) as entries:
+            for entry in entries:
+                if (
+                    entry.is_file()
+                    and entry.name.startswith(f"{DB_NAME}-backup-")
+                    and entry.stat().st_mtime < expire_before
+                ):
+                    os.remove(entry.path)
+                    removed += 1
+        logger.info(f"Старые бэкапы удалены: {removed}")
+    except OSError as e:
         logger.error(f"Ошибка при удалении старых бэкапов: {e}")
 
 
-async def create_backup_and_send_to_admins(xui):
-    await xui.login()
-    await xui.database.export()
+async def create_backup_and_send_to_admins(xui, force: bool = False):
+    if not force and not await is_leader():
+        return
+    await xui_call(xui, xui.database.export)
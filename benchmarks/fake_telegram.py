@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MESSAGE_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendVideo",
+    "sendDocument",
+    "sendAnimation",
+    "sendInvoice",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageMedia",
+    "editMessageReplyMarkup",
+    "copyMessage",
+    "forwardMessage",
+}
+
+
+class FakeTelegramServer:
+    """
+    Локальная заглушка Bot API.
+
+    Принимает любые методы по пути /bot{token}/{method}, отвечает правдоподобным
+    результатом и считает вызовы по методам. Задержка latency имитирует сетевой RTT.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.url = f"http://{bound_host}:{bound_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update({key: value for key, value in (await request.post()).items() if isinstance(value, str)})
+
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        if method == "getChatMember":
+            return {
+                "status": "member",
+                "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"},
+            }
+        if method == "createInvoiceLink":
+            return "https://t.me/$benchmark"
+        if method in MESSAGE_METHODS:
+            self._message_id += 1
+            chat_id = params.get("chat_id", 0)
+            message = {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if method == "sendPhoto":
+                photo = params.get("photo") or "benchmark-photo"
+                message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1, "height": 1}]
+            return message
+        return True
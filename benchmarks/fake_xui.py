@@ -0,0 +1,203 @@
+import asyncio
+import base64
+import json
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+SESSION_COOKIE = "3x-ui"
+
+
+class FakeXuiServer:
+    """
+    Локальная заглушка панели 3x-ui с одним хранилищем клиентов на инбаунд.
+
+    Поддерживает вход (csrf-token, login), добавление, обновление, удаление и поиск
+    клиентов по email, список онлайн-клиентов, экспорт базы и ссылки подписок /sub/{email}.
+    Маршруты есть как в формате panel/api/clients, так и в классическом panel/api/inbounds.
+    Вызовы считаются по операциям в calls.
+    """
+
+    def __init__(self, latency: float = 0.0, inbound_ids: tuple[int, ...] = (1,)):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.inbounds: dict[int, dict[str, dict]] = {inbound_id: {} for inbound_id in inbound_ids}
+        self.online: set[str] = set()
+        self._token = uuid.uuid4().hex
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        routes = [
+            ("GET", "/csrf-token", "csrf", self.csrf_token),
+            ("POST", "/login", "login", self.login),
+            ("GET", "/panel/api/inbounds/list", "inbounds_list", self.list_inbounds),
+            ("GET", "/panel/api/inbounds/get/{inbound_id}", "inbound_get", self.get_inbound),
+            ("POST", "/panel/api/clients/add", "client_add", self.add_client),
+            ("POST", "/panel/api/inbounds/addClient", "client_add", self.add_client_legacy),
+            ("POST", "/panel/api/clients/update/{email}", "client_update", self.update_client),
+            ("POST", "/panel/api/inbounds/updateClient/{client_id}", "client_update", self.update_client_legacy),
+            ("POST", "/panel/api/clients/del/{email}", "client_delete", self.delete_client),
+            ("POST", "/panel/api/inbounds/{inbound_id}/delClient/{client_id}", "client_delete", self.delete_client),
+            ("GET", "/panel/api/clients/get/{email}", "client_get", self.get_client),
+            ("GET", "/panel/api/inbounds/getClientTraffics/{email}", "client_get", self.get_client),
+            ("GET", "/panel/api/clients/list", "clients_list", self.list_clients),
+            ("POST", "/panel/api/clients/onlines", "online", self.onlines),
+            ("POST", "/panel/api/inbounds/onlines", "online", self.onlines),
+            ("POST", "/panel/api/backuptotgbot", "backup", self.ok),
+            ("GET", "/panel/api/inbounds/createbackup", "backup", self.ok),
+            ("GET", "/sub/{email}", "subscription", self.subscription),
+        ]
+        for method, path, name, handler in routes:
+            app.router.add_route(method, path, self._counted(name, handler))
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.url = f"http://{bound_host}:{bound_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _counted(self, operation: str, handler):
+        async def wrapper(request: web.Request) -> web.Response:
+            self.calls[operation] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+
+            authorized = request.cookies.get(SESSION_COOKIE) == self._token
+            if operation not in ("csrf", "login", "subscription") and not authorized:
+                raise web.HTTPNotFound()
+            return await handler(request)
+
+        return wrapper
+
+    def expire_sessions(self):
+        """Сбрасывает токен сессии, заставляя клиентов войти заново."""
+        self._token = uuid.uuid4().hex
+
+    @staticmethod
+    def _response(obj=None, *, success: bool = True, msg: str = "") -> web.Response:
+        return web.json_response({"success": success, "msg": msg, "obj": obj})
+
+    def _find(self, email: str | None = None, client_id: str | None = None) -> tuple[int, dict] | tuple[None, None]:
+        for inbound_id, clients in self.inbounds.items():
+            for client in clients.values():
+                if (email and client.get("email", "").lower() == email.lower()) or (
+                    client_id and str(client.get("id")) == str(client_id)
+                ):
+                    return inbound_id, client
+        return None, None
+
+    def _inbound_json(self, inbound_id: int) -> dict:
+        clients = list(self.inbounds[inbound_id].values())
+        return {
+            "id": inbound_id,
+            "enable": True,
+            "port": 443,
+            "protocol": "vless",
+            "remark": f"bench-{inbound_id}",
+            "settings": json.dumps({"clients": clients, "decryption": "none", "fallbacks": []}),
+            "streamSettings": json.dumps({"network": "tcp", "security": "reality"}),
+            "sniffing": json.dumps({"enabled": False}),
+            "clientStats": [],
+        }
+
+    def _store(self, inbound_id: int, client: dict) -> web.Response:
+        clients = self.inbounds.setdefault(inbound_id, {})
+        email = client.get("email", "")
+        if self._find(email=email)[1] is not None:
+            return self._response(success=False, msg=f"Duplicate email: {email}")
+        clients[email] = client
+        return self._response()
+
+    async def csrf_token(self, request: web.Request) -> web.Response:
+        return self._response("benchmark")
+
+    async def login(self, request: web.Request) -> web.Response:
+        response = self._response()
+        response.set_cookie(SESSION_COOKIE, self._token)
+        return response
+
+    async def ok(self, request: web.Request) -> web.Response:
+        return self._response()
+
+    async def list_inbounds(self, request: web.Request) -> web.Response:
+        return self._response([self._inbound_json(inbound_id) for inbound_id in self.inbounds])
+
+    async def get_inbound(self, request: web.Request) -> web.Response:
+        inbound_id = int(request.match_info["inbound_id"])
+        if inbound_id not in self.inbounds:
+            return self._response(success=False, msg="Inbound not found")
+        return self._response(self._inbound_json(inbound_id))
+
+    async def add_client(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        inbound_id = int(data["inboundIds"][0])
+        return self._store(inbound_id, data["client"])
+
+    async def add_client_legacy(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        settings = json.loads(data["settings"]) if isinstance(data["settings"], str) else data["settings"]
+        for client in settings.get("clients", []):
+            response = self._store(int(data["id"]), client)
+            if json.loads(response.body)["success"] is False:
+                return response
+        return self._response()
+
+    async def update_client(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        inbound_id, client = self._find(email=request.match_info["email"])
+        if client is None:
+            return self._response(success=False, msg="Client not found")
+        client.update(data)
+        return self._response()
+
+    async def update_client_legacy(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        settings = json.loads(data["settings"]) if isinstance(data["settings"], str) else data["settings"]
+        inbound_id, client = self._find(client_id=request.match_info["client_id"])
+        if client is None:
+            return self._response(success=False, msg="Client not found")
+        client.update(settings["clients"][0])
+        return self._response()
+
+    async def delete_client(self, request: web.Request) -> web.Response:
+        inbound_id, client = self._find(
+            email=request.match_info.get("email"), client_id=request.match_info.get("client_id")
+        )
+        if client is None:
+            return self._response(success=False, msg="Client not found")
+        del self.inbounds[inbound_id][client["email"]]
+        return self._response()
+
+    async def get_client(self, request: web.Request) -> web.Response:
+        inbound_id, client = self._find(email=request.match_info["email"])
+        if client is None:
+            return self._response()
+        return self._response({**client, "inboundId": inbound_id, "up": 0, "down": 0, "total": 0})
+
+    async def list_clients(self, request: web.Request) -> web.Response:
+        return self._response([client for clients in self.inbounds.values() for client in clients.values()])
+
+    async def onlines(self, request: web.Request) -> web.Response:
+        return self._response(sorted(self.online))
+
+    async def subscription(self, request: web.Request) -> web.Response:
+        email = request.match_info["email"]
+        links = [
+            f"vless://{client['id']}@{request.host}:443?type=tcp&security=reality#{client['email']}"
+            for clients in self.inbounds.values()
+            for client in clients.values()
+            if client.get("subId") == email or client.get("email") == email
+        ]
+        if not links:
+            raise web.HTTPNotFound()
+        return web.Response(text=base64.b64encode("\n".join(links).encode("utf-8")).decode("utf-8"))
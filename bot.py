@@ -1,40 +1,112 @@
+import asyncio
 import traceback
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ErrorEvent
 
 from config import API_TOKEN
+from broadcast import broadcast_loop
+from database import (
+    check_pool_health,
+    close_pool,
+    get_pool,
+    listen_servers_changes,
+    monitor_pool,
+    refresh_stats_loop,
+)
+from fsm_storage import PostgresStorage, create_storage
 from logger import logger
+from metrics import start_metrics_server, stop_metrics_server
 from middlewares.admin import AdminMiddleware
+from middlewares.blocked import BlockedUsersMiddleware
 from middlewares.database import DatabaseMiddleware
 from middlewares.delete import DeleteMessageMiddleware
-from middlewares.logging import LoggingMiddleware
+from middlewares.logging import LoggingMiddleware, UpdateContextMiddleware
+from middlewares.metrics import HandlerNameMiddleware, MetricsMiddleware, TelegramMetricsMiddleware
+from middlewares.sharding import ShardingMiddleware, close_forward_session
+from middlewares.throttling import ThrottlingMiddleware
 from middlewares.user import UserMiddleware
+from workers import WORKER_URLS, release_leadership
+
+try:
+    from config import SERVERS_CACHE_LISTEN
+except ImportError:
+    SERVERS_CACHE_LISTEN = False
 
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(bot=bot, storage=storage)
+bot.session.middleware(TelegramMetricsMiddleware())
+blocked_users_middleware = BlockedUsersMiddleware()
+bot.session.middleware(blocked_users_middleware)
+storage = create_storage()
+# FSMContextMiddleware регистрируется ниже вручную, после ограничения частоты,
+# чтобы отклоненные обновления не читали состояние из хранилища.
+dp = Dispatcher(bot=bot, storage=storage, disable_fsm=True)
+
+dp.update.outer_middleware(UpdateContextMiddleware())
+if WORKER_URLS:
+    dp.update.outer_middleware(ShardingMiddleware())
+throttling_middleware = ThrottlingMiddleware()
+dp.update.outer_middleware(throttling_middleware)
+dp.update.outer_middleware(dp.fsm)
 
 dp.message.middleware(LoggingMiddleware())
 dp.callback_query.middleware(LoggingMiddleware())
 
 dp.message.middleware(AdminMiddleware())
 dp.callback_query.middleware(AdminMiddleware())
-dp.message.middleware(UserMiddleware())
-dp.callback_query.middleware(UserMiddleware())
+user_middleware = UserMiddleware()
+dp.message.middleware(user_middleware)
+dp.callback_query.middleware(user_middleware)
 
 dp.message.middleware(DatabaseMiddleware())
 dp.callback_query.middleware(DatabaseMiddleware())
 
-# dp.message.middleware(ThrottlingMiddleware(limit=1))
-# dp.callback_query.middleware(ThrottlingMiddleware(limit=1))
+metrics_middleware = MetricsMiddleware()
+dp.message.outer_middleware(metrics_middleware)
+dp.callback_query.outer_middleware(metrics_middleware)
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
 
 dp.message.outer_middleware(DeleteMessageMiddleware())
 dp.callback_query.outer_middleware(DeleteMessageMiddleware())
 
+background_tasks: list[asyncio.Task] = []
+
+
+@dp.startup()
+async def on_startup():
+    await get_pool()
+    if not await check_pool_health():
+        logger.error("База данных недоступна при запуске бота")
+    background_tasks.append(asyncio.create_task(monitor_pool()))
+    await start_metrics_server()
+    background_tasks.append(asyncio.create_task(refresh_stats_loop()))
+    background_tasks.append(asyncio.create_task(broadcast_loop(bot)))
+    if isinstance(storage, PostgresStorage):
+        background_tasks.append(asyncio.create_task(storage.run()))
+    if SERVERS_CACHE_LISTEN:
+        background_tasks.append(asyncio.create_task(listen_servers_changes()))
+
+
+@dp.shutdown()
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+
+    from handlers.keys.subscriptions import close_http_session
+
+    await close_http_session()
+    await close_forward_session()
+    await user_middleware.close()
+    await blocked_users_middleware.close()
+    await stop_metrics_server()
+    await release_leadership()
+    await close_pool()
+    await logger.complete()
+
 
 @dp.error()
 async def error_handler(event: ErrorEvent):
@@ -0,0 +1,333 @@
+import asyncio
+import contextlib
+import functools
+import time
+from datetime import datetime, timezone
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from database import acquire_connection, add_blocked_users
+from logger import logger
+from sender import dispatch, send_limited
+from workers import is_leader
+
+try:
+    from config import BROADCAST_BATCH_SIZE
+except ImportError:
+    BROADCAST_BATCH_SIZE = 200
+
+try:
+    from config import BROADCAST_PROGRESS_INTERVAL
+except ImportError:
+    BROADCAST_PROGRESS_INTERVAL = 5
+
+try:
+    from config import BROADCAST_POLL_INTERVAL
+except ImportError:
+    BROADCAST_POLL_INTERVAL = 10
+
+# Получатели рассылки по группам; $1 — id рассылки в запросе вставки, $2 — параметр группы.
+AUDIENCES = {
+    "all": "SELECT DISTINCT tg_id FROM connections",
+    "subscribed": """
+        SELECT DISTINCT c.tg_id
+        FROM connections c
+        JOIN keys k ON c.tg_id = k.tg_id
+        WHERE k.expiry_time > $2
+    """,
+    "unsubscribed": """
+        SELECT c.tg_id
+        FROM connections c
+        LEFT JOIN keys k ON c.tg_id = k.tg_id
+        GROUP BY c.tg_id
+        HAVING COUNT(k.tg_id) = 0 OR MAX(k.expiry_time) <= $2
+    """,
+    "cluster": """
+        SELECT DISTINCT c.tg_id
+        FROM connections c
+        JOIN keys k ON c.tg_id = k.tg_id
+        JOIN servers s ON k.server_id = s.cluster_name
+        WHERE s.cluster_name = $2
+    """,
+}
+
+STATUS_LABELS = {
+    "pending": "⏳ ожидает запуска",
+    "running": "🔄 идет",
+    "done": "✅ завершена",
+    "cancelled": "⏹ остановлена",
+}
+
+_wakeup = asyncio.Event()
+_running: dict[int, asyncio.Task] = {}
+
+
+async def create_broadcast(admin_tg_id: int, text: str, audience: str, cluster_name: str | None = None) -> tuple[int, int]:
+    """
+    Создает рассылку и сохраняет список ее получателей.
+
+    Получатели выбираются один раз при создании, поэтому после перезапуска рассылка
+    продолжается по тому же списку.
+
+    Args:
+        admin_tg_id (int): Администратор, запустивший рассылку
+        text (str): Текст сообщения
+        audience (str): Группа получателей: "all", "subscribed", "unsubscribed" или "cluster"
+        cluster_name (str, optional): Кластер для группы "cluster"
+
+    Returns:
+        tuple[int, int]: Id рассылки и число получателей
+    """
+    if audience in ("subscribed", "unsubscribed"):
+        args = [int(datetime.now(timezone.utc).timestamp() * 1000)]
+    elif audience == "cluster":
+        args = [cluster_name]
+    else:
+        args = []
+
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            broadcast_id = await conn.fetchval(
+                """
+                INSERT INTO broadcasts (admin_tg_id, text, audience, cluster_name)
+                VALUES ($1, $2, $3, $4)
+                RETURNING id
+                """,
+                admin_tg_id,
+                text,
+                audience,
+                cluster_name,
+            )
+            await conn.execute(
+                f"""
+                INSERT INTO broadcast_recipients (broadcast_id, tg_id)
+                SELECT $1, tg_id FROM ({AUDIENCES[audience]}) AS audience
+                ON CONFLICT DO NOTHING
+                """,
+                broadcast_id,
+                *args,
+            )
+            total = await conn.fetchval(
+                """
+                UPDATE broadcasts
+                SET total = (SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = $1)
+                WHERE id = $1
+                RETURNING total
+                """,
+                broadcast_id,
+            )
+
+    logger.info(f"Создана рассылка #{broadcast_id} ({audience}): {total} получателей")
+    return broadcast_id, total
+
+
+async def set_progress_message(broadcast_id: int, chat_id: int, message_id: int):
+    """Запоминает сообщение, в котором показывается ход рассылки, и будит фоновую задачу."""
+    async with acquire_connection() as conn:
+        await conn.execute(
+            "UPDATE broadcasts SET progress_chat_id = $2, progress_message_id = $3 WHERE id = $1",
+            broadcast_id,
+            chat_id,
+            message_id,
+        )
+    _wakeup.set()
+
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    """Останавливает рассылку. Неотправленные сообщения так и остаются неотправленными."""
+    async with acquire_connection() as conn:
+        cancelled = await conn.fetchval(
+            """
+            UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND status IN ('pending', 'running')
+            RETURNING id
+            """,
+            broadcast_id,
+        )
+    return cancelled is not None
+
+
+def format_progress(broadcast) -> str:
+    processed = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    return (
+        f"📤 Рассылка #{broadcast['id']}: {STATUS_LABELS.get(broadcast['status'], broadcast['status'])}\n"
+        f"👥 Всего пользователей: {broadcast['total']}\n"
+        f"✅ Успешно отправлено: {broadcast['sent']}\n"
+        f"🚫 Заблокировали бота: {broadcast['blocked']}\n"
+        f"❌ Не доставлено: {broadcast['failed']}\n"
+        f"⏳ Осталось: {broadcast['total'] - processed}"
+    )
+
+
+def progress_markup(broadcast):
+    if broadcast["status"] not in ("pending", "running"):
+        return None
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="⏹ Остановить рассылку", callback_data=f"broadcast_cancel|{broadcast['id']}")
+    )
+    return builder.as_markup()
+
+
+async def _show_progress(bot: Bot, broadcast):
+    chat_id, message_id = broadcast["progress_chat_id"], broadcast["progress_message_id"]
+    if not message_id:
+        return
+    try:
+        await send_limited(
+            chat_id,
+            lambda: bot.edit_message_text(
+                text=format_progress(broadcast),
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=progress_markup(broadcast),
+            ),
+            kind="broadcast_progress",
+        )
+    except Exception as e:
+        logger.debug(f"Не удалось обновить ход рассылки #{broadcast['id']}: {e}")
+
+
+async def deliver(bot: Bot, broadcast_id: int, text: str, results: dict[int, str], tg_id: int):
+    """Отправляет сообщение рассылки одному получателю и записывает в results "sent", "blocked" или "failed"."""
+    try:
+        await send_limited(tg_id, functools.partial(bot.send_message, chat_id=tg_id, text=text), kind="broadcast")
+        results[tg_id] = "sent"
+    except TelegramForbiddenError:
+        results[tg_id] = "blocked"
+    except TelegramBadRequest as e:
+        results[tg_id] = "failed"
+        logger.warning(f"Сообщение рассылки #{broadcast_id} не доставлено пользователю {tg_id}: {e}")
+    except Exception as e:
+        results[tg_id] = "failed"
+        logger.error(f"❌ Ошибка при отправке сообщения рассылки #{broadcast_id} пользователю {tg_id}: {e}")
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int):
+    """
+    Отправляет рассылку пачками по BROADCAST_BATCH_SIZE получателей.
+
+    Получатели пачки обслуживаются параллельно через sender.send_limited с его общими
+    лимитами Telegram. После каждой пачки статусы получателей и счетчики рассылки
+    сохраняются в базе, поэтому после перезапуска рассылка продолжается с первого
+    необработанного получателя; повторно может уйти только прерванная пачка.
+    Пользователи, заблокировавшие бота, добавляются в blocked_users.
+    """
+    async with acquire_connection() as conn:
+        await conn.execute("UPDATE broadcasts SET status = 'running' WHERE id = $1 AND status = 'pending'", broadcast_id)
+
+    last_progress = 0.0
+    while True:
+        if not await is_leader():
+            logger.warning(f"Процесс больше не ведущий, рассылка #{broadcast_id} продолжится в другом процессе")
+            return
+
+        async with acquire_connection() as conn:
+            broadcast = await conn.fetchrow("SELECT * FROM broadcasts WHERE id = $1", broadcast_id)
+            if broadcast is None or broadcast["status"] != "running":
+                break
+            batch = await conn.fetch(
+                """
+                SELECT tg_id FROM broadcast_recipients
+                WHERE broadcast_id = $1 AND status = 'pending'
+                ORDER BY tg_id
+                LIMIT $2
+                """,
+                broadcast_id,
+                BROADCAST_BATCH_SIZE,
+            )
+        if not batch:
+            break
+
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await _show_progress(bot, broadcast)
+
+        results: dict[int, str] = {}
+        await dispatch(
+            [record["tg_id"] for record in batch],
+            functools.partial(deliver, bot, broadcast_id, broadcast["text"], results),
+        )
+
+        statuses = list(results.values())
+        blocked_ids = [tg_id for tg_id, status in results.items() if status == "blocked"]
+        async with acquire_connection() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    UPDATE broadcast_recipients r
+                    SET status = u.status
+                    FROM unnest($2::bigint[], $3::text[]) AS u(tg_id, status)
+                    WHERE r.broadcast_id = $1 AND r.tg_id = u.tg_id
+                    """,
+                    broadcast_id,
+                    list(results),
+                    statuses,
+                )
+                await conn.execute(
+                    "UPDATE broadcasts SET sent = sent + $2, failed = failed + $3, blocked = blocked + $4 WHERE id = $1",
+                    broadcast_id,
+                    statuses.count("sent"),
+                    statuses.count("failed"),
+                    len(blocked_ids),
+                )
+                await add_blocked_users(blocked_ids, conn)
+
+    async with acquire_connection() as conn:
+        broadcast = await conn.fetchrow(
+            """
+            UPDATE broadcasts
+            SET status = CASE WHEN status = 'running' THEN 'done' ELSE status END,
+                finished_at = COALESCE(finished_at, CURRENT_TIMESTAMP)
+            WHERE id = $1
+            RETURNING *
+            """,
+            broadcast_id,
+        )
+    if broadcast is not None:
+        logger.info(
+            f"📤 Рассылка #{broadcast_id} {broadcast['status']}: отправлено {broadcast['sent']}, "
+            f"заблокировали {broadcast['blocked']}, не доставлено {broadcast['failed']} из {broadcast['total']}"
+        )
+        await _show_progress(bot, broadcast)
+
+
+async def _run_safely(bot: Bot, broadcast_id: int):
+    try:
+        await run_broadcast(bot, broadcast_id)
+    except Exception as e:
+        # Рассылка остается в статусе running и будет продолжена при следующей проверке
+        logger.error(f"Ошибка в рассылке #{broadcast_id}: {e}")
+    finally:
+        _running.pop(broadcast_id, None)
+
+
+async def broadcast_loop(bot: Bot):
+    """
+    Фоновая задача: ведущий процесс запускает незавершенные рассылки, в том числе
+    прерванные перезапуском. Проверка выполняется раз в BROADCAST_POLL_INTERVAL секунд
+    или сразу после создания рассылки в этом процессе.
+    """
+    try:
+        while True:
+            _wakeup.clear()
+            try:
+                if await is_leader():
+                    async with acquire_connection() as conn:
+                        rows = await conn.fetch(
+                            "SELECT id FROM broadcasts WHERE status IN ('pending', 'running') ORDER BY id"
+                        )
+                    for row in rows:
+                        if row["id"] not in _running:
+                            _running[row["id"]] = asyncio.create_task(_run_safely(bot, row["id"]))
+            except Exception as e:
+                logger.error(f"Ошибка при проверке рассылок: {e}")
+
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+    finally:
+        for task in _running.values():
+            task.cancel()
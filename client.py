@@ -1,7 +1,98 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
+import httpx
 import py3xui
 
-from config import LIMIT_IP, SUPERNODE
+from config import ADMIN_PASSWORD, ADMIN_USERNAME, LIMIT_IP, SUPERNODE
 from logger import logger
+from metrics import panel_call_duration, panel_call_errors
+
+try:
+    from config import XUI_SESSION_TTL
+except ImportError:
+    XUI_SESSION_TTL = 3600
+
+try:
+    from config import XUI_BULK_BATCH_SIZE
+except ImportError:
+    XUI_BULK_BATCH_SIZE = 100
+
+# 3x-ui отвечает 404 на запросы к API без действующей сессии, старые версии — 401
+XUI_AUTH_ERROR_CODES = (401, 403, 404)
+
+xui_sessions: dict[str, py3xui.AsyncApi] = {}
+_xui_login_state: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_xui(api_url: str) -> py3xui.AsyncApi:
+    """
+    Возвращает долгоживущий клиент панели 3x-ui для указанного api_url.
+
+    Клиент создается один раз на сервер и переиспользует сессию между операциями.
+    """
+    xui = xui_sessions.get(api_url)
+    if xui is None:
+        xui = py3xui.AsyncApi(api_url, username=ADMIN_USERNAME, password=ADMIN_PASSWORD)
+        xui_sessions[api_url] = xui
+    return xui
+
+
+async def ensure_login(xui, expired_at: float | None = None) -> float:
+    """
+    Авторизуется в панели, только если сессии еще нет, она старше XUI_SESSION_TTL
+    или была отклонена панелью.
+
+    Args:
+        xui: Клиент панели 3x-ui
+        expired_at (float, optional): Время входа сессии, которую панель отклонила.
+            Если с тех пор вход уже выполнен другим запросом, повторный вход не нужен.
+
+    Returns:
+        float: Время входа текущей сессии
+    """
+    state = _xui_login_state.get(xui)
+    if state is None:
+        state = {"lock": asyncio.Lock(), "login_at": 0.0}
+        _xui_login_state[xui] = state
+
+    async with state["lock"]:
+        expired = expired_at is not None and state["login_at"] == expired_at
+        if expired or not xui.session or time.monotonic() - state["login_at"] > XUI_SESSION_TTL:
+            await xui.login()
+            state["login_at"] = time.monotonic()
+        return state["login_at"]
+
+
+async def xui_call(xui, method, *args, **kwargs):
+    """
+    Вызывает метод API панели. Если панель отклонила сессию, входит заново
+    и повторяет вызов один раз.
+    """
+    login_at = await ensure_login(xui)
+    try:
+        return await _timed_call(xui, method, *args, **kwargs)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in XUI_AUTH_ERROR_CODES:
+            raise
+        logger.warning(f"Сессия панели {e.request.url.host} отклонена ({e.response.status_code}), повторный вход")
+        await ensure_login(xui, expired_at=login_at)
+        return await _timed_call(xui, method, *args, **kwargs)
+
+
+async def _timed_call(xui, method, *args, **kwargs):
+    server = urlsplit(xui.client.host).hostname or xui.client.host
+    method_name = getattr(method, "__qualname__", str(method))
+    started_at = time.perf_counter()
+    try:
+        return await method(*args, **kwargs)
+    except Exception:
+        panel_call_errors.inc(server, method_name)
+        raise
+    finally:
+        panel_call_duration.observe(time.perf_counter() - started_at, server, method_name)
 
 
 async def add_client(
@@ -21,8 +112,6 @@ async def add_client(
     Adds a client to the server via 3x-ui.
     """
     try:
-        await xui.login()
-
         client = py3xui.Client(
             id=client_id,
             email=email.lower(),
@@ -35,7 +124,7 @@ async def add_client(
             flow=flow,
         )
 
-        response = await xui.client.add(inbound_id, [client])
+        response = await xui_call(xui, xui.client.add, inbound_id, [client])
 
         logger.info(f"Клиент {email} успешно добавлен с ID {client_id}.")
 
@@ -54,15 +143,79 @@ async def add_client(
         return {"status": "failed", "error": error_message}
 
 
+async def add_clients_bulk(
+    xui,
+    inbound_id: int,
+    clients: list[py3xui.Client],
+    batch_size: int | None = None,
+    existing_emails: set[str] | None = None,
+) -> dict[str, dict]:
+    """
+    Добавляет клиентов в инбаунд пачками по batch_size за один запрос к панели.
+
+    Клиенты, которые уже есть в инбаунде, пропускаются. Если пачка отклонена панелью,
+    ее клиенты добавляются по одному, чтобы найти конкретные ошибки.
+
+    Args:
+        existing_emails (set[str], optional): Email клиентов инбаунда в нижнем регистре,
+            если они уже получены. Иначе список запрашивается у панели.
+
+    Returns:
+        dict: Результат по email клиента: {"status": "added" | "exists" | "failed", "error": ...}
+    """
+    batch_size = batch_size or XUI_BULK_BATCH_SIZE
+    results: dict[str, dict] = {}
+
+    if existing_emails is None:
+        inbound = await xui_call(xui, xui.inbound.get_by_id, inbound_id)
+        existing_emails = {client.email.lower() for client in inbound.settings.clients}
+
+    pending = []
+    for client in clients:
+        if client.email.lower() in existing_emails:
+            results[client.email] = {"status": "exists"}
+        else:
+            pending.append(client)
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start : start + batch_size]
+        try:
+            await xui_call(xui, xui.client.add, inbound_id, batch)
+            for client in batch:
+                results[client.email] = {"status": "added"}
+            continue
+        except Exception as e:
+            logger.warning(
+                f"Пачка из {len(batch)} клиентов отклонена инбаундом {inbound_id}: {e}. Добавление по одному."
+            )
+
+        for client in batch:
+            try:
+                await xui_call(xui, xui.client.add, inbound_id, [client])
+                results[client.email] = {"status": "added"}
+            except Exception as e:
+                if "Duplicate email" in str(e):
+                    results[client.email] = {"status": "exists"}
+                else:
+                    results[client.email] = {"status": "failed", "error": str(e)}
+
+    added = sum(1 for result in results.values() if result["status"] == "added")
+    logger.info(
+        f"Инбаунд {inbound_id}: добавлено {added} из {len(clients)} клиентов, "
+        f"уже существовало {len(clients) - len(pending)}."
+    )
+    return results
+
+
 async def extend_client_key(
     xui, inbound_id, email: str, new_expiry_time: int, client_id: str, total_gb: int, sub_id = str
 ):
     """
     Функция для обновления срока действия ключа клиента по email.
     """
-    await xui.login()
+    await ensure_login(xui)
     try:
-        client = await xui.client.get_by_email(email)
+        client = await xui_call(xui, xui.client.get_by_email, email)
 
         if not client:
             logger.warning(f"Клиент с email {email} не найден.")
@@ -85,8 +238,8 @@ async def extend_client_key(
         client.limit_ip = LIMIT_IP
         client.inbound_id = inbound_id
 
-        await xui.client.update(client.id, client)
-        await xui.client.reset_stats(inbound_id, email)
+        await xui_call(xui, xui.client.update, client.id, client)
+        await xui_call(xui, xui.client.reset_stats, inbound_id, email)
         logger.info(
             f"Ключ клиента {client.email} успешно продлён до {new_expiry_time}."
         )
@@ -105,14 +258,14 @@ async def delete_client(
     Функция для удаления клиента с сервера 3x-ui.
     Возвращает True при успешном удалении, иначе False.
     """
-    await xui.login()
+    await ensure_login(xui)
     try:
         if SUPERNODE:
-            await xui.client.delete(inbound_id, client_id)
+            await xui_call(xui, xui.client.delete, inbound_id, client_id)
             logger.info(f"Клиент с ID {client_id} был удален успешно (SUPERNODE).")
             return True
 
-        client = await xui.client.get_by_email(email)
+        client = await xui_call(xui, xui.client.get_by_email, email)
 
         if not client:
             logger.warning(f"Клиент с email {email} и ID {client_id} не найден.")
@@ -120,7 +273,7 @@ async def delete_client(
 
         client.id = client_id
 
-        await xui.client.delete(inbound_id, client.id)
+        await xui_call(xui, xui.client.delete, inbound_id, client.id)
         logger.info(f"Клиент с ID {client_id} был удален успешно.")
         return True
 
@@ -1,4 +1,9 @@
+import asyncio
 import json
+import os
+import re
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Any
 
@@ -6,8 +11,294 @@ import asyncpg
 
 from config import DATABASE_URL, REFERRAL_BONUS_PERCENTAGES
 from logger import logger
+from metrics import (
+    db_pool_acquire_timeouts,
+    db_pool_connections,
+    db_pool_wait_max,
+    record_query,
+    track_db_function,
+)
+from workers import is_leader
+
+try:
+    from config import DB_POOL_MIN_SIZE
+except ImportError:
+    DB_POOL_MIN_SIZE = 2
+
+try:
+    from config import DB_POOL_MAX_SIZE
+except ImportError:
+    DB_POOL_MAX_SIZE = 20
+
+try:
+    from config import DB_POOL_ACQUIRE_TIMEOUT
+except ImportError:
+    DB_POOL_ACQUIRE_TIMEOUT = 10
+
+try:
+    from config import DB_POOL_MAX_INACTIVE_LIFETIME
+except ImportError:
+    DB_POOL_MAX_INACTIVE_LIFETIME = 300
+
+try:
+    from config import SERVERS_CACHE_TTL
+except ImportError:
+    SERVERS_CACHE_TTL = 300
+
+try:
+    from config import CLUSTER_COUNTS_TTL
+except ImportError:
+    CLUSTER_COUNTS_TTL = 600
+
+try:
+    from config import STATS_SNAPSHOT_TTL
+except ImportError:
+    STATS_SNAPSHOT_TTL = 300
+
+SERVERS_CHANNEL = "servers_changed"
+MIGRATIONS_DIR = "assets/migrations"
+MIGRATIONS_LOCK_ID = 0x4D696772  # "Migr"
+MIGRATIONS_LOCK_POLL_INTERVAL = 1
+CONCURRENT_INDEX_RE = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE
+)
+
+_pool: asyncpg.Pool | None = None
+_pool_lock = asyncio.Lock()
+_pool_stats = {
+    "acquired": 0,
+    "timeouts": 0,
+    "waiting": 0,
+    "in_use": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+}
+
+_query_loggers: list = []
+
+_servers_cache: dict | None = None
+_servers_cache_version = 0
+_servers_cache_loaded_at = 0.0
+
+_key_counts: dict[str, int] | None = None
+_key_counts_loaded_at = 0.0
+_key_delete_listeners: list = []
+
+_stats_snapshot: tuple[dict, datetime] | None = None
+_stats_snapshot_loaded_at = 0.0
+
+# Вся статистика админки за один запрос: каждая таблица читается один раз, окна считаются через FILTER.
+STATS_QUERY = """
+    SELECT
+        u.total_users, u.registrations_today, u.registrations_week, u.registrations_month, u.users_updated_today,
+        k.total_keys, k.active_keys,
+        r.total_referrals,
+        p.payments_today, p.payments_week, p.payments_month, p.payments_all_time
+    FROM
+        (
+            SELECT
+                COUNT(*) AS total_users,
+                COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS registrations_today,
+                COUNT(*) FILTER (WHERE created_at >= date_trunc('week', CURRENT_DATE)) AS registrations_week,
+                COUNT(*) FILTER (WHERE created_at >= date_trunc('month', CURRENT_DATE)) AS registrations_month,
+                COUNT(*) FILTER (WHERE updated_at >= CURRENT_DATE) AS users_updated_today
+            FROM users
+        ) u,
+        (
+            SELECT COUNT(*) AS total_keys, COUNT(*) FILTER (WHERE expiry_time > $1) AS active_keys
+            FROM keys
+        ) k,
+        (SELECT COUNT(*) AS total_referrals FROM referrals) r,
+        (
+            SELECT
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= CURRENT_DATE), 0) AS payments_today,
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= date_trunc('week', CURRENT_DATE)), 0) AS payments_week,
+                COALESCE(SUM(amount) FILTER (WHERE created_at >= date_trunc('month', CURRENT_DATE)), 0) AS payments_month,
+                COALESCE(SUM(amount), 0) AS payments_all_time
+            FROM payments
+        ) p
+"""
+
+
+async def get_pool() -> asyncpg.Pool:
+    """
+    Возвращает общий для процесса пул соединений, создавая его при первом обращении.
+
+    Returns:
+        asyncpg.Pool: Пул соединений с базой данных
+    """
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                    init=_init_connection,
+                )
+                logger.info(
+                    f"Создан пул соединений с базой данных: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}"
+                )
+    return _pool
+
+
+def add_query_logger(callback):
+    """
+    Регистрирует обработчик, который asyncpg вызывает после каждого запроса.
+
+    Действует на соединения, созданные пулом после регистрации, поэтому
+    вызывать нужно до первого обращения к get_pool.
+
+    Args:
+        callback: Функция, принимающая asyncpg.connection.LoggedQuery
+    """
+    _query_loggers.append(callback)
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    for callback in _query_loggers:
+        conn.add_query_logger(callback)
+
+
+add_query_logger(record_query)
+
+
+async def connect() -> asyncpg.Connection:
+    """
+    Открывает отдельное соединение с базой вне пула, например для LISTEN или сессионной
+    advisory-блокировки. Адрес берется из DATABASE_URL этого модуля, поэтому его подмена
+    (например, в нагрузочном стенде) действует и на такие соединения.
+    """
+    return await asyncpg.connect(DATABASE_URL)
+
+
+@asynccontextmanager
+async def acquire_connection(conn: Any = None, timeout: float | None = None):
+    """
+    Выдает соединение из общего пула и возвращает его обратно после использования.
+
+    Время ожидания свободного соединения учитывается в статистике пула.
+
+    Args:
+        conn (Any, optional): Уже открытое соединение. Если передано, используется оно, а пул не затрагивается.
+        timeout (float, optional): Максимальное время ожидания соединения в секундах.
+            По умолчанию DB_POOL_ACQUIRE_TIMEOUT.
+
+    Raises:
+        asyncio.TimeoutError: Если свободное соединение не получено за отведенное время
+    """
+    if conn is not None:
+        yield conn
+        return
+
+    pool = await get_pool()
+    started = time.monotonic()
+    _pool_stats["waiting"] += 1
+    try:
+        conn = await pool.acquire(timeout=timeout or DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        _pool_stats["timeouts"] += 1
+        logger.error(
+            f"Не удалось получить соединение из пула за {timeout or DB_POOL_ACQUIRE_TIMEOUT} сек. "
+            f"Статистика пула: {get_pool_stats()}"
+        )
+        raise
+    finally:
+        _pool_stats["waiting"] -= 1
+
+    waited = time.monotonic() - started
+    _pool_stats["acquired"] += 1
+    _pool_stats["wait_total"] += waited
+    _pool_stats["wait_max"] = max(_pool_stats["wait_max"], waited)
+    _pool_stats["in_use"] += 1
+    try:
+        yield conn
+    finally:
+        _pool_stats["in_use"] -= 1
+        await pool.release(conn)
+
+
+def get_pool_stats() -> dict:
+    """
+    Возвращает статистику использования пула соединений.
+
+    Returns:
+        dict: Размер пула, число занятых и свободных соединений, число ожидающих,
+            количество выдач и таймаутов, среднее и максимальное время ожидания в секундах
+    """
+    acquired = _pool_stats["acquired"]
+    return {
+        "size": _pool.get_size() if _pool else 0,
+        "idle": _pool.get_idle_size() if _pool else 0,
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "in_use": _pool_stats["in_use"],
+        "waiting": _pool_stats["waiting"],
+        "acquired": acquired,
+        "timeouts": _pool_stats["timeouts"],
+        "wait_avg": _pool_stats["wait_total"] / acquired if acquired else 0.0,
+        "wait_max": _pool_stats["wait_max"],
+    }
+
+
+def _collect_pool_connections() -> dict[tuple, float]:
+    stats = get_pool_stats()
+    return {(state,): stats[state] for state in ("size", "idle", "in_use", "max_size", "waiting")}
+
+
+db_pool_connections.set_function(_collect_pool_connections)
+db_pool_acquire_timeouts.set_function(lambda: {(): _pool_stats["timeouts"]})
+db_pool_wait_max.set_function(lambda: {(): _pool_stats["wait_max"]})
 
 
+async def check_pool_health() -> bool:
+    """
+    Проверяет доступность базы данных через соединение из пула.
+
+    Returns:
+        bool: True, если база данных отвечает на запрос, иначе False
+    """
+    try:
+        async with acquire_connection() as conn:
+            await conn.fetchval("SELECT 1")
+        return True
+    except Exception as e:
+        logger.error(f"Проверка пула соединений не пройдена: {e}")
+        return False
+
+
+async def monitor_pool(interval: int = 60):
+    """
+    Периодически проверяет пул соединений и сообщает о его насыщении.
+
+    Заполненность пула для графиков и алертов публикуется метриками solobot_db_pool_*,
+    которые считаются при каждом запросе /metrics.
+
+    Args:
+        interval (int, optional): Интервал проверки в секундах. По умолчанию 60.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        healthy = await check_pool_health()
+        stats = get_pool_stats()
+        if not healthy or stats["waiting"] > 0 or stats["in_use"] >= stats["max_size"]:
+            logger.warning(f"Пул соединений перегружен или недоступен: {stats}")
+        else:
+            logger.debug(f"Состояние пула соединений: {stats}")
+
+
+async def close_pool():
+    """Закрывает общий пул соединений."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+        logger.info("Пул соединений с базой данных закрыт")
+
+
+@track_db_function
 async def save_temporary_data(session, tg_id: int, state: str, data: dict):
     """Сохраняет временные данные пользователя."""
     await session.execute(
@@ -24,6 +315,7 @@ async def save_temporary_data(session, tg_id: int, state: str, data: dict):
     )
 
 
+@track_db_function
 async def get_temporary_data(session, tg_id: int) -> dict | None:
     """Извлекает временные данные пользователя."""
     result = await session.fetchrow(
@@ -34,10 +326,12 @@ async def get_temporary_data(session, tg_id: int) -> dict | None:
     return None
 
 
+@track_db_function
 async def clear_temporary_data(session, tg_id: int):
     await session.execute("DELETE FROM temporary_data WHERE tg_id = $1", tg_id)
 
 
+@track_db_function
 async def add_blocked_user(tg_id: int, conn: asyncpg.Connection):
     await conn.execute(
         "INSERT INTO blocked_users (tg_id) VALUES ($1) ON CONFLICT (tg_id) DO NOTHING",
@@ -45,23 +339,131 @@ async def add_blocked_user(tg_id: int, conn: asyncpg.Connection):
     )
 
 
-async def init_db(file_path: str = "assets/schema.sql"):
+@track_db_function
+async def add_blocked_users(tg_ids: list[int], conn: Any = None):
+    """Добавляет пользователей в blocked_users одним запросом."""
+    if not tg_ids:
+        return
+    async with acquire_connection(conn) as conn:
+        await conn.execute(
+            "INSERT INTO blocked_users (tg_id) SELECT unnest($1::bigint[]) ON CONFLICT (tg_id) DO NOTHING",
+            tg_ids,
+        )
+
+
+async def init_db(file_path: str = "assets/schema.sql", migrations_dir: str = MIGRATIONS_DIR):
+    """
+    Создает таблицы из schema.sql и применяет новые миграции из migrations_dir.
+
+    Args:
+        file_path (str, optional): Путь к базовой схеме
+        migrations_dir (str, optional): Каталог с файлами миграций
+    """
     with open(file_path, mode="r") as file:
         sql_content = file.read()
 
-    statements = [stmt.strip() for stmt in sql_content.split(";") if stmt.strip()]
-    conn = await asyncpg.connect(DATABASE_URL)
-
     try:
-        for statement in statements:
-            await conn.execute(statement)
+        async with acquire_connection() as conn:
+            await conn.execute(sql_content)
+            logger.info("Tables created successfully")
+            await apply_migrations(conn, migrations_dir)
     except Exception as e:
         logger.error(f"Error while executing SQL statement: {e}")
+
+
+async def apply_migrations(conn: asyncpg.Connection, migrations_dir: str = MIGRATIONS_DIR) -> list[str]:
+    """
+    Применяет по порядку миграции из migrations_dir, которых еще нет в schema_migrations.
+
+    Файл миграции называется NNNN_описание.sql и выполняется целиком в одной транзакции.
+    Если первая строка файла — "-- no-transaction", выражения выполняются по одному вне транзакции
+    (нужно для CREATE INDEX CONCURRENTLY); каждое выражение в таком файле должно заканчиваться
+    точкой с запятой в конце строки и быть идемпотентным, так как при ошибке файл выполнится заново.
+    Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, который IF NOT EXISTS
+    пропустил бы, поэтому такие индексы удаляются перед созданием, а версия записывается
+    только если все индексы миграции валидны.
+
+    Одновременный запуск из нескольких процессов упорядочивается advisory-блокировкой. Ее ждут
+    опросом pg_try_advisory_lock, а не pg_advisory_lock: ожидающий запрос держит снимок данных,
+    и CREATE INDEX CONCURRENTLY в процессе, владеющем блокировкой, ждал бы его бесконечно.
+
+    Returns:
+        list[str]: Версии примененных миграций
+    """
+    if not os.path.isdir(migrations_dir):
+        return []
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version TEXT PRIMARY KEY,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+    applied = []
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_ID):
+        await asyncio.sleep(MIGRATIONS_LOCK_POLL_INTERVAL)
+    try:
+        done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for file_name in sorted(os.listdir(migrations_dir)):
+            version = file_name.removesuffix(".sql")
+            if not file_name.endswith(".sql") or version in done:
+                continue
+
+            with open(os.path.join(migrations_dir, file_name)) as file:
+                sql = file.read()
+
+            started_at = time.monotonic()
+            if sql.startswith("-- no-transaction"):
+                indexes = []
+                for statement in re.split(r";[ \t]*$", sql, flags=re.MULTILINE):
+                    statement = re.sub(r"--[^\n]*", "", statement).strip()
+                    if not statement:
+                        continue
+                    index_names = CONCURRENT_INDEX_RE.findall(statement)
+                    for index_name in await get_invalid_indexes(conn, index_names):
+                        logger.warning(f"Удаляется невалидный индекс {index_name} от прерванной миграции {version}")
+                        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"')
+                    await conn.execute(statement)
+                    indexes += index_names
+
+                invalid = await get_invalid_indexes(conn, indexes)
+                if invalid:
+                    raise RuntimeError(f"Миграция {version} оставила невалидные индексы: {', '.join(invalid)}")
+                await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+            else:
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+
+            applied.append(version)
+            logger.info(f"Применена миграция {version} за {time.monotonic() - started_at:.1f} с")
     finally:
-        logger.info("Tables created successfully")
-        await conn.close()
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
 
+    return applied
 
+
+async def get_invalid_indexes(conn: asyncpg.Connection, index_names: list[str]) -> list[str]:
+    """Возвращает индексы текущей схемы из index_names, помеченные в pg_index как невалидные."""
+    if not index_names:
+        return []
+    rows = await conn.fetch(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema() AND c.relname = ANY($1::text[])
+        """,
+        [index_name.lower() for index_name in index_names],
+    )
+    return [row["relname"] for row in rows]
+
+
+@track_db_function
 async def check_unique_server_name(server_name: str) -> bool:
     """
     Проверяет уникальность имени сервера.
@@ -69,17 +471,15 @@ async def check_unique_server_name(server_name: str) -> bool:
     :param server_name: Имя сервера.
     :return: True, если имя сервера уникально, False, если уже существует.
     """
-    conn = await asyncpg.connect(DATABASE_URL)
-
-    result = await conn.fetchrow(
-        "SELECT 1 FROM servers WHERE server_name = $1 LIMIT 1", server_name
-    )
-
-    await conn.close()
+    async with acquire_connection() as conn:
+        result = await conn.fetchrow(
+            "SELECT 1 FROM servers WHERE server_name = $1 LIMIT 1", server_name
+        )
 
     return result is None
 
 
+@track_db_function
 async def create_coupon(
     coupon_code: str, amount: float, usage_limit: int, session: Any
 ):
@@ -114,6 +514,7 @@ async def create_coupon(
         raise
 
 
+@track_db_function
 async def get_all_coupons(session: Any):
     """
     Получает список всех купонов из базы данных.
@@ -145,6 +546,7 @@ async def get_all_coupons(session: Any):
         return []
 
 
+@track_db_function
 async def delete_coupon_from_db(coupon_code: str, session: Any):
     """
     Удаляет купон из базы данных по его коду.
@@ -189,6 +591,7 @@ async def delete_coupon_from_db(coupon_code: str, session: Any):
         return False
 
 
+@track_db_function
 async def restore_trial(tg_id: int, session: Any):
     """
     Восстанавливает возможность использования триального периода для пользователя.
@@ -219,6 +622,7 @@ async def restore_trial(tg_id: int, session: Any):
         return False
 
 
+@track_db_function
 async def use_trial(tg_id: int, session: Any):
     """
     Отмечает использование триального периода для пользователя.
@@ -247,6 +651,7 @@ async def use_trial(tg_id: int, session: Any):
         return False
 
 
+@track_db_function
 async def add_connection(
     tg_id: int, balance: float = 0.0, trial: int = 0, session: Any = None
 ):
@@ -282,6 +687,7 @@ async def add_connection(
         raise
 
 
+@track_db_function
 async def check_connection_exists(tg_id: int):
     """
     Проверяет существование подключения для указанного пользователя в базе данных.
@@ -296,25 +702,23 @@ async def check_connection_exists(tg_id: int):
         Exception: В случае ошибки при подключении к базе данных.
     """
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        exists = await conn.fetchval(
-            """
-            SELECT EXISTS(SELECT 1 FROM connections WHERE tg_id = $1)
-            """,
-            tg_id,
-        )
-        logger.info(
-            f"Проверка существования подключения для пользователя {tg_id}: {'найдено' if exists else 'не найдено'}"
-        )
-        return exists
+        async with acquire_connection() as conn:
+            exists = await conn.fetchval(
+                """
+                SELECT EXISTS(SELECT 1 FROM connections WHERE tg_id = $1)
+                """,
+                tg_id,
+            )
+            logger.info(
+                f"Проверка существования подключения для пользователя {tg_id}: {'найдено' if exists else 'не найдено'}"
+            )
+            return exists
     except Exception as e:
         logger.error(f"Ошибка при проверке подключения для пользователя {tg_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def store_key(
     tg_id: int,
     client_id: str,
@@ -352,6 +756,7 @@ async def store_key(
             key,
             server_id,
         )
+        adjust_key_count(server_id, 1)
         logger.info(
             f"Ключ успешно сохранен для пользователя {tg_id} на сервере {server_id}"
         )
@@ -360,6 +765,7 @@ async def store_key(
         raise
 
 
+@track_db_function
 async def get_keys(tg_id: int):
     """
     Получает список ключей для указанного пользователя.
@@ -373,27 +779,24 @@ async def get_keys(tg_id: int):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        records = await conn.fetch(
-            """
-            SELECT client_id, email, created_at, key
-            FROM keys
-            WHERE tg_id = $1
-            """,
-            tg_id,
-        )
-        logger.info(f"Успешно получено {len(records)} ключей для пользователя {tg_id}")
-        return records
+        async with acquire_connection() as conn:
+            records = await conn.fetch(
+                """
+                SELECT client_id, email, created_at, key
+                FROM keys
+                WHERE tg_id = $1
+                """,
+                tg_id,
+            )
+            logger.info(f"Успешно получено {len(records)} ключей для пользователя {tg_id}")
+            return records
     except Exception as e:
         logger.error(f"Ошибка при получении ключей для пользователя {tg_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def get_keys_by_server(tg_id: int, server_id: str):
     """
     Получает список ключей для указанного пользователя на определенном сервере.
@@ -408,32 +811,29 @@ async def get_keys_by_server(tg_id: int, server_id: str):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        records = await conn.fetch(
-            """
-            SELECT client_id, email, created_at, key
-            FROM keys
-            WHERE tg_id = $1 AND server_id = $2
-            """,
-            tg_id,
-            server_id,
-        )
-        logger.info(
-            f"Успешно получено {len(records)} ключей для пользователя {tg_id} на сервере {server_id}"
-        )
-        return records
+        async with acquire_connection() as conn:
+            records = await conn.fetch(
+                """
+                SELECT client_id, email, created_at, key
+                FROM keys
+                WHERE tg_id = $1 AND server_id = $2
+                """,
+                tg_id,
+                server_id,
+            )
+            logger.info(
+                f"Успешно получено {len(records)} ключей для пользователя {tg_id} на сервере {server_id}"
+            )
+            return records
     except Exception as e:
         logger.error(
             f"Ошибка при получении ключей для пользователя {tg_id} на сервере {server_id}: {e}"
         )
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def has_active_key(tg_id: int) -> bool:
     """
     Проверяет наличие активных ключей для указанного пользователя.
@@ -447,24 +847,21 @@ async def has_active_key(tg_id: int) -> bool:
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        count = await conn.fetchval("SELECT COUNT(*) FROM keys WHERE tg_id = $1", tg_id)
-        logger.info(
-            f"Проверка наличия ключей для пользователя {tg_id}. Найдено ключей: {count}"
-        )
-        return count > 0
+        async with acquire_connection() as conn:
+            count = await conn.fetchval("SELECT COUNT(*) FROM keys WHERE tg_id = $1", tg_id)
+            logger.info(
+                f"Проверка наличия ключей для пользователя {tg_id}. Найдено ключей: {count}"
+            )
+            return count > 0
     except Exception as e:
         logger.error(
             f"Ошибка при проверке наличия ключей для пользователя {tg_id}: {e}"
         )
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def get_balance(tg_id: int) -> float:
     """
     Получает баланс пользователя из базы данных.
@@ -478,22 +875,19 @@ async def get_balance(tg_id: int) -> float:
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        balance = await conn.fetchval(
-            "SELECT balance FROM connections WHERE tg_id = $1", tg_id
-        )
-        logger.info(f"Получен баланс для пользователя {tg_id}: {balance}")
-        return balance if balance is not None else 0.0
+        async with acquire_connection() as conn:
+            balance = await conn.fetchval(
+                "SELECT balance FROM connections WHERE tg_id = $1", tg_id
+            )
+            logger.info(f"Получен баланс для пользователя {tg_id}: {balance}")
+            return balance if balance is not None else 0.0
     except Exception as e:
         logger.error(f"Ошибка при получении баланса для пользователя {tg_id}: {e}")
         return 0.0
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def update_balance(tg_id: int, amount: float):
     """
     Обновляет баланс пользователя в базе данных.
@@ -505,30 +899,27 @@ async def update_balance(tg_id: int, amount: float):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или обновлении баланса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        await conn.execute(
-            """
-            UPDATE connections
-            SET balance = balance + $1
-            WHERE tg_id = $2
-            """,
-            amount,
-            tg_id,
-        )
-        logger.info(f"Баланс пользователя {tg_id} обновлен на сумму {amount}")
+        async with acquire_connection() as conn:
+            await conn.execute(
+                """
+                UPDATE connections
+                SET balance = balance + $1
+                WHERE tg_id = $2
+                """,
+                amount,
+                tg_id,
+            )
+            logger.info(f"Баланс пользователя {tg_id} обновлен на сумму {amount}")
 
         await handle_referral_on_balance_update(tg_id, amount)
 
     except Exception as e:
         logger.error(f"Ошибка при обновлении баланса для пользователя {tg_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def get_trial(tg_id: int, session: Any) -> int:
     """
     Получает статус триала для пользователя из базы данных.
@@ -553,6 +944,7 @@ async def get_trial(tg_id: int, session: Any) -> int:
         return 0
 
 
+@track_db_function
 async def get_key_count(tg_id: int) -> int:
     """
     Получает количество ключей для указанного пользователя.
@@ -566,22 +958,19 @@ async def get_key_count(tg_id: int) -> int:
     Raises:
         Exception: В случае ошибки при подключении к базе данных
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        count = await conn.fetchval("SELECT COUNT(*) FROM keys WHERE tg_id = $1", tg_id)
-        logger.info(f"Получено количество ключей для пользователя {tg_id}: {count}")
-        return count if count is not None else 0
+        async with acquire_connection() as conn:
+            count = await conn.fetchval("SELECT COUNT(*) FROM keys WHERE tg_id = $1", tg_id)
+            logger.info(f"Получено количество ключей для пользователя {tg_id}: {count}")
+            return count if count is not None else 0
     except Exception as e:
         logger.error(
             f"Ошибка при получении количества ключей для пользователя {tg_id}: {e}"
         )
         return 0
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def get_all_users(conn):
     """
     Получает список всех пользователей из базы данных.
@@ -604,6 +993,7 @@ async def get_all_users(conn):
         raise
 
 
+@track_db_function
 async def add_referral(referred_tg_id: int, referrer_tg_id: int, session: Any):
     try:
 
@@ -629,6 +1019,7 @@ async def add_referral(referred_tg_id: int, referrer_tg_id: int, session: Any):
         raise
 
 
+@track_db_function
 async def handle_referral_on_balance_update(tg_id: int, amount: float):
     """
     Обработка многоуровневой реферальной системы при обновлении баланса пользователя.
@@ -640,50 +1031,49 @@ async def handle_referral_on_balance_update(tg_id: int, amount: float):
         tg_id (int): Идентификатор Telegram пользователя, пополнившего баланс
         amount (float): Сумма пополнения баланса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(f"Начало обработки реферальной системы для пользователя {tg_id}")
-
-        MAX_REFERRAL_LEVELS = len(REFERRAL_BONUS_PERCENTAGES.keys())
-        if MAX_REFERRAL_LEVELS == 0:
-            logger.warning("Реферальные бонусы отключены.")
-            return
-
-        visited_tg_ids = set()
-        current_tg_id = tg_id
-        referral_chain = []
-
-        for level in range(1, MAX_REFERRAL_LEVELS + 1):
-            if current_tg_id in visited_tg_ids:
-                logger.warning(
-                    f"Обнаружен цикл в реферальной цепочке для пользователя {current_tg_id}. Прекращение."
+        async with acquire_connection() as conn:
+            logger.info(f"Начало обработки реферальной системы для пользователя {tg_id}")
+
+            MAX_REFERRAL_LEVELS = len(REFERRAL_BONUS_PERCENTAGES.keys())
+            if MAX_REFERRAL_LEVELS == 0:
+                logger.warning("Реферальные бонусы отключены.")
+                return
+
+            visited_tg_ids = set()
+            current_tg_id = tg_id
+            referral_chain = []
+
+            for level in range(1, MAX_REFERRAL_LEVELS + 1):
+                if current_tg_id in visited_tg_ids:
+                    logger.warning(
+                        f"Обнаружен цикл в реферальной цепочке для пользователя {current_tg_id}. Прекращение."
+                    )
+                    break
+
+                visited_tg_ids.add(current_tg_id)
+
+                referral = await conn.fetchrow(
+                    """
+                    SELECT referrer_tg_id 
+                    FROM referrals 
+                    WHERE referred_tg_id = $1
+                    """,
+                    current_tg_id,
                 )
-                break
 
-            visited_tg_ids.add(current_tg_id)
+                if not referral:
+                    logger.info(f"Цепочка рефералов завершена на уровне {level}.")
+                    break
 
-            referral = await conn.fetchrow(
-                """
-                SELECT referrer_tg_id 
-                FROM referrals 
-                WHERE referred_tg_id = $1
-                """,
-                current_tg_id,
-            )
+                referrer_tg_id = referral["referrer_tg_id"]
 
-            if not referral:
-                logger.info(f"Цепочка рефералов завершена на уровне {level}.")
-                break
+                if referrer_tg_id in visited_tg_ids:
+                    logger.warning(f"Реферер {referrer_tg_id} уже обработан. Пропуск.")
+                    break
 
-            referrer_tg_id = referral["referrer_tg_id"]
-
-            if referrer_tg_id in visited_tg_ids:
-                logger.warning(f"Реферер {referrer_tg_id} уже обработан. Пропуск.")
-                break
-
-            referral_chain.append({"tg_id": referrer_tg_id, "level": level})
-            current_tg_id = referrer_tg_id
+                referral_chain.append({"tg_id": referrer_tg_id, "level": level})
+                current_tg_id = referrer_tg_id
 
         for referral in referral_chain:
             referrer_tg_id = referral["tg_id"]
@@ -706,126 +1096,120 @@ async def handle_referral_on_balance_update(tg_id: int, amount: float):
         logger.error(
             f"Ошибка при обработке многоуровневой реферальной системы для {tg_id}: {e}"
         )
-    finally:
-        if conn:
-            await conn.close()
 
 
+@track_db_function
 async def get_referral_stats(referrer_tg_id: int):
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для получения статистики рефералов пользователя {referrer_tg_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для получения статистики рефералов пользователя {referrer_tg_id}"
+            )
 
-        total_referrals = await conn.fetchval(
-            """
-            SELECT COUNT(*) FROM referrals WHERE referrer_tg_id = $1
-            """,
-            referrer_tg_id,
-        )
-        logger.debug(f"Получено общее количество рефералов: {total_referrals}")
+            total_referrals = await conn.fetchval(
+                """
+                SELECT COUNT(*) FROM referrals WHERE referrer_tg_id = $1
+                """,
+                referrer_tg_id,
+            )
+            logger.debug(f"Получено общее количество рефералов: {total_referrals}")
 
-        active_referrals = await conn.fetchval(
-            """
-            SELECT COUNT(*) FROM referrals WHERE referrer_tg_id = $1 AND reward_issued = TRUE
-            """,
-            referrer_tg_id,
-        )
-        logger.debug(f"Получено количество активных рефералов: {active_referrals}")
+            active_referrals = await conn.fetchval(
+                """
+                SELECT COUNT(*) FROM referrals WHERE referrer_tg_id = $1 AND reward_issued = TRUE
+                """,
+                referrer_tg_id,
+            )
+            logger.debug(f"Получено количество активных рефералов: {active_referrals}")
 
-        MAX_REFERRAL_LEVELS = len(REFERRAL_BONUS_PERCENTAGES.keys())
+            MAX_REFERRAL_LEVELS = len(REFERRAL_BONUS_PERCENTAGES.keys())
 
-        referrals_by_level_records = await conn.fetch(
-            f"""
-            WITH RECURSIVE referral_levels AS (
-                SELECT referred_tg_id, referrer_tg_id, 1 AS level
-                FROM referrals 
-                WHERE referrer_tg_id = $1
+            referrals_by_level_records = await conn.fetch(
+                f"""
+                WITH RECURSIVE referral_levels AS (
+                    SELECT referred_tg_id, referrer_tg_id, 1 AS level
+                    FROM referrals 
+                    WHERE referrer_tg_id = $1
                 
-                UNION
+                    UNION
                 
-                SELECT r.referred_tg_id, r.referrer_tg_id, rl.level + 1
-                FROM referrals r
-                JOIN referral_levels rl ON r.referrer_tg_id = rl.referred_tg_id
-                WHERE rl.level < {MAX_REFERRAL_LEVELS}
+                    SELECT r.referred_tg_id, r.referrer_tg_id, rl.level + 1
+                    FROM referrals r
+                    JOIN referral_levels rl ON r.referrer_tg_id = rl.referred_tg_id
+                    WHERE rl.level < {MAX_REFERRAL_LEVELS}
+                )
+                SELECT level, 
+                       COUNT(*) AS level_count, 
+                       COUNT(CASE WHEN reward_issued = TRUE THEN 1 END) AS active_level_count
+                FROM referral_levels rl
+                JOIN referrals r ON rl.referred_tg_id = r.referred_tg_id
+                GROUP BY level
+                ORDER BY level
+                """,
+                referrer_tg_id,
             )
-            SELECT level, 
-                   COUNT(*) AS level_count, 
-                   COUNT(CASE WHEN reward_issued = TRUE THEN 1 END) AS active_level_count
-            FROM referral_levels rl
-            JOIN referrals r ON rl.referred_tg_id = r.referred_tg_id
-            GROUP BY level
-            ORDER BY level
-            """,
-            referrer_tg_id,
-        )
 
-        referrals_by_level = {
-            record["level"]: {
-                "total": record["level_count"],
-                "active": record["active_level_count"],
+            referrals_by_level = {
+                record["level"]: {
+                    "total": record["level_count"],
+                    "active": record["active_level_count"],
+                }
+                for record in referrals_by_level_records
             }
-            for record in referrals_by_level_records
-        }
-        logger.debug(f"Получена статистика рефералов по уровням: {referrals_by_level}")
-
-        total_referral_bonus = await conn.fetchval(
-            f"""
-            WITH RECURSIVE referral_levels AS (
-                SELECT 
-                    referred_tg_id, 
-                    referrer_tg_id, 
-                    1 AS level
-                FROM referrals 
-                WHERE referrer_tg_id = $1
+            logger.debug(f"Получена статистика рефералов по уровням: {referrals_by_level}")
+
+            total_referral_bonus = await conn.fetchval(
+                f"""
+                WITH RECURSIVE referral_levels AS (
+                    SELECT 
+                        referred_tg_id, 
+                        referrer_tg_id, 
+                        1 AS level
+                    FROM referrals 
+                    WHERE referrer_tg_id = $1
                 
-                UNION
+                    UNION
                 
+                    SELECT 
+                        r.referred_tg_id, 
+                        r.referrer_tg_id, 
+                        rl.level + 1
+                    FROM referrals r
+                    JOIN referral_levels rl ON r.referrer_tg_id = rl.referred_tg_id
+                    WHERE rl.level < {MAX_REFERRAL_LEVELS}
+                )
                 SELECT 
-                    r.referred_tg_id, 
-                    r.referrer_tg_id, 
-                    rl.level + 1
-                FROM referrals r
-                JOIN referral_levels rl ON r.referrer_tg_id = rl.referred_tg_id
-                WHERE rl.level < {MAX_REFERRAL_LEVELS}
+                    COALESCE(SUM(p.amount * (
+                        CASE 
+                            {" ".join([f"WHEN rl.level = {level} THEN {REFERRAL_BONUS_PERCENTAGES[level]}" for level in REFERRAL_BONUS_PERCENTAGES])}
+                            ELSE 0 
+                        END)), 0) AS total_bonus
+                FROM referral_levels rl
+                JOIN payments p ON rl.referred_tg_id = p.tg_id
+                WHERE p.status = 'success' AND rl.level <= {MAX_REFERRAL_LEVELS}
+                """,
+                referrer_tg_id,
             )
-            SELECT 
-                COALESCE(SUM(p.amount * (
-                    CASE 
-                        {" ".join([f"WHEN rl.level = {level} THEN {REFERRAL_BONUS_PERCENTAGES[level]}" for level in REFERRAL_BONUS_PERCENTAGES])}
-                        ELSE 0 
-                    END)), 0) AS total_bonus
-            FROM referral_levels rl
-            JOIN payments p ON rl.referred_tg_id = p.tg_id
-            WHERE p.status = 'success' AND rl.level <= {MAX_REFERRAL_LEVELS}
-            """,
-            referrer_tg_id,
-        )
 
-        logger.debug(
-            f"Получена общая сумма бонусов от рефералов: {total_referral_bonus}"
-        )
+            logger.debug(
+                f"Получена общая сумма бонусов от рефералов: {total_referral_bonus}"
+            )
 
-        return {
-            "total_referrals": total_referrals,
-            "active_referrals": active_referrals,
-            "referrals_by_level": referrals_by_level,
-            "total_referral_bonus": total_referral_bonus,
-        }
+            return {
+                "total_referrals": total_referrals,
+                "active_referrals": active_referrals,
+                "referrals_by_level": referrals_by_level,
+                "total_referral_bonus": total_referral_bonus,
+            }
 
     except Exception as e:
         logger.error(
             f"Ошибка при получении статистики рефералов для пользователя {referrer_tg_id}: {e}"
         )
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def update_key_expiry(client_id: str, new_expiry_time: int):
     """
     Обновление времени истечения ключа для указанного клиента.
@@ -837,35 +1221,31 @@ async def update_key_expiry(client_id: str, new_expiry_time: int):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или обновлении ключа
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для обновления времени истечения ключа клиента {client_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для обновления времени истечения ключа клиента {client_id}"
+            )
 
-        await conn.execute(
-            """
-            UPDATE keys
-            SET expiry_time = $1, notified = FALSE, notified_24h = FALSE
-            WHERE client_id = $2
-        """,
-            new_expiry_time,
-            client_id,
-        )
-        logger.info(f"Успешно обновлено время истечения ключа для клиента {client_id}")
+            await conn.execute(
+                """
+                UPDATE keys
+                SET expiry_time = $1, notified = FALSE, notified_24h = FALSE
+                WHERE client_id = $2
+            """,
+                new_expiry_time,
+                client_id,
+            )
+            logger.info(f"Успешно обновлено время истечения ключа для клиента {client_id}")
 
     except Exception as e:
         logger.error(
             f"Ошибка при обновлении времени истечения ключа для клиента {client_id}: {e}"
         )
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def delete_key(client_id: str):
     """
     Удаление ключа из базы данных для указанного клиента.
@@ -876,31 +1256,29 @@ async def delete_key(client_id: str):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или удалении ключа
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для удаления ключа клиента {client_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для удаления ключа клиента {client_id}"
+            )
 
-        await conn.execute(
-            """
-            DELETE FROM keys
-            WHERE client_id = $1
-            """,
-            client_id,
-        )
-        logger.info(f"Успешно удален ключ для клиента {client_id}")
+            deleted = await conn.fetch(
+                """
+                DELETE FROM keys
+                WHERE client_id = $1
+                RETURNING server_id, email
+                """,
+                client_id,
+            )
+            keys_deleted(deleted)
+            logger.info(f"Успешно удален ключ для клиента {client_id}")
 
     except Exception as e:
         logger.error(f"Ошибка при удалении ключа для клиента {client_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def add_balance_to_client(client_id: str, amount: float):
     """
     Добавление баланса клиенту по его идентификатору Telegram.
@@ -912,33 +1290,29 @@ async def add_balance_to_client(client_id: str, amount: float):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или обновлении баланса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для пополнения баланса клиента {client_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для пополнения баланса клиента {client_id}"
+            )
 
-        await conn.execute(
-            """
-            UPDATE connections
-            SET balance = balance + $1
-            WHERE tg_id = $2
-            """,
-            amount,
-            client_id,
-        )
-        logger.info(f"Успешно пополнен баланс клиента {client_id} на сумму {amount}")
+            await conn.execute(
+                """
+                UPDATE connections
+                SET balance = balance + $1
+                WHERE tg_id = $2
+                """,
+                amount,
+                client_id,
+            )
+            logger.info(f"Успешно пополнен баланс клиента {client_id} на сумму {amount}")
 
     except Exception as e:
         logger.error(f"Ошибка при пополнении баланса для клиента {client_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def get_client_id_by_email(email: str):
     """
     Получение идентификатора клиента по электронной почте.
@@ -952,36 +1326,32 @@ async def get_client_id_by_email(email: str):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для поиска client_id по email: {email}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для поиска client_id по email: {email}"
+            )
 
-        client_id = await conn.fetchval(
-            """
-            SELECT client_id FROM keys WHERE email = $1
-        """,
-            email,
-        )
+            client_id = await conn.fetchval(
+                """
+                SELECT client_id FROM keys WHERE email = $1
+            """,
+                email,
+            )
 
-        if client_id:
-            logger.info(f"Найден client_id для email: {email}")
-        else:
-            logger.warning(f"Не найден client_id для email: {email}")
+            if client_id:
+                logger.info(f"Найден client_id для email: {email}")
+            else:
+                logger.warning(f"Не найден client_id для email: {email}")
 
-        return client_id
+            return client_id
 
     except Exception as e:
         logger.error(f"Ошибка при получении client_id для email {email}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def get_tg_id_by_client_id(client_id: str):
     """
     Получение Telegram ID по идентификатору клиента.
@@ -995,33 +1365,29 @@ async def get_tg_id_by_client_id(client_id: str):
     Raises:
         Exception: В случае ошибки при подключении к базе данных или выполнении запроса
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для поиска Telegram ID по client_id: {client_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для поиска Telegram ID по client_id: {client_id}"
+            )
 
-        result = await conn.fetchrow(
-            "SELECT tg_id FROM keys WHERE client_id = $1", client_id
-        )
+            result = await conn.fetchrow(
+                "SELECT tg_id FROM keys WHERE client_id = $1", client_id
+            )
 
-        if result:
-            logger.info(f"Найден Telegram ID для client_id: {client_id}")
-            return result["tg_id"]
-        else:
-            logger.warning(f"Не найден Telegram ID для client_id: {client_id}")
-            return None
+            if result:
+                logger.info(f"Найден Telegram ID для client_id: {client_id}")
+                return result["tg_id"]
+            else:
+                logger.warning(f"Не найден Telegram ID для client_id: {client_id}")
+                return None
 
     except Exception as e:
         logger.error(f"Ошибка при получении Telegram ID для client_id {client_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def upsert_user(
     tg_id: int,
     username: str = None,
@@ -1033,6 +1399,8 @@ async def upsert_user(
     """
     Обновляет или вставляет информацию о пользователе в базу данных.
 
+    Пользователь снова пишет боту, значит он его разблокировал: запись в blocked_users удаляется.
+
     Args:
         tg_id (int): Идентификатор пользователя в Telegram
         username (str, optional): Имя пользователя в Telegram
@@ -1044,19 +1412,62 @@ async def upsert_user(
     Raises:
         Exception: В случае ошибки при работе с базой данных
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для обновления пользователя {tg_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для обновления пользователя {tg_id}"
+            )
+
+            await conn.execute(
+                """
+                WITH unblocked AS (DELETE FROM blocked_users WHERE tg_id = $1)
+                INSERT INTO users (tg_id, username, first_name, last_name, language_code, is_bot, created_at, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (tg_id) DO UPDATE 
+                SET 
+                    username = COALESCE(EXCLUDED.username, users.username),
+                    first_name = COALESCE(EXCLUDED.first_name, users.first_name),
+                    last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+                    language_code = COALESCE(EXCLUDED.language_code, users.language_code),
+                    is_bot = EXCLUDED.is_bot,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                tg_id,
+                username,
+                first_name,
+                last_name,
+                language_code,
+                is_bot,
+            )
+            logger.info(f"Успешно обновлена информация о пользователе {tg_id}")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении информации о пользователе {tg_id}: {e}")
+        raise
+
+
+@track_db_function
+async def upsert_users(users: list[tuple]):
+    """
+    Обновляет или вставляет информацию о нескольких пользователях одним запросом
+    и удаляет их из blocked_users, как и upsert_user.
+
+    Args:
+        users (list[tuple]): Кортежи (tg_id, username, first_name, last_name, language_code, is_bot)
+    """
+    if not users:
+        return
 
+    columns = list(zip(*users))
+    async with acquire_connection() as conn:
         await conn.execute(
             """
+            WITH unblocked AS (DELETE FROM blocked_users WHERE tg_id = ANY($1::bigint[]))
             INSERT INTO users (tg_id, username, first_name, last_name, language_code, is_bot, created_at, updated_at)
-            VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ON CONFLICT (tg_id) DO UPDATE 
-            SET 
+            SELECT tg_id, username, first_name, last_name, language_code, is_bot, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+            FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::text[], $6::boolean[])
+                AS t(tg_id, username, first_name, last_name, language_code, is_bot)
+            ON CONFLICT (tg_id) DO UPDATE
+            SET
                 username = COALESCE(EXCLUDED.username, users.username),
                 first_name = COALESCE(EXCLUDED.first_name, users.first_name),
                 last_name = COALESCE(EXCLUDED.last_name, users.last_name),
@@ -1064,23 +1475,11 @@ async def upsert_user(
                 is_bot = EXCLUDED.is_bot,
                 updated_at = CURRENT_TIMESTAMP
             """,
-            tg_id,
-            username,
-            first_name,
-            last_name,
-            language_code,
-            is_bot,
+            *(list(column) for column in columns),
         )
-        logger.info(f"Успешно обновлена информация о пользователе {tg_id}")
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении информации о пользователе {tg_id}: {e}")
-        raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных")
 
 
+@track_db_function
 async def add_payment(tg_id: int, amount: float, payment_system: str):
     """
     Добавляет информацию о платеже в базу данных.
@@ -1093,34 +1492,30 @@ async def add_payment(tg_id: int, amount: float, payment_system: str):
     Raises:
         Exception: В случае ошибки при добавлении платежа
     """
-    conn = None
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info(
-            f"Установлено подключение к базе данных для добавления платежа пользователя {tg_id}"
-        )
+        async with acquire_connection() as conn:
+            logger.info(
+                f"Установлено подключение к базе данных для добавления платежа пользователя {tg_id}"
+            )
 
-        await conn.execute(
-            """
-            INSERT INTO payments (tg_id, amount, payment_system, status)
-            VALUES ($1, $2, $3, 'success')
-            """,
-            tg_id,
-            amount,
-            payment_system,
-        )
-        logger.info(
-            f"Успешно добавлен платеж для пользователя {tg_id} на сумму {amount}"
-        )
+            await conn.execute(
+                """
+                INSERT INTO payments (tg_id, amount, payment_system, status)
+                VALUES ($1, $2, $3, 'success')
+                """,
+                tg_id,
+                amount,
+                payment_system,
+            )
+            logger.info(
+                f"Успешно добавлен платеж для пользователя {tg_id} на сумму {amount}"
+            )
     except Exception as e:
         logger.error(f"Ошибка при добавлении платежа для пользователя {tg_id}: {e}")
         raise
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Закрытие подключения к базе данных после добавления платежа")
 
 
+@track_db_function
 async def add_notification(tg_id: int, notification_type: str, session: Any):
     """
     Добавляет запись о notification в базу данных.
@@ -1154,6 +1549,7 @@ async def add_notification(tg_id: int, notification_type: str, session: Any):
         raise
 
 
+@track_db_function
 async def check_notification_time(
     tg_id: int, notification_type: str, hours: int = 12, session: Any = None
 ) -> bool:
@@ -1172,33 +1568,31 @@ async def check_notification_time(
     Raises:
         Exception: В случае ошибки при проверке времени уведомления
     """
-    conn = None
     try:
-        conn = session if session is not None else await asyncpg.connect(DATABASE_URL)
-
-        result = await conn.fetchval(
-            """
-            SELECT 
-                CASE 
-                    WHEN MAX(last_notification_time) IS NULL THEN TRUE
-                    WHEN NOW() - MAX(last_notification_time) > ($1 * INTERVAL '1 hour') THEN TRUE
-                    ELSE FALSE 
-                END AS can_notify
-            FROM notifications 
-            WHERE tg_id = $2 AND notification_type = $3
-            """,
-            hours,
-            tg_id,
-            notification_type,
-        )
+        async with acquire_connection(session) as conn:
+            result = await conn.fetchval(
+                """
+                SELECT 
+                    CASE 
+                        WHEN MAX(last_notification_time) IS NULL THEN TRUE
+                        WHEN NOW() - MAX(last_notification_time) > ($1 * INTERVAL '1 hour') THEN TRUE
+                        ELSE FALSE 
+                    END AS can_notify
+                FROM notifications 
+                WHERE tg_id = $2 AND notification_type = $3
+                """,
+                hours,
+                tg_id,
+                notification_type,
+            )
 
-        can_notify = result if result is not None else True
+            can_notify = result if result is not None else True
 
-        logger.info(
-            f"Проверка уведомления типа {notification_type} для пользователя {tg_id}: {'можно отправить' if can_notify else 'слишком рано'}"
-        )
+            logger.info(
+                f"Проверка уведомления типа {notification_type} для пользователя {tg_id}: {'можно отправить' if can_notify else 'слишком рано'}"
+            )
 
-        return can_notify
+            return can_notify
 
     except Exception as e:
         logger.error(
@@ -1206,22 +1600,164 @@ async def check_notification_time(
         )
         return False
 
-    finally:
-        if conn is not None and session is None:
-            await conn.close()
 
+@track_db_function
+async def get_key_counts(force: bool = False) -> dict[str, int]:
+    """
+    Возвращает количество ключей по server_id.
+
+    Счетчики загружаются одним запросом с GROUP BY, затем поддерживаются при
+    store_key/delete_key и полностью пересчитываются раз в CLUSTER_COUNTS_TTL секунд,
+    чтобы учесть удаления в обход этих функций.
+
+    Args:
+        force (bool, optional): Пересчитать счетчики немедленно. По умолчанию False.
+    """
+    global _key_counts, _key_counts_loaded_at
+
+    if force or _key_counts is None or time.monotonic() - _key_counts_loaded_at > CLUSTER_COUNTS_TTL:
+        async with acquire_connection() as conn:
+            rows = await conn.fetch("SELECT server_id, COUNT(*) AS total FROM keys GROUP BY server_id")
+        _key_counts = {row["server_id"]: row["total"] for row in rows}
+        _key_counts_loaded_at = time.monotonic()
+        logger.debug(f"Счетчики ключей пересчитаны: {_key_counts}")
+
+    return dict(_key_counts)
+
+
+def adjust_key_count(server_id: str, delta: int):
+    """Изменяет счетчик ключей server_id на delta, если счетчики уже загружены."""
+    if _key_counts is not None:
+        _key_counts[server_id] = max(_key_counts.get(server_id, 0) + delta, 0)
+
+
+def add_key_delete_listener(callback):
+    """
+    Регистрирует функцию, которую keys_deleted вызывает с email каждого удаленного ключа,
+    например для сброса кэша подписок.
+    """
+    _key_delete_listeners.append(callback)
+
+
+def keys_deleted(rows):
+    """
+    Учитывает удаленные ключи: уменьшает счетчики кластеров и уведомляет подписчиков.
+
+    Args:
+        rows: Строки из DELETE FROM keys ... RETURNING server_id, email
+    """
+    for row in rows:
+        adjust_key_count(row["server_id"], -1)
+        for callback in _key_delete_listeners:
+            callback(row["email"])
+
+
+@track_db_function
+async def refresh_stats_snapshot() -> tuple[dict, datetime]:
+    """
+    Пересчитывает статистику админки одним запросом и сохраняет снимок в stats_snapshot.
+
+    Returns:
+        tuple[dict, datetime]: Статистика и время ее расчета
+    """
+    global _stats_snapshot, _stats_snapshot_loaded_at
+
+    async with acquire_connection() as conn:
+        row = await conn.fetchrow(STATS_QUERY, int(datetime.utcnow().timestamp() * 1000))
+        stats = {name: float(value) if name.startswith("payments_") else value for name, value in row.items()}
+        stats["expired_keys"] = stats["total_keys"] - stats["active_keys"]
+        refreshed_at = await conn.fetchval(
+            """
+            INSERT INTO stats_snapshot (id, data, refreshed_at)
+            VALUES (1, $1::jsonb, CURRENT_TIMESTAMP)
+            ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, refreshed_at = EXCLUDED.refreshed_at
+            RETURNING refreshed_at
+            """,
+            json.dumps(stats),
+        )
+
+    _stats_snapshot = (stats, refreshed_at)
+    _stats_snapshot_loaded_at = time.monotonic()
+    logger.debug(f"Снимок статистики обновлен: {stats}")
+    return _stats_snapshot
+
+
+@track_db_function
+async def get_stats_snapshot(force: bool = False) -> tuple[dict, datetime]:
+    """
+    Возвращает статистику админки из снимка не старше STATS_SNAPSHOT_TTL секунд.
+
+    Снимок хранится в таблице stats_snapshot и общий для всех процессов; процесс держит
+    его копию в памяти. Если снимка нет или он устарел, статистика пересчитывается сразу.
+
+    Args:
+        force (bool, optional): Пересчитать статистику немедленно. По умолчанию False.
+
+    Returns:
+        tuple[dict, datetime]: Статистика и время ее расчета
+    """
+    global _stats_snapshot, _stats_snapshot_loaded_at
+
+    if force:
+        return await refresh_stats_snapshot()
+    if _stats_snapshot is not None and time.monotonic() - _stats_snapshot_loaded_at < STATS_SNAPSHOT_TTL:
+        return _stats_snapshot
 
+    async with acquire_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT data, refreshed_at FROM stats_snapshot
+            WHERE id = 1 AND refreshed_at > NOW() - make_interval(secs => $1)
+            """,
+            float(STATS_SNAPSHOT_TTL),
+        )
+    if row is None:
+        return await refresh_stats_snapshot()
+
+    _stats_snapshot = (json.loads(row["data"]), row["refreshed_at"])
+    _stats_snapshot_loaded_at = time.monotonic()
+    return _stats_snapshot
+
+
+async def refresh_stats_loop(interval: int = max(STATS_SNAPSHOT_TTL // 2, 1)):
+    """
+    Фоновая задача: ведущий процесс обновляет снимок статистики раз в interval секунд,
+    чтобы админка открывалась без пересчета. Интервал меньше STATS_SNAPSHOT_TTL, чтобы
+    другие процессы не застали снимок устаревшим.
+    """
+    while True:
+        try:
+            if await is_leader():
+                await refresh_stats_snapshot()
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении снимка статистики: {e}")
+        await asyncio.sleep(interval)
+
+
+@track_db_function
 async def get_servers_from_db():
-    conn = await asyncpg.connect(DATABASE_URL)
+    """
+    Возвращает каталог серверов, сгруппированный по кластерам.
 
-    result = await conn.fetch(
-        """
-        SELECT cluster_name, server_name, api_url, subscription_url, inbound_id 
-        FROM servers
-        """
-    )
+    Каталог кэшируется в памяти процесса на SERVERS_CACHE_TTL секунд и сбрасывается
+    через invalidate_servers_cache при изменении таблицы servers.
+
+    Returns:
+        dict: Словарь {cluster_name: [информация о серверах]}
+    """
+    global _servers_cache, _servers_cache_loaded_at
+
+    if _servers_cache is not None and time.monotonic() - _servers_cache_loaded_at < SERVERS_CACHE_TTL:
+        return {cluster: list(servers) for cluster, servers in _servers_cache.items()}
 
-    await conn.close()
+    version = _servers_cache_version
+    async with acquire_connection() as conn:
+        result = await conn.fetch(
+            """
+            SELECT cluster_name, server_name, api_url, subscription_url, inbound_id 
+            FROM servers
+            """
+        )
 
     servers = {}
     for row in result:
@@ -1238,9 +1774,70 @@ async def get_servers_from_db():
             }
         )
 
-    return servers
+    if version == _servers_cache_version:
+        _servers_cache = servers
+        _servers_cache_loaded_at = time.monotonic()
+
+    return {cluster: list(cluster_servers) for cluster, cluster_servers in servers.items()}
+
+
+def invalidate_servers_cache():
+    """Сбрасывает кэш каталога серверов текущего процесса."""
+    global _servers_cache, _servers_cache_version
+    _servers_cache = None
+    _servers_cache_version += 1
+    logger.info(f"Кэш серверов сброшен, версия {_servers_cache_version}")
+
 
+async def notify_servers_changed(conn: Any = None):
+    """
+    Сбрасывает кэш серверов и оповещает остальные процессы бота через NOTIFY.
+
+    Args:
+        conn (Any, optional): Соединение, в котором была изменена таблица servers
+    """
+    invalidate_servers_cache()
+    try:
+        async with acquire_connection(conn) as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", SERVERS_CHANNEL, str(os.getpid()))
+    except Exception as e:
+        logger.error(f"Не удалось отправить уведомление об изменении серверов: {e}")
+
+
+async def listen_servers_changes(reconnect_delay: int = 5):
+    """
+    Слушает канал SERVERS_CHANNEL и сбрасывает кэш серверов при изменениях в других процессах.
+
+    Использует отдельное соединение, так как LISTEN должен жить дольше одного запроса.
+
+    Args:
+        reconnect_delay (int, optional): Пауза перед переподключением в секундах. По умолчанию 5.
+    """
 
+    def on_notify(connection, pid, channel, payload):
+        if payload != str(os.getpid()):
+            invalidate_servers_cache()
+
+    while True:
+        conn = None
+        try:
+            conn = await connect()
+            await conn.add_listener(SERVERS_CHANNEL, on_notify)
+            invalidate_servers_cache()
+            logger.info(f"Подписка на канал {SERVERS_CHANNEL} установлена")
+            while not conn.is_closed():
+                await asyncio.sleep(reconnect_delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка подписки на изменения серверов: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(reconnect_delay)
+
+
+@track_db_function
 async def delete_user_data(session: Any, tg_id: int):
 
     try:
@@ -1252,10 +1849,11 @@ async def delete_user_data(session: Any, tg_id: int):
     await session.execute("DELETE FROM payments WHERE tg_id = $1", tg_id)
     await session.execute("DELETE FROM users WHERE tg_id = $1", tg_id)
     await session.execute("DELETE FROM connections WHERE tg_id = $1", tg_id)
-    await session.execute("DELETE FROM keys WHERE tg_id = $1", tg_id)
+    keys_deleted(await session.fetch("DELETE FROM keys WHERE tg_id = $1 RETURNING server_id, email", tg_id))
     await session.execute("DELETE FROM referrals WHERE referrer_tg_id = $1", tg_id)
 
 
+@track_db_function
 async def store_gift_link(
     gift_id: str,
     sender_tg_id: int,
@@ -1281,34 +1879,28 @@ async def store_gift_link(
     Raises:
         Exception: В случае ошибки при сохранении информации о подарке
     """
-    conn = None
     try:
-        conn = session if session is not None else await asyncpg.connect(DATABASE_URL)
-
-        result = await conn.execute(
-            """
-            INSERT INTO gifts (gift_id, sender_tg_id, recipient_tg_id, selected_months, expiry_time, gift_link, created_at, is_used)
-            VALUES ($1, $2, NULL, $3, $4, $5, $6, FALSE)
-            """,
-            gift_id,
-            sender_tg_id,
-            selected_months,
-            expiry_time,
-            gift_link,
-            datetime.utcnow(),
-        )
+        async with acquire_connection(session) as conn:
+            result = await conn.execute(
+                """
+                INSERT INTO gifts (gift_id, sender_tg_id, recipient_tg_id, selected_months, expiry_time, gift_link, created_at, is_used)
+                VALUES ($1, $2, NULL, $3, $4, $5, $6, FALSE)
+                """,
+                gift_id,
+                sender_tg_id,
+                selected_months,
+                expiry_time,
+                gift_link,
+                datetime.utcnow(),
+            )
 
-        if result:
-            logger.info(f"Подарок с ID {gift_id} успешно добавлен в базу данных.")
-            return True
-        else:
-            logger.error(f"Не удалось добавить подарок с ID {gift_id} в базу данных.")
-            return False
+            if result:
+                logger.info(f"Подарок с ID {gift_id} успешно добавлен в базу данных.")
+                return True
+            else:
+                logger.error(f"Не удалось добавить подарок с ID {gift_id} в базу данных.")
+                return False
     except Exception as e:
 
         logger.error(f"Ошибка при сохранении подарка с ID {gift_id} в базе данных: {e}")
         return False
-
-    finally:
-        if conn is not None and session is None:
-            await conn.close()
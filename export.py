@@ -0,0 +1,141 @@
+import asyncio
+import csv
+import gzip
+import io
+import os
+import tempfile
+
+import asyncpg
+from aiogram.types import FSInputFile, Message
+
+from logger import logger
+
+try:
+    from config import EXPORT_GZIP
+except ImportError:
+    EXPORT_GZIP = False
+
+try:
+    from config import EXPORT_PART_SIZE
+except ImportError:
+    # Telegram принимает от ботов файлы до 50 МБ
+    EXPORT_PART_SIZE = 45 * 1024 * 1024
+
+try:
+    from config import EXPORT_BATCH_SIZE
+except ImportError:
+    EXPORT_BATCH_SIZE = 1000
+
+
+class CsvExport:
+    """
+    Результат выгрузки: CSV-файлы во временном каталоге, каждый не больше EXPORT_PART_SIZE.
+
+    Используется как асинхронный контекстный менеджер, файлы удаляются при выходе.
+    """
+
+    def __init__(self, name: str, parts: list[str], rows: int, directory: tempfile.TemporaryDirectory):
+        self.name = name
+        self.parts = parts
+        self.rows = rows
+        self._directory = directory
+
+    async def __aenter__(self) -> "CsvExport":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.to_thread(self._directory.cleanup)
+
+    async def send(self, message: Message, caption: str, **kwargs):
+        """Отправляет части выгрузки документами; kwargs (например reply_markup) — только с последней."""
+        for index, part in enumerate(self.parts, start=1):
+            part_caption = caption if len(self.parts) == 1 else f"{caption} ({index}/{len(self.parts)})"
+            await message.answer_document(
+                FSInputFile(part),
+                caption=part_caption,
+                **(kwargs if index == len(self.parts) else {}),
+            )
+
+
+def _open_part(path: str, header: list[str], compress: bool) -> tuple[io.BufferedWriter, io.TextIOWrapper, csv.writer]:
+    raw = open(path, "wb")  # noqa: SIM115
+    stream = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+    # utf-8-sig, чтобы Excel правильно показывал кириллицу
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(header)
+    return raw, text, writer
+
+
+def _close_part(raw: io.BufferedWriter, text: io.TextIOWrapper):
+    # GzipFile не закрывает переданный ему файл, поэтому он закрывается отдельно
+    text.close()
+    raw.close()
+
+
+def _write_rows(text: io.TextIOWrapper, writer: csv.writer, rows: list[asyncpg.Record]):
+    writer.writerows(rows)
+    text.flush()
+
+
+async def export_query_to_csv(
+    conn: asyncpg.Connection,
+    query: str,
+    name: str,
+    *args,
+    compress: bool = EXPORT_GZIP,
+) -> CsvExport:
+    """
+    Выгружает результат запроса в CSV, читая его серверным курсором по EXPORT_BATCH_SIZE строк.
+
+    Строки пишутся во временные файлы на диске, поэтому память не зависит от размера таблицы.
+    Когда файл превышает EXPORT_PART_SIZE, начинается следующий со своей строкой заголовков;
+    граница частей всегда проходит между строками.
+
+    Args:
+        conn (asyncpg.Connection): Соединение с базой данных
+        query (str): Запрос SELECT
+        name (str): Имя файла без расширения, например "users_export"
+        *args: Параметры запроса
+        compress (bool, optional): Сжимать файлы gzip. По умолчанию EXPORT_GZIP.
+
+    Returns:
+        CsvExport: Готовые файлы и число выгруженных строк
+    """
+    directory = tempfile.TemporaryDirectory(prefix="export-")
+    extension = ".csv.gz" if compress else ".csv"
+    parts: list[str] = []
+    rows = 0
+    raw = text = writer = None
+    try:
+        async with conn.transaction(readonly=True):
+            statement = await conn.prepare(query)
+            header = [attribute.name for attribute in statement.get_attributes()]
+            cursor = await statement.cursor(*args)
+            while batch := await cursor.fetch(EXPORT_BATCH_SIZE):
+                if text is None or raw.tell() >= EXPORT_PART_SIZE:
+                    if text is not None:
+                        await asyncio.to_thread(_close_part, raw, text)
+                    parts.append(os.path.join(directory.name, f"{name}_part{len(parts) + 1}{extension}"))
+                    raw, text, writer = await asyncio.to_thread(_open_part, parts[-1], header, compress)
+                await asyncio.to_thread(_write_rows, text, writer, batch)
+                rows += len(batch)
+
+        if text is None:
+            parts.append(os.path.join(directory.name, f"{name}_part1{extension}"))
+            raw, text, writer = await asyncio.to_thread(_open_part, parts[-1], header, compress)
+        await asyncio.to_thread(_close_part, raw, text)
+        text = None
+    except BaseException:
+        if text is not None:
+            _close_part(raw, text)
+        directory.cleanup()
+        raise
+
+    if len(parts) == 1:
+        single = os.path.join(directory.name, f"{name}{extension}")
+        os.replace(parts[0], single)
+        parts = [single]
+
+    logger.info(f"Выгрузка {name}: {rows} строк, частей: {len(parts)}")
+    return CsvExport(name, parts, rows, directory)
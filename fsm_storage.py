@@ -0,0 +1,256 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from database import acquire_connection
+from logger import logger
+from workers import WORKER_URLS, is_leader
+
+try:
+    from config import FSM_STORAGE
+except ImportError:
+    FSM_STORAGE = "postgres"
+
+try:
+    from config import FSM_WRITE_BEHIND
+except ImportError:
+    FSM_WRITE_BEHIND = 0.0
+
+try:
+    from config import FSM_STATE_TTL
+except ImportError:
+    FSM_STATE_TTL = 86400
+
+try:
+    from config import FSM_CLEANUP_INTERVAL
+except ImportError:
+    FSM_CLEANUP_INTERVAL = 3600
+
+try:
+    from config import FSM_CACHE_SIZE
+except ImportError:
+    FSM_CACHE_SIZE = 10000
+
+try:
+    from config import FSM_READ_CACHE_TTL
+except ImportError:
+    # Без шардирования по чатам обновления одного чата приходят в разные процессы,
+    # и кэш одного из них не увидит состояние, выставленное другим.
+    FSM_READ_CACHE_TTL = 60 if WORKER_URLS else 0
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_storage.
+
+    По умолчанию каждое изменение сразу пишется в базу, поэтому состояние переживает
+    перезапуск и видно всем процессам бота за одним вебхуком.
+
+    При FSM_WRITE_BEHIND > 0 записи копятся в локальном кэше и сбрасываются в базу
+    одним запросом раз в FSM_WRITE_BEHIND секунд. Этот режим годится только когда
+    обновления одного пользователя всегда попадают в один и тот же процесс.
+
+    При шардировании по чатам (WORKER_URLS) прочитанные записи, в том числе пустые, кэшируются
+    на FSM_READ_CACHE_TTL секунд, а свои изменения процесс сразу применяет к кэшу: все обновления
+    чата обрабатывает один процесс, поэтому кэш всегда актуален и чтение состояния на каждом
+    обновлении обычно не идет в базу. Без шардирования кэш чтения по умолчанию выключен.
+
+    Записи, не менявшиеся дольше FSM_STATE_TTL секунд, не читаются и удаляются фоновой очисткой.
+    """
+
+    def __init__(
+        self,
+        write_behind: float = FSM_WRITE_BEHIND,
+        ttl: int | None = FSM_STATE_TTL,
+        read_cache_ttl: float = FSM_READ_CACHE_TTL,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.write_behind = write_behind
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self.read_cache_ttl = read_cache_ttl
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        self._loaded_at: dict[str, float] = {}
+        self._dirty: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        state = state.state if isinstance(state, State) else state
+        if self.write_behind:
+            record = await self._get_record(key)
+            record["state"] = state
+            self._mark_dirty(key)
+            return
+
+        await self._execute(
+            """
+            INSERT INTO fsm_storage (key, state, updated_at)
+            VALUES ($1, $2, NOW())
+            ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()
+            """,
+            self.key_builder.build(key),
+            state,
+        )
+        self._update_cached(key, "state", state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get_record(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]):
+        if self.write_behind:
+            record = await self._get_record(key)
+            record["data"] = data.copy()
+            self._mark_dirty(key)
+            return
+
+        await self._execute(
+            """
+            INSERT INTO fsm_storage (key, data, updated_at)
+            VALUES ($1, $2, NOW())
+            ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+            """,
+            self.key_builder.build(key),
+            json.dumps(data),
+        )
+        self._update_cached(key, "data", data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get_record(key))["data"].copy()
+
+    async def close(self):
+        await self.flush()
+
+    async def _get_record(self, key: StorageKey) -> dict:
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is not None and (
+            self.write_behind or time.monotonic() - self._loaded_at[storage_key] < self.read_cache_ttl
+        ):
+            self._cache.move_to_end(storage_key)
+            return record
+
+        query = "SELECT state, data FROM fsm_storage WHERE key = $1"
+        args: list[Any] = [storage_key]
+        if self.ttl:
+            query += " AND updated_at > NOW() - make_interval(secs => $2)"
+            args.append(float(self.ttl))
+
+        async with acquire_connection() as conn:
+            row = await conn.fetchrow(query, *args)
+
+        record = {"state": row["state"], "data": json.loads(row["data"])} if row else {"state": None, "data": {}}
+        if self.write_behind or self.read_cache_ttl:
+            self._cache[storage_key] = record
+            self._cache.move_to_end(storage_key)
+            self._loaded_at[storage_key] = time.monotonic()
+            self._evict()
+        return record
+
+    def _update_cached(self, key: StorageKey, field: str, value: Any):
+        """Применяет записанное в базу значение к кэшированной записи, если она есть."""
+        record = self._cache.get(self.key_builder.build(key))
+        if record is not None:
+            record[field] = value
+
+    def _mark_dirty(self, key: StorageKey):
+        self._dirty.add(self.key_builder.build(key))
+
+    def _evict(self):
+        """Убирает из кэша самые старые записи, уже сохраненные в базе."""
+        for storage_key in list(self._cache):
+            if len(self._cache) <= FSM_CACHE_SIZE:
+                break
+            if storage_key not in self._dirty:
+                del self._cache[storage_key]
+                self._loaded_at.pop(storage_key, None)
+
+    async def _execute(self, query: str, *args):
+        async with acquire_connection() as conn:
+            await conn.execute(query, *args)
+
+    async def flush(self):
+        """Сохраняет в базу все измененные записи одним запросом на вставку и одним на удаление."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+
+            upserts, deleted = [], []
+            for key in dirty:
+                record = self._cache[key]
+                if record["state"] or record["data"]:
+                    upserts.append((key, record))
+                else:
+                    deleted.append(key)
+            try:
+                async with acquire_connection() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.execute(
+                                """
+                                INSERT INTO fsm_storage (key, state, data, updated_at)
+                                SELECT key, state, data, NOW()
+                                FROM unnest($1::text[], $2::text[], $3::jsonb[]) AS t(key, state, data)
+                                ON CONFLICT (key) DO UPDATE
+                                SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW()
+                                """,
+                                [key for key, _ in upserts],
+                                [record["state"] for _, record in upserts],
+                                [json.dumps(record["data"]) for _, record in upserts],
+                            )
+                        if deleted:
+                            await conn.execute("DELETE FROM fsm_storage WHERE key = ANY($1::text[])", deleted)
+            except Exception as e:
+                self._dirty |= dirty
+                logger.error(f"Ошибка при сохранении состояний FSM: {e}")
+                return
+
+            for key in deleted:
+                if key not in self._dirty:
+                    self._cache.pop(key, None)
+                    self._loaded_at.pop(key, None)
+            self._evict()
+
+    async def cleanup(self):
+        """Удаляет пустые и просроченные записи."""
+        query = "DELETE FROM fsm_storage WHERE (state IS NULL AND data = '{}'::jsonb)"
+        args: list[Any] = []
+        if self.ttl:
+            query += " OR updated_at < NOW() - make_interval(secs => $1)"
+            args.append(float(self.ttl))
+
+        async with acquire_connection() as conn:
+            result = await conn.execute(query, *args)
+        logger.info(f"Очистка состояний FSM: {result}")
+
+    async def run(self):
+        """Фоновая задача: периодический сброс кэша и очистка таблицы."""
+        interval = self.write_behind or FSM_CLEANUP_INTERVAL
+        elapsed = FSM_CLEANUP_INTERVAL
+        while True:
+            try:
+                await self.flush()
+                if elapsed >= FSM_CLEANUP_INTERVAL:
+                    elapsed = 0
+                    if await is_leader():
+                        await self.cleanup()
+            except Exception as e:
+                logger.error(f"Ошибка в фоновой задаче хранилища FSM: {e}")
+            await asyncio.sleep(interval)
+            elapsed += interval
+
+
+def create_storage() -> BaseStorage:
+    """Создает хранилище FSM согласно FSM_STORAGE: "postgres" или "memory"."""
+    if FSM_STORAGE == "memory":
+        from aiogram.fsm.storage.memory import MemoryStorage
+
+        return MemoryStorage()
+    return PostgresStorage()
@@ -1,25 +1,33 @@
+import html
 import subprocess
-from datetime import datetime
-from io import BytesIO
+import time
 from typing import Any
 
-import asyncpg
 from aiogram import F, Router, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import BufferedInputFile, CallbackQuery, InlineKeyboardButton
+from aiogram.types import CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from backup import backup_database
-from bot import bot
-from config import DATABASE_URL
-from database import delete_user_data
+from broadcast import (
+    cancel_broadcast,
+    create_broadcast,
+    format_progress,
+    progress_markup,
+    set_progress_message,
+)
+from database import delete_user_data, get_stats_snapshot
+from export import export_query_to_csv
 from filters.admin import IsAdminFilter
 from logger import logger
+from sender import dead_letters, get_dead_letters_summary
 
 router = Router()
 
+DEAD_LETTERS_SHOWN = 10
+
 
 class UserEditorState(StatesGroup):
     waiting_for_tg_id = State()
@@ -83,6 +91,9 @@ async def handle_bot_management(callback_query: types.CallbackQuery):
         InlineKeyboardButton(text="🔄 Перезагрузить бота", callback_data="restart_bot")
     )
     builder.row(InlineKeyboardButton(text="🚫 Баны", callback_data="ban_user"))
+    builder.row(
+        InlineKeyboardButton(text="📭 Недоставленные сообщения", callback_data="dead_letters")
+    )
     builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin"))
     await callback_query.message.answer(
         "🤖 Управление ботом",
@@ -90,71 +101,63 @@ async def handle_bot_management(callback_query: types.CallbackQuery):
     )
 
 
-@router.callback_query(F.data == "user_stats", IsAdminFilter())
-async def user_stats_menu(callback_query: CallbackQuery, session: Any):
-    try:
-        total_users = await session.fetchval("SELECT COUNT(*) FROM users")
-        total_keys = await session.fetchval("SELECT COUNT(*) FROM keys")
-        total_referrals = await session.fetchval("SELECT COUNT(*) FROM referrals")
-
-        total_payments_today = await session.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE created_at >= CURRENT_DATE"
-        )
-        total_payments_week = await session.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE created_at >= date_trunc('week', CURRENT_DATE)"
-        )
-        total_payments_month = await session.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE created_at >= date_trunc('month', CURRENT_DATE)"
-        )
-        total_payments_all_time = await session.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM payments"
-        )
+@router.callback_query(F.data == "dead_letters", IsAdminFilter())
+async def handle_dead_letters(callback_query: CallbackQuery):
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="🔄 Обновить", callback_data="dead_letters"))
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="bot_management"))
 
-        registrations_today = await session.fetchval(
-            "SELECT COUNT(*) FROM users WHERE created_at >= CURRENT_DATE"
+    if not dead_letters:
+        text = "📭 Недоставленных сообщений нет."
+    else:
+        summary = "\n".join(
+            f"• {kind} / {error_type}: {count}"
+            for (kind, error_type), count in get_dead_letters_summary().items()
         )
-        registrations_week = await session.fetchval(
-            "SELECT COUNT(*) FROM users WHERE created_at >= date_trunc('week', CURRENT_DATE)"
+        recent = "\n".join(
+            f"• {time.strftime('%d.%m %H:%M:%S', time.localtime(letter['time']))} <code>{letter['chat_id']}</code> "
+            f"{letter['kind']}: {html.escape(letter['error'][:100])}"
+            for letter in list(dead_letters)[-DEAD_LETTERS_SHOWN:][::-1]
         )
-        registrations_month = await session.fetchval(
-            "SELECT COUNT(*) FROM users WHERE created_at >= date_trunc('month', CURRENT_DATE)"
+        text = (
+            f"📭 Недоставленные сообщения этого процесса: {len(dead_letters)}\n\n"
+            f"<b>По типам:</b>\n{summary}\n\n"
+            f"<b>Последние:</b>\n{recent}"
         )
+    await callback_query.message.answer(text, reply_markup=builder.as_markup())
 
-        users_updated_today = await session.fetchval(
-            "SELECT COUNT(*) FROM users WHERE updated_at >= CURRENT_DATE"
-        )
 
-        active_keys = await session.fetchval(
-            "SELECT COUNT(*) FROM keys WHERE expiry_time > $1",
-            int(datetime.utcnow().timestamp() * 1000),
-        )
-        expired_keys = total_keys - active_keys
+@router.callback_query(F.data.in_({"user_stats", "user_stats_refresh"}), IsAdminFilter())
+async def user_stats_menu(callback_query: CallbackQuery):
+    try:
+        stats, refreshed_at = await get_stats_snapshot(force=callback_query.data == "user_stats_refresh")
 
         stats_message = (
             f"📊 <b>Подробная статистика проекта:</b>\n\n"
             f"👥 Пользователи:\n"
-            f"   📅 За день: <b>{registrations_today}</b>\n"
-            f"   📆 За неделю: <b>{registrations_week}</b>\n"
-            f"   📆 За месяц: <b>{registrations_month}</b>\n"
-            f"   🌐 За все время: <b>{total_users}</b>\n\n"
+            f"   📅 За день: <b>{stats['registrations_today']}</b>\n"
+            f"   📆 За неделю: <b>{stats['registrations_week']}</b>\n"
+            f"   📆 За месяц: <b>{stats['registrations_month']}</b>\n"
+            f"   🌐 За все время: <b>{stats['total_users']}</b>\n\n"
             f"🌟 Активные пользователи:\n"
-            f"   🌟 Активных сегодня: <b>{users_updated_today}</b>\n\n"
+            f"   🌟 Активных сегодня: <b>{stats['users_updated_today']}</b>\n\n"
             f"👥 Рефералы:\n"
-            f"   🤝 Всего привлечено: <b>{total_referrals}</b>\n\n"
+            f"   🤝 Всего привлечено: <b>{stats['total_referrals']}</b>\n\n"
             f"🔑 Ключи:\n"
-            f"   🌈 Всего сгенерировано: <b>{total_keys}</b>\n"
-            f"   ✅ Действующих: <b>{active_keys}</b>\n"
-            f"   ❌ Просроченных: <b>{expired_keys}</b>\n\n"
+            f"   🌈 Всего сгенерировано: <b>{stats['total_keys']}</b>\n"
+            f"   ✅ Действующих: <b>{stats['active_keys']}</b>\n"
+            f"   ❌ Просроченных: <b>{stats['expired_keys']}</b>\n\n"
             f"💰 Финансовая статистика:\n"
-            f"   📅 За день: <b>{total_payments_today} ₽</b>\n"
-            f"   📆 За неделю: <b>{total_payments_week} ₽</b>\n"
-            f"   📆 За месяц: <b>{total_payments_month} ₽</b>\n"
-            f"   🏦 За все время: <b>{total_payments_all_time} ₽</b>\n"
+            f"   📅 За день: <b>{stats['payments_today']} ₽</b>\n"
+            f"   📆 За неделю: <b>{stats['payments_week']} ₽</b>\n"
+            f"   📆 За месяц: <b>{stats['payments_month']} ₽</b>\n"
+            f"   🏦 За все время: <b>{stats['payments_all_time']} ₽</b>\n\n"
+            f"🕒 Данные на {refreshed_at.astimezone():%d.%m.%Y %H:%M:%S}"
         )
 
         builder = InlineKeyboardBuilder()
         builder.row(
-            InlineKeyboardButton(text="🔄 Обновить", callback_data="user_stats")
+            InlineKeyboardButton(text="🔄 Обновить", callback_data="user_stats_refresh")
         )
         builder.row(
             InlineKeyboardButton(
@@ -183,45 +186,35 @@ async def export_users_csv(callback_query: CallbackQuery, session: Any):
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="user_stats"))
     try:
-        users = await session.fetch(
+        async with await export_query_to_csv(
+            await session.connection(),
             """
-            SELECT 
-                u.tg_id, 
-                u.username, 
-                u.first_name, 
-                u.last_name, 
-                u.language_code, 
-                u.is_bot, 
-                c.balance, 
-                c.trial 
+            SELECT
+                u.tg_id,
+                u.username,
+                u.first_name,
+                u.last_name,
+                u.language_code,
+                u.is_bot,
+                c.balance,
+                c.trial
             FROM users u
             LEFT JOIN connections c ON u.tg_id = c.tg_id
-        """
-        )
+            ORDER BY u.tg_id
+            """,
+            "users_export",
+        ) as export:
+            if not export.rows:
+                await callback_query.message.answer(
+                    "📭 Нет пользователей для экспорта.", reply_markup=builder.as_markup()
+                )
+                return
 
-        if not users:
-            await callback_query.message.answer(
-                "📭 Нет пользователей для экспорта.", reply_markup=builder.as_markup()
+            await export.send(
+                callback_query.message,
+                "📥 Экспорт пользователей в CSV",
+                reply_markup=builder.as_markup(),
             )
-            return
-
-        csv_data = (
-            "tg_id,username,first_name,last_name,language_code,is_bot,balance,trial\n"
-        )
-        for user in users:
-            csv_data += f"{user['tg_id']},{user['username']},{user['first_name']},{user['last_name']},{user['language_code']},{user['is_bot']},{user['balance']},{user['trial']}\n"
-
-        file_name = BytesIO(csv_data.encode("utf-8-sig"))
-        file_name.seek(0)
-
-        file = BufferedInputFile(file_name.getvalue(), filename="users_export.csv")
-
-        await callback_query.message.answer_document(
-            file,
-            caption="📥 Экспорт пользователей в CSV",
-            reply_markup=builder.as_markup(),
-        )
-        file_name.close()
 
     except Exception as e:
         logger.error(f"Ошибка при экспорте пользователей в CSV: {e}")
@@ -236,41 +229,33 @@ async def export_payments_csv(callback_query: CallbackQuery, session: Any):
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="user_stats"))
     try:
-        payments = await session.fetch(
+        async with await export_query_to_csv(
+            await session.connection(),
             """
-            SELECT 
-                u.tg_id, 
-                u.username, 
-                u.first_name, 
-                u.last_name, 
-                p.amount, 
+            SELECT
+                u.tg_id,
+                u.username,
+                u.first_name,
+                u.last_name,
+                p.amount,
                 p.payment_system,
                 p.status,
-                p.created_at 
+                p.created_at
             FROM users u
             JOIN payments p ON u.tg_id = p.tg_id
-        """
-        )
+            ORDER BY p.created_at
+            """,
+            "payments_export",
+        ) as export:
+            if not export.rows:
+                await callback_query.message.answer(
+                    "📭 Нет платежей для экспорта.", reply_markup=builder.as_markup()
+                )
+                return
 
-        if not payments:
-            await callback_query.message.answer(
-                "📭 Нет платежей для экспорта.", reply_markup=builder.as_markup()
+            await export.send(
+                callback_query.message, "📥 Экспорт платежей в CSV", reply_markup=builder.as_markup()
             )
-            return
-
-        csv_data = "tg_id,username,first_name,last_name,amount,payment_system,status,created_at\n"  # Заголовки CSV
-        for payment in payments:
-            csv_data += f"{payment['tg_id']},{payment['username']},{payment['first_name']},{payment['last_name']},{payment['amount']},{payment['payment_system']},{payment['status']},{payment['created_at']}\n"
-
-        file_name = BytesIO(csv_data.encode("utf-8-sig"))
-        file_name.seek(0)
-
-        file = BufferedInputFile(file_name.getvalue(), filename="payments_export.csv")
-
-        await callback_query.message.answer_document(
-            file, caption="📥 Экспорт платежей в CSV", reply_markup=builder.as_markup()
-        )
-        file_name.close()
 
     except Exception as e:
         logger.error(f"Ошибка при экспорте платежей в CSV: {e}")
@@ -368,84 +353,41 @@ async def handle_send_cluster(callback_query: CallbackQuery, state: FSMContext):
 
 
 @router.message(UserEditorState.waiting_for_message, IsAdminFilter())
-async def process_message_to_all(
-    message: types.Message, state: FSMContext, session: Any
-):
-    text_message = message.text
-
+async def process_message_to_all(message: types.Message, state: FSMContext):
     try:
         state_data = await state.get_data()
-        send_to = state_data.get("send_to", "all")
-
-        if send_to == "all":
-            tg_ids = await session.fetch("SELECT DISTINCT tg_id FROM connections")
-        elif send_to == "subscribed":
-            tg_ids = await session.fetch(
-                """
-                SELECT DISTINCT c.tg_id 
-                FROM connections c
-                JOIN keys k ON c.tg_id = k.tg_id
-                WHERE k.expiry_time > $1
-            """,
-                int(datetime.utcnow().timestamp() * 1000),
-            )
-        elif send_to == "unsubscribed":
-            tg_ids = await session.fetch(
-                """
-                SELECT c.tg_id 
-                FROM connections c
-                LEFT JOIN keys k ON c.tg_id = k.tg_id
-                GROUP BY c.tg_id
-                HAVING COUNT(k.tg_id) = 0 OR MAX(k.expiry_time) <= $1
-            """,
-                int(datetime.utcnow().timestamp() * 1000),
-            )
-        elif send_to == "cluster":
-            cluster_name = state_data.get("cluster_name")
-            tg_ids = await session.fetch(
-                """
-                SELECT DISTINCT c.tg_id
-                FROM connections c
-                JOIN keys k ON c.tg_id = k.tg_id
-                JOIN servers s ON k.server_id = s.cluster_name
-                WHERE s.cluster_name = $1
-            """,
-                cluster_name,
-            )
-
-        total_users = len(tg_ids)
-        success_count = 0
-        error_count = 0
-
-        for record in tg_ids:
-            tg_id = record["tg_id"]
-            try:
-                await bot.send_message(chat_id=tg_id, text=text_message)
-                success_count += 1
-            except Exception as e:
-                error_count += 1
-                logger.error(
-                    f"❌ Ошибка при отправке сообщения пользователю {tg_id}: {e}"
-                )
-
-        await message.answer(
-            f"📤 Рассылка завершена:\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"✅ Успешно отправлено: {success_count}\n"
-            f"❌ Не доставлено: {error_count}"
+        broadcast_id, total_users = await create_broadcast(
+            message.from_user.id,
+            message.text,
+            state_data.get("send_to", "all"),
+            state_data.get("cluster_name"),
         )
+
+        broadcast = {"id": broadcast_id, "status": "pending", "total": total_users, "sent": 0, "failed": 0, "blocked": 0}
+        progress = await message.answer(format_progress(broadcast), reply_markup=progress_markup(broadcast))
+        await set_progress_message(broadcast_id, progress.chat.id, progress.message_id)
     except Exception as e:
-        logger.error(f"❗ Ошибка при подключении к базе данных: {e}")
+        logger.error(f"❗ Ошибка при создании рассылки: {e}")
+        await message.answer("❗ Не удалось запустить рассылку.")
 
     await state.clear()
 
 
+@router.callback_query(F.data.startswith("broadcast_cancel|"), IsAdminFilter())
+async def handle_broadcast_cancel(callback_query: CallbackQuery):
+    broadcast_id = int(callback_query.data.split("|")[1])
+    if await cancel_broadcast(broadcast_id):
+        await callback_query.answer(f"⏹ Рассылка #{broadcast_id} остановлена")
+    else:
+        await callback_query.answer(f"Рассылка #{broadcast_id} уже завершена")
+
+
 @router.callback_query(F.data == "backups", IsAdminFilter())
 async def handle_backup(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.message.answer(
         "💾 Инициализация резервного копирования базы данных..."
     )
-    await backup_database()
+    await backup_database(force=True)
     await callback_query.message.answer(
         "✅ Резервная копия успешно создана и отправлена администратору."
     )
@@ -543,36 +485,23 @@ async def handle_ban_user(callback_query: types.CallbackQuery):
 
 
 @router.callback_query(F.data == "export_to_csv")
-async def export_banned_users_to_csv(callback_query: types.CallbackQuery):
-    conn = await asyncpg.connect(DATABASE_URL)
+async def export_banned_users_to_csv(callback_query: types.CallbackQuery, session: Any):
     try:
-        banned_users = await conn.fetch("SELECT tg_id, blocked_at FROM blocked_users")
-
-        import csv
-        import io
-
-        csv_output = io.StringIO()
-        writer = csv.writer(csv_output)
-        writer.writerow(["tg_id", "blocked_at"])
-        for user in banned_users:
-            writer.writerow([user["tg_id"], user["blocked_at"]])
-
-        csv_output.seek(0)
-
-        document = BufferedInputFile(
-            file=csv_output.getvalue().encode("utf-8"), filename="banned_users.csv"
-        )
-
         builder = InlineKeyboardBuilder()
         builder.row(
             InlineKeyboardButton(text="⬅️ Назад", callback_data="bot_management")
         )
 
-        await callback_query.message.answer_document(
-            document=document,
-            caption="📄 Список заблокировавших бота пользователей",
-            reply_markup=builder.as_markup(),
-        )
+        async with await export_query_to_csv(
+            await session.connection(),
+            "SELECT tg_id, blocked_at FROM blocked_users",
+            "banned_users",
+        ) as export:
+            await export.send(
+                callback_query.message,
+                "📄 Список заблокировавших бота пользователей",
+                reply_markup=builder.as_markup(),
+            )
     except Exception as e:
         builder = InlineKeyboardBuilder()
         builder.row(
@@ -582,15 +511,20 @@ async def export_banned_users_to_csv(callback_query: types.CallbackQuery):
             text=f"Ошибка при выгрузке CSV: {e}",
             reply_markup=builder.as_markup(),
         )
-    finally:
-        await conn.close()
 
 
 @router.callback_query(F.data == "delete_banned_users")
-async def delete_banned_users(callback_query: types.CallbackQuery):
-    conn = await asyncpg.connect(DATABASE_URL)
+async def delete_banned_users(callback_query: types.CallbackQuery, session: Any):
     try:
-        blocked_users = await conn.fetch("SELECT tg_id FROM blocked_users")
+        # Пользователи, писавшие боту после блокировки, его уже разблокировали
+        blocked_users = await session.fetch(
+            """
+            SELECT b.tg_id
+            FROM blocked_users b
+            LEFT JOIN users u ON u.tg_id = b.tg_id
+            WHERE u.updated_at IS NULL OR u.updated_at <= b.blocked_at
+            """
+        )
         blocked_ids = [record["tg_id"] for record in blocked_users]
 
         if not blocked_ids:
@@ -600,9 +534,9 @@ async def delete_banned_users(callback_query: types.CallbackQuery):
             return
 
         for tg_id in blocked_ids:
-            await delete_user_data(conn, tg_id)
+            await delete_user_data(session, tg_id)
 
-        await conn.execute(
+        await session.execute(
             "DELETE FROM blocked_users WHERE tg_id = ANY($1)", blocked_ids
         )
 
@@ -623,5 +557,3 @@ async def delete_banned_users(callback_query: types.CallbackQuery):
             text=f"Ошибка при удалении записей: {e}",
             reply_markup=builder.as_markup(),
         )
-    finally:
-        await conn.close()
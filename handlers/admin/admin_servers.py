@@ -1,19 +1,24 @@
-import asyncio
+import math
+import time
 
-import asyncpg
 from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from py3xui import AsyncApi
 
 from backup import create_backup_and_send_to_admins
-from config import ADMIN_PASSWORD, ADMIN_USERNAME, DATABASE_URL
-from database import check_unique_server_name, get_servers_from_db
+from client import get_xui, xui_call
+from database import (
+    acquire_connection,
+    check_unique_server_name,
+    get_servers_from_db,
+    notify_servers_changed,
+)
 from filters.admin import IsAdminFilter
-from handlers.keys.key_utils import create_key_on_cluster
+from handlers.keys.reconcile import reconcile_cluster
 from logger import logger
+from servers import set_server_online_users
 
 router = Router()
 
@@ -266,19 +271,19 @@ async def handle_inbound_id_input(message: types.Message, state: FSMContext):
     api_url = user_data.get("api_url")
     subscription_url = user_data.get("subscription_url")
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute(
-        """
-        INSERT INTO servers (cluster_name, server_name, api_url, subscription_url, inbound_id) 
-        VALUES ($1, $2, $3, $4, $5)
-        """,
-        cluster_name,
-        server_name,
-        api_url,
-        subscription_url,
-        inbound_id,
-    )
-    await conn.close()
+    async with acquire_connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO servers (cluster_name, server_name, api_url, subscription_url, inbound_id) 
+            VALUES ($1, $2, $3, $4, $5)
+            """,
+            cluster_name,
+            server_name,
+            api_url,
+            subscription_url,
+            inbound_id,
+        )
+        await notify_servers_changed(conn)
 
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -351,52 +356,71 @@ async def handle_manage_cluster(callback_query: types.CallbackQuery, state: FSMC
     )
 
 
+def format_reconcile_report(cluster_name: str, reports: dict, dry_run: bool) -> str:
+    title = "🔍 Проверка синхронизации" if dry_run else "✅ Синхронизация выполнена"
+    lines = [f"{title} для кластера {cluster_name}:\n"]
+    for server_name, report in reports.items():
+        if report["error"]:
+            lines.append(f"❌ {server_name}: {report['error']}")
+            continue
+        lines.append(
+            f"🌍 {server_name}: добавить {len(report['add'])}, обновить {len(report['update'])}, "
+            f"удалить {len(report['delete'])}"
+            + (f", ошибок {len(report['failed'])}" if report["failed"] else "")
+            + (f", отложено удалений {len(report['deferred'])}" if report["deferred"] else "")
+        )
+        for action, label in (("add", "➕"), ("update", "✏️"), ("delete", "➖")):
+            emails = report[action][:5]
+            if emails:
+                more = len(report[action]) - len(emails)
+                lines.append(f"   {label} {', '.join(emails)}" + (f" и еще {more}" if more else ""))
+    return "\n".join(lines)
+
+
 @router.callback_query(F.data.startswith("sync_cluster|"), IsAdminFilter())
 async def sync_cluster_handler(callback_query: types.CallbackQuery):
-    """Обработчик для синхронизации ключей на всех серверах выбранного кластера."""
+    """Показывает, какие изменения нужны, чтобы серверы кластера совпадали с базой."""
     cluster_name = callback_query.data.split("|")[1]
 
-    conn = await asyncpg.connect(DATABASE_URL)
     try:
-        query_keys = """
-            SELECT tg_id, client_id, email, expiry_time
-            FROM keys
-            WHERE server_id = $1
-        """
-        keys_to_sync = await conn.fetch(query_keys, cluster_name)
-
-        if not keys_to_sync:
-            await callback_query.message.answer(
-                f"❌ Нет ключей для синхронизации в кластере {cluster_name}.",
-                reply_markup=InlineKeyboardBuilder()
-                .row(
-                    InlineKeyboardButton(
-                        text="🔙 Назад", callback_data="servers_editor"
-                    )
+        reports = await reconcile_cluster(cluster_name, dry_run=True)
+        # Клиенты без ключа из этого отчета удаляются сразу после подтверждения
+        report_time = math.ceil(time.time())
+
+        builder = InlineKeyboardBuilder()
+        if any(report["add"] or report["update"] or report["delete"] for report in reports.values()):
+            builder.row(
+                InlineKeyboardButton(
+                    text="✅ Применить", callback_data=f"apply_sync_cluster|{cluster_name}|{report_time}"
                 )
-                .as_markup(),
             )
-            return
-
-        servers = await get_servers_from_db()
-        cluster_servers = servers.get(cluster_name, [])
-
-        for key in keys_to_sync:
-            for server_info in cluster_servers:
-                try:
-                    await create_key_on_cluster(
-                        cluster_name,
-                        key["tg_id"],
-                        key["client_id"],
-                        key["email"],
-                        key["expiry_time"],
-                    )
-                    await asyncio.sleep(0.6)
-                except Exception as e:
-                    logger.error(f"Ошибка при добавлении ключа {key['client_id']} в кластер {cluster_name}: {e}")
+        builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="servers_editor"))
 
         await callback_query.message.answer(
-            f"✅ Ключи успешно синхронизированы для кластера {cluster_name}.",
+            format_reconcile_report(cluster_name, reports, dry_run=True),
+            reply_markup=builder.as_markup(),
+        )
+    except Exception as e:
+        logger.error(f"Ошибка проверки синхронизации кластера {cluster_name}: {e}")
+        await callback_query.message.answer(
+            f"❌ Произошла ошибка при синхронизации: {e}",
+            reply_markup=InlineKeyboardBuilder()
+            .row(InlineKeyboardButton(text="🔙 Назад", callback_data="servers_editor"))
+            .as_markup(),
+        )
+
+
+@router.callback_query(F.data.startswith("apply_sync_cluster|"), IsAdminFilter())
+async def apply_sync_cluster_handler(callback_query: types.CallbackQuery):
+    """Обработчик для синхронизации ключей на всех серверах выбранного кластера."""
+    _, cluster_name, *report_time = callback_query.data.split("|")
+    confirmed_at = int(report_time[0]) if report_time else None
+
+    try:
+        reports = await reconcile_cluster(cluster_name, dry_run=False, confirmed_at=confirmed_at)
+
+        await callback_query.message.answer(
+            format_reconcile_report(cluster_name, reports, dry_run=False),
             reply_markup=InlineKeyboardBuilder()
             .row(InlineKeyboardButton(text="🔙 Назад", callback_data="servers_editor"))
             .as_markup(),
@@ -409,8 +433,6 @@ async def sync_cluster_handler(callback_query: types.CallbackQuery):
             .row(InlineKeyboardButton(text="🔙 Назад", callback_data="servers_editor"))
             .as_markup(),
         )
-    finally:
-        await conn.close()
 
 
 @router.callback_query(F.data.startswith("server_availability|"), IsAdminFilter())
@@ -434,14 +456,11 @@ async def handle_check_server_availability(callback_query: types.CallbackQuery):
     )
 
     for server in cluster_servers:
-        xui = AsyncApi(
-            server["api_url"], username=ADMIN_USERNAME, password=ADMIN_PASSWORD
-        )
+        xui = get_xui(server["api_url"])
 
         try:
-            await xui.login()
-
-            online_users = len(await xui.client.online())
+            online_users = len(await xui_call(xui, xui.client.online))
+            set_server_online_users(server["server_name"], online_users)
             availability_message += (
                 f"🌍 {server['server_name']}: {online_users} активных пользователей.\n"
             )
@@ -534,14 +553,14 @@ async def handle_confirm_delete_server(
 ):
     server_name = callback_query.data.split("|")[1]
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute(
-        """
-        DELETE FROM servers WHERE server_name = $1
-        """,
-        server_name,
-    )
-    await conn.close()
+    async with acquire_connection() as conn:
+        await conn.execute(
+            """
+            DELETE FROM servers WHERE server_name = $1
+            """,
+            server_name,
+        )
+        await notify_servers_changed(conn)
 
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -585,12 +604,8 @@ async def handle_backup_cluster(callback_query: types.CallbackQuery):
     cluster_servers = servers.get(cluster_name, [])
 
     for server in cluster_servers:
-        xui = AsyncApi(
-            server["api_url"],
-            username=ADMIN_USERNAME,
-            password=ADMIN_PASSWORD,
-        )
-        await create_backup_and_send_to_admins(xui)
+        xui = get_xui(server["api_url"])
+        await create_backup_and_send_to_admins(xui, force=True)
 
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="servers_editor"))
@@ -1,12 +1,12 @@
 import os
 from typing import Any
 
-import asyncpg
 from aiogram import F, Router, types
-from aiogram.types import BufferedInputFile, InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from config import CONNECT_MACOS, CONNECT_WINDOWS, DATABASE_URL, SUPPORT_CHAT_URL
+from config import CONNECT_MACOS, CONNECT_WINDOWS, SUPPORT_CHAT_URL
+from database import acquire_connection
 from handlers.texts import (
     CONNECT_TV_TEXT,
     INSTRUCTION_PC,
@@ -15,6 +15,7 @@ from handlers.texts import (
     SUBSCRIPTION_DETAILS_TEXT,
 )
 from logger import logger
+from media import send_photo_cached
 
 router = Router()
 
@@ -47,12 +48,12 @@ async def send_instructions(
     else:
         send_photo = callback_query_or_message.answer_photo
 
-    with open(image_path, "rb") as image_from_buffer:
-        await send_photo(
-            BufferedInputFile(image_from_buffer.read(), filename="instructions.jpg"),
-            caption=instructions_message,
-            reply_markup=builder.as_markup(),
-        )
+    await send_photo_cached(
+        send_photo,
+        image_path,
+        caption=instructions_message,
+        reply_markup=builder.as_markup(),
+    )
 
 
 @router.callback_query(F.data.startswith("connect_pc|"))
@@ -127,8 +128,7 @@ async def process_continue_tv(callback_query: types.CallbackQuery):
 
     logger.info(f"tg_id: {tg_id}, key_name: {key_name}")
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with acquire_connection() as conn:
         record = await conn.fetchrow(
             """
             SELECT k.key
@@ -140,8 +140,6 @@ async def process_continue_tv(callback_query: types.CallbackQuery):
         )
 
         logger.info(f"Query result: {record}")
-    finally:
-        await conn.close()
 
     subscription_link = record["key"]
 
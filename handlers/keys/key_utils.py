@@ -1,10 +1,11 @@
 import asyncio
 
-from py3xui import AsyncApi
+import py3xui
 
-from client import add_client, delete_client, extend_client_key
-from config import ADMIN_PASSWORD, ADMIN_USERNAME, LIMIT_IP, SUPERNODE, TOTAL_GB
-from database import get_servers_from_db
+from client import add_client, delete_client, extend_client_key, get_xui
+from config import LIMIT_IP, SUPERNODE, TOTAL_GB
+from database import get_servers_from_db, keys_deleted
+from handlers.keys.subscriptions import invalidate_subscription_cache
 from logger import logger
 
 
@@ -63,11 +64,7 @@ async def create_client_on_server(
     Создает клиента на указанном сервере.
     """
     async with semaphore:
-        xui = AsyncApi(
-            server_info["api_url"],
-            username=ADMIN_USERNAME,
-            password=ADMIN_PASSWORD,
-        )
+        xui = get_xui(server_info["api_url"])
 
         inbound_id = server_info.get("inbound_id")
         server_name = server_info.get("server_name", "unknown")
@@ -104,6 +101,33 @@ async def create_client_on_server(
 
 
 
+def build_server_client(key, server_name: str, total_gb: int = TOTAL_GB) -> py3xui.Client:
+    """
+    Собирает клиента панели для ключа из базы с учетом режима SUPERNODE.
+
+    Args:
+        key: Запись с полями tg_id, client_id, email, expiry_time
+        server_name (str): Имя сервера, на котором будет клиент
+        total_gb (int, optional): Лимит трафика. По умолчанию TOTAL_GB.
+    """
+    if SUPERNODE:
+        unique_email = f"{key['email']}_{server_name.lower()}"
+    else:
+        unique_email = key["email"]
+
+    return py3xui.Client(
+        id=key["client_id"],
+        email=unique_email.lower(),
+        limit_ip=LIMIT_IP,
+        total_gb=total_gb,
+        expiry_time=key["expiry_time"],
+        enable=True,
+        tg_id=key["tg_id"],
+        sub_id=key["email"],
+        flow="xtls-rprx-vision",
+    )
+
+
 async def renew_key_in_cluster(cluster_id, email, client_id, new_expiry_time, total_gb):
     try:
         servers = await get_servers_from_db()
@@ -114,11 +138,7 @@ async def renew_key_in_cluster(cluster_id, email, client_id, new_expiry_time, to
 
         tasks = []
         for server_info in cluster:
-            xui = AsyncApi(
-                server_info["api_url"],
-                username=ADMIN_USERNAME,
-                password=ADMIN_PASSWORD,
-            )
+            xui = get_xui(server_info["api_url"])
 
             inbound_id = server_info.get("inbound_id")
             server_name = server_info.get("server_name", "unknown")
@@ -159,7 +179,7 @@ async def renew_key_in_cluster(cluster_id, email, client_id, new_expiry_time, to
 
 async def delete_key_from_db(client_id, session):
     try:
-        await session.execute("DELETE FROM keys WHERE client_id = $1", client_id)
+        keys_deleted(await session.fetch("DELETE FROM keys WHERE client_id = $1 RETURNING server_id, email", client_id))
     except Exception as e:
         logger.error(f"Ошибка при удалении ключа {client_id} из базы данных: {e}")
 
@@ -175,11 +195,7 @@ async def delete_key_from_cluster(cluster_id, email, client_id):
 
         tasks = []
         for server_info in cluster:
-            xui = AsyncApi(
-                server_info["api_url"],
-                username=ADMIN_USERNAME,
-                password=ADMIN_PASSWORD,
-            )
+            xui = get_xui(server_info["api_url"])
 
             inbound_id = server_info.get("inbound_id")
             if not inbound_id:
@@ -198,6 +214,7 @@ async def delete_key_from_cluster(cluster_id, email, client_id):
             )
 
         await asyncio.gather(*tasks)
+        invalidate_subscription_cache(email)
 
     except Exception as e:
         logger.error(
@@ -216,11 +233,7 @@ async def update_key_on_cluster(tg_id, client_id, email, expiry_time, cluster_id
 
         tasks = []
         for server_info in cluster:
-            xui = AsyncApi(
-                server_info["api_url"],
-                username=ADMIN_USERNAME,
-                password=ADMIN_PASSWORD,
-            )
+            xui = get_xui(server_info["api_url"])
 
             inbound_id = server_info.get("inbound_id")
             if not inbound_id:
@@ -246,6 +259,7 @@ async def update_key_on_cluster(tg_id, client_id, email, expiry_time, cluster_id
             )
 
         await asyncio.gather(*tasks)
+        invalidate_subscription_cache(email)
 
         logger.info(
             f"Ключ успешно обновлен для {client_id} на всех серверах в кластере {cluster_id}"
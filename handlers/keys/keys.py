@@ -4,17 +4,15 @@ import os
 from datetime import datetime, timedelta
 from typing import Any
 
-import asyncpg
 import pytz
 from aiogram import F, Router, types
-from aiogram.types import BufferedInputFile, InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from bot import bot
 from config import (
     CONNECT_ANDROID,
     CONNECT_IOS,
-    DATABASE_URL,
     DOWNLOAD_ANDROID,
     DOWNLOAD_IOS,
     ENABLE_DELETE_KEY_BUTTON,
@@ -26,9 +24,11 @@ from config import (
     USE_NEW_PAYMENT_FLOW,
 )
 from database import (
+    acquire_connection,
     delete_key,
     get_balance,
     get_servers_from_db,
+    keys_deleted,
     save_temporary_data,
     store_key,
     update_balance,
@@ -59,6 +59,7 @@ from handlers.texts import (
 )
 from handlers.utils import get_least_loaded_cluster, handle_error
 from logger import logger
+from media import send_photo_cached
 
 locale.setlocale(locale.LC_TIME, "ru_RU.UTF-8")
 
@@ -155,16 +156,10 @@ async def send_with_optional_image(
     """
     Отправляет сообщение с изображением, если файл существует. В противном случае отправляет только текст.
     """
-    if os.path.isfile(image_path):
-        with open(image_path, "rb") as image_file:
-            await send_photo(
-                photo=BufferedInputFile(
-                    image_file.read(), filename=os.path.basename(image_path)
-                ),
-                caption=text,
-                reply_markup=keyboard,
-            )
-    else:
+    sent = await send_photo_cached(
+        send_photo, image_path, caption=text, reply_markup=keyboard
+    )
+    if not sent:
         await send_message(
             text=text,
             reply_markup=keyboard,
@@ -273,12 +268,12 @@ async def process_callback_view_key(callback_query: types.CallbackQuery, session
                 await callback_query.message.answer("Файл изображения не найден.")
                 return
 
-            with open(image_path, "rb") as image_file:
-                await callback_query.message.answer_photo(
-                    photo=BufferedInputFile(image_file.read(), filename="pic_view.jpg"),
-                    caption=response_message,
-                    reply_markup=keyboard,
-                )
+            await send_photo_cached(
+                callback_query.message.answer_photo,
+                image_path,
+                caption=response_message,
+                reply_markup=keyboard,
+            )
         else:
             await callback_query.message.answer(
                 text="<b>Информация о подписке не найдена.</b>",
@@ -314,14 +309,16 @@ async def process_callback_update_subscription(
             public_link = f"{PUBLIC_LINK}{email}/{tg_id}"
 
             try:
-                await session.execute(
+                deleted = await session.fetch(
                     """
                     DELETE FROM keys
                     WHERE tg_id = $1 AND email = $2
+                    RETURNING server_id, email
                     """,
                     tg_id,
                     email,
                 )
+                keys_deleted(deleted)
             except Exception as delete_error:
                 await callback_query.message.answer(
                     f"Ошибка при удалении старой подписки: {delete_error}",
@@ -593,44 +590,40 @@ async def complete_key_renewal(tg_id, client_id, email, new_expiry_time, total_g
     else:
         await bot.send_message(tg_id, response_message, reply_markup=builder.as_markup())
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    key_info = await conn.fetchrow(
-        """
-        SELECT server_id 
-        FROM keys 
-        WHERE tg_id = $1 AND client_id = $2
-        """,
-        tg_id,
-        client_id,
-    )
-
-    if not key_info:
-        logger.error(f"[RENEW] Ключ с client_id {client_id} для пользователя {tg_id} не найден.")
-        await conn.close()
-        return
-
-    server_id = key_info["server_id"]
-
-    if USE_COUNTRY_SELECTION:
-        cluster_info = await conn.fetchrow(
+    async with acquire_connection() as conn:
+        key_info = await conn.fetchrow(
             """
-            SELECT cluster_name 
-            FROM servers 
-            WHERE server_name = $1
+            SELECT server_id 
+            FROM keys 
+            WHERE tg_id = $1 AND client_id = $2
             """,
-            server_id,
+            tg_id,
+            client_id,
         )
 
-        if not cluster_info:
-            logger.error(f"[RENEW] Сервер {server_id} не найден в таблице servers.")
-            await conn.close()
+        if not key_info:
+            logger.error(f"[RENEW] Ключ с client_id {client_id} для пользователя {tg_id} не найден.")
             return
 
-        cluster_id = cluster_info["cluster_name"]
-    else:
-        cluster_id = server_id
+        server_id = key_info["server_id"]
 
-    await conn.close()
+        if USE_COUNTRY_SELECTION:
+            cluster_info = await conn.fetchrow(
+                """
+                SELECT cluster_name 
+                FROM servers 
+                WHERE server_name = $1
+                """,
+                server_id,
+            )
+
+            if not cluster_info:
+                logger.error(f"[RENEW] Сервер {server_id} не найден в таблице servers.")
+                return
+
+            cluster_id = cluster_info["cluster_name"]
+        else:
+            cluster_id = server_id
 
     logger.info(f"[RENEW] Запуск продления ключа для пользователя {tg_id} на {plan} мес. в кластере {cluster_id}.")
 
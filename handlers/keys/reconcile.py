@@ -0,0 +1,247 @@
+import asyncio
+import time
+
+from config import TOTAL_GB
+
+from client import add_clients_bulk, get_xui, xui_call
+from database import acquire_connection, get_servers_from_db
+from handlers.keys.key_utils import build_server_client
+from logger import logger
+
+try:
+    from config import XUI_RECONCILE_CONCURRENCY
+except ImportError:
+    XUI_RECONCILE_CONCURRENCY = 5
+
+try:
+    from config import RECONCILE_GRACE_PERIOD
+except ImportError:
+    RECONCILE_GRACE_PERIOD = 120
+
+# (сервер, email клиента) -> когда (time.time()) клиент впервые найден на панели без ключа в базе
+_orphans_first_seen: dict[tuple[str, str], float] = {}
+
+
+def needs_update(panel_client, expected_client) -> bool:
+    """
+    Проверяет, отличается ли клиент на панели от ожидаемого по данным базы.
+
+    Лимит трафика зависит от тарифа и в базе не хранится, поэтому исправляется
+    только лимит ниже TOTAL_GB. Безлимит (0) на панели считается корректным.
+    """
+    if str(panel_client.id) != str(expected_client.id):
+        return True
+    if panel_client.expiry_time != expected_client.expiry_time:
+        return True
+    if TOTAL_GB == 0:
+        return panel_client.total_gb != 0
+    return 0 < panel_client.total_gb < TOTAL_GB
+
+
+def diff_server(keys: list, panel_clients: dict, server_name: str) -> dict:
+    """
+    Сравнивает ключи из базы с клиентами инбаунда сервера.
+
+    Args:
+        keys (list): Ключи, которые должны быть на сервере
+        panel_clients (dict): Клиенты инбаунда по email в нижнем регистре
+        server_name (str): Имя сервера
+
+    Returns:
+        dict: Списки клиентов для добавления (add), обновления (update)
+            в виде пар (клиент панели, ожидаемый клиент) и удаления (delete)
+    """
+    expected = {}
+    for key in keys:
+        client = build_server_client(key, server_name)
+        expected[client.email] = client
+
+    plan = {"add": [], "update": [], "delete": []}
+    for email, client in expected.items():
+        panel_client = panel_clients.get(email)
+        if panel_client is None:
+            plan["add"].append(client)
+        elif needs_update(panel_client, client):
+            if TOTAL_GB:
+                client.total_gb = max(TOTAL_GB, panel_client.total_gb) if panel_client.total_gb else 0
+            plan["update"].append((panel_client, client))
+
+    plan["delete"] = [client for email, client in panel_clients.items() if email not in expected]
+    return plan
+
+
+async def reconcile_server(server_info: dict, keys: list, dry_run: bool, confirmed_at: float | None = None) -> dict:
+    """
+    Приводит инбаунд сервера в соответствие с таблицей keys.
+
+    Список клиентов запрашивается у панели один раз, затем выполняются только
+    необходимые добавления, обновления и удаления. confirmed_at — время отчета,
+    который подтвердил администратор (см. split_orphans).
+    """
+    server_name = server_info.get("server_name", "unknown")
+    inbound_id = server_info.get("inbound_id")
+    report = {"add": [], "update": [], "delete": [], "deferred": [], "failed": [], "error": None}
+
+    if not inbound_id:
+        report["error"] = "INBOUND_ID отсутствует"
+        return report
+    inbound_id = int(inbound_id)
+
+    try:
+        xui = get_xui(server_info["api_url"])
+        inbound = await xui_call(xui, xui.inbound.get_by_id, inbound_id)
+    except Exception as e:
+        logger.error(f"Не удалось получить клиентов сервера {server_name}: {e}")
+        report["error"] = str(e)
+        return report
+
+    panel_clients = {client.email.lower(): client for client in inbound.settings.clients}
+    plan = diff_server(keys, panel_clients, server_name)
+    plan["delete"], deferred = split_orphans(server_name, plan["delete"], None if dry_run else confirmed_at)
+    if dry_run:
+        # В отчете показываются все клиенты без ключа: подтверждение отчета разрешает их удалить
+        plan["delete"], deferred = plan["delete"] + deferred, []
+    report["add"] = [client.email for client in plan["add"]]
+    report["update"] = [client.email for _, client in plan["update"]]
+    report["delete"] = [client.email for client in plan["delete"]]
+    report["deferred"] = [client.email for client in deferred]
+
+    if dry_run:
+        return report
+
+    if plan["add"]:
+        results = await add_clients_bulk(
+            xui, inbound_id, plan["add"], existing_emails=set(panel_clients)
+        )
+        report["failed"] += [email for email, result in results.items() if result["status"] == "failed"]
+
+    semaphore = asyncio.Semaphore(XUI_RECONCILE_CONCURRENCY)
+
+    async def update_client(panel_client, client):
+        client.inbound_id = inbound_id
+        async with semaphore:
+            try:
+                await xui_call(xui, xui.client.update, panel_client.id, client)
+            except Exception as e:
+                logger.error(f"Не удалось обновить клиента {client.email} на сервере {server_name}: {e}")
+                report["failed"].append(client.email)
+
+    async def remove_client(panel_client):
+        async with semaphore:
+            try:
+                await xui_call(xui, xui.client.delete, inbound_id, panel_client.id)
+            except Exception as e:
+                logger.error(f"Не удалось удалить клиента {panel_client.email} на сервере {server_name}: {e}")
+                report["failed"].append(panel_client.email)
+
+    # Ключ мог появиться в базе уже после ее чтения: при покупке клиент сначала
+    # создается на панели и только потом сохраняется в keys.
+    stored = await find_stored_clients(plan["delete"])
+    removable = []
+    for panel_client in plan["delete"]:
+        if str(panel_client.id) in stored or (panel_client.sub_id or panel_client.email).lower() in stored:
+            report["delete"].remove(panel_client.email)
+        else:
+            removable.append(panel_client)
+
+    await asyncio.gather(
+        *(update_client(panel_client, client) for panel_client, client in plan["update"]),
+        *(remove_client(panel_client) for panel_client in removable),
+    )
+    return report
+
+
+def split_orphans(server_name: str, orphans: list, confirmed_at: float | None = None) -> tuple[list, list]:
+    """
+    Делит клиентов панели без ключа в базе на удаляемых и отложенных.
+
+    Клиент удаляется, если он был без ключа уже в отчете, который подтвердил администратор
+    (найден не позже confirmed_at), либо RECONCILE_GRACE_PERIOD секунд назад. Клиент,
+    появившийся после отчета, может оказаться только что созданным при покупке и еще
+    не попавшим в keys, поэтому его удаление откладывается. У клиентов панели нет времени
+    создания, поэтому отсчет идет от первой сверки этого процесса, которая его обнаружила.
+
+    Returns:
+        tuple[list, list]: Клиенты для удаления и отложенные до следующей сверки
+    """
+    now = time.time()
+    emails = {client.email.lower() for client in orphans}
+    for seen in [seen for seen in _orphans_first_seen if seen[0] == server_name and seen[1] not in emails]:
+        del _orphans_first_seen[seen]
+
+    removable, deferred = [], []
+    for client in orphans:
+        first_seen = _orphans_first_seen.setdefault((server_name, client.email.lower()), now)
+        confirmed = confirmed_at is not None and first_seen <= confirmed_at
+        (removable if confirmed or now - first_seen >= RECONCILE_GRACE_PERIOD else deferred).append(client)
+    return removable, deferred
+
+
+async def find_stored_clients(panel_clients: list) -> set[str]:
+    """Возвращает client_id и email (в нижнем регистре) клиентов, которые уже есть в таблице keys."""
+    if not panel_clients:
+        return set()
+    async with acquire_connection() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT client_id, lower(email) AS email FROM keys
+            WHERE client_id = ANY($1::text[]) OR lower(email) = ANY($2::text[])
+            """,
+            [str(client.id) for client in panel_clients],
+            [(client.sub_id or client.email).lower() for client in panel_clients],
+        )
+    return {row["client_id"] for row in rows} | {row["email"] for row in rows}
+
+
+async def reconcile_cluster(
+    cluster_name: str, dry_run: bool = True, confirmed_at: float | None = None
+) -> dict[str, dict]:
+    """
+    Сверяет ключи кластера из базы с клиентами на всех его серверах.
+
+    Ключ, привязанный к кластеру, ожидается на каждом сервере кластера,
+    а ключ, привязанный к конкретному серверу (выбор страны), только на нем.
+
+    Args:
+        cluster_name (str): Имя кластера
+        dry_run (bool, optional): Только посчитать изменения, ничего не меняя. По умолчанию True.
+        confirmed_at (float, optional): Время (time.time()) отчета пробной сверки, который
+            подтвердил администратор. Клиенты без ключа из этого отчета удаляются сразу.
+
+    Returns:
+        dict: Отчет по имени сервера со списками email в add, update, delete, deferred
+            (удаления, отложенные до следующей сверки) и failed
+    """
+    servers = await get_servers_from_db()
+    cluster_servers = servers.get(cluster_name)
+
+    if not cluster_servers:
+        raise ValueError(f"Кластер с ID {cluster_name} не найден.")
+
+    server_names = [server["server_name"] for server in cluster_servers]
+    async with acquire_connection() as conn:
+        keys = await conn.fetch(
+            """
+            SELECT tg_id, client_id, email, expiry_time, server_id
+            FROM keys
+            WHERE server_id = $1 OR server_id = ANY($2::text[])
+            """,
+            cluster_name,
+            server_names,
+        )
+
+    async def reconcile(server_info: dict):
+        server_keys = [
+            key for key in keys if key["server_id"] in (cluster_name, server_info["server_name"])
+        ]
+        return server_info["server_name"], await reconcile_server(server_info, server_keys, dry_run, confirmed_at)
+
+    reports = dict(await asyncio.gather(*(reconcile(server_info) for server_info in cluster_servers)))
+
+    for server_name, report in reports.items():
+        logger.info(
+            f"Сверка {'(пробная) ' if dry_run else ''}сервера {server_name} кластера {cluster_name}: "
+            f"добавить {len(report['add'])}, обновить {len(report['update'])}, "
+            f"удалить {len(report['delete'])}, отложить {len(report['deferred'])}, ошибок {len(report['failed'])}"
+        )
+    return reports
@@ -1,41 +1,116 @@
 import asyncio
 import base64
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
 
 import aiohttp
-import asyncpg
 from aiohttp import web
 
-from config import DATABASE_URL, PROJECT_NAME, SUB_MESSAGE, SUPERNODE, TRANSITION_DATE_STR
-from database import get_servers_from_db
+from config import PROJECT_NAME, SUB_MESSAGE, SUPERNODE, TRANSITION_DATE_STR
+from database import acquire_connection, add_key_delete_listener, get_servers_from_db
 from logger import logger
 
-# Глобальная переменная для пула соединений
-db_pool = None
+try:
+    from config import SUBSCRIPTION_CACHE_TTL
+except ImportError:
+    SUBSCRIPTION_CACHE_TTL = 60
 
-async def init_db_pool():
+try:
+    from config import SUBSCRIPTION_FETCH_TIMEOUT
+except ImportError:
+    SUBSCRIPTION_FETCH_TIMEOUT = 5
+
+try:
+    from config import SUBSCRIPTION_CONNECTION_LIMIT
+except ImportError:
+    SUBSCRIPTION_CONNECTION_LIMIT = 100
+
+try:
+    from config import SUBSCRIPTION_CACHE_SIZE
+except ImportError:
+    SUBSCRIPTION_CACHE_SIZE = 10000
+
+_http_session: aiohttp.ClientSession | None = None
+
+subscription_cache: OrderedDict[tuple[str, str], dict] = OrderedDict()
+_inflight: dict[tuple[str, str], asyncio.Task] = {}
+
+
+def get_http_session() -> aiohttp.ClientSession:
     """
-    Инициализация пула соединений, если он ещё не создан.
+    Возвращает общую HTTP-сессию для запросов к серверам подписок.
+
+    Сессия держит keep-alive соединения с панелями, поэтому каждое обновление
+    подписки не открывает новые TCP и TLS соединения.
     """
-    global db_pool
-    if not db_pool:
-        db_pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=5, max_size=20)
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=SUBSCRIPTION_FETCH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=SUBSCRIPTION_CONNECTION_LIMIT, ttl_dns_cache=300, ssl=False),
+        )
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def invalidate_subscription_cache(email: str | None = None):
+    """Сбрасывает кэш подписок для email или полностью."""
+    if email is None:
+        subscription_cache.clear()
+        return
+    for cache_key in [cache_key for cache_key in subscription_cache if cache_key[0] == email]:
+        del subscription_cache[cache_key]
+
+
+add_key_delete_listener(invalidate_subscription_cache)
+
+
+def normalize_query(query_string: str) -> str:
+    """Приводит query string к одному виду, чтобы порядок параметров не плодил записи кэша."""
+    return urlencode(sorted(parse_qsl(query_string, keep_blank_values=True)))
+
+
+def get_cached_subscription(cache_key: tuple[str, str]) -> dict | None:
+    """Возвращает неистекшую запись кэша подписок; истекшая запись удаляется."""
+    entry = subscription_cache.get(cache_key)
+    if entry is None:
+        return None
+    if entry["expires_at"] <= time.monotonic():
+        del subscription_cache[cache_key]
+        return None
+    subscription_cache.move_to_end(cache_key)
+    return entry
+
+
+def _store_subscription(cache_key: tuple[str, str], entry: dict):
+    subscription_cache[cache_key] = entry
+    subscription_cache.move_to_end(cache_key)
+    while len(subscription_cache) > SUBSCRIPTION_CACHE_SIZE:
+        subscription_cache.popitem(last=False)
+
 
 async def fetch_url_content(url, tg_id):
     try:
         logger.info(f"Получение URL: {url} для tg_id: {tg_id}")
-        timeout = aiohttp.ClientTimeout(total=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, ssl=False) as response:
-                if response.status == 200:
-                    content = await response.text()
-                    logger.info(f"Успешно получен контент с {url} для tg_id: {tg_id}")
-                    return base64.b64decode(content).decode("utf-8").split("\n")
-                else:
-                    logger.error(
-                        f"Не удалось получить {url} для tg_id: {tg_id}, статус: {response.status}"
-                    )
-                    return []
+        async with get_http_session().get(url) as response:
+            if response.status == 200:
+                content = await response.text()
+                logger.info(f"Успешно получен контент с {url} для tg_id: {tg_id}")
+                return base64.b64decode(content).decode("utf-8").split("\n")
+            else:
+                logger.error(
+                    f"Не удалось получить {url} для tg_id: {tg_id}, статус: {response.status}"
+                )
+                return []
     except asyncio.TimeoutError:
         logger.error(f"Таймаут при получении {url} для tg_id: {tg_id}")
         return []
@@ -71,6 +146,71 @@ async def combine_unique_lines(urls, tg_id, query_string):
 
     return list(all_lines)
 
+
+async def build_subscription(email: str, tg_id, cluster_name: str, query_string: str) -> dict:
+    """
+    Собирает подписку с серверов кластера и кэширует ее по (email, query).
+
+    В кэше не больше SUBSCRIPTION_CACHE_SIZE записей, давно не запрашиваемые вытесняются.
+
+    Одновременные запросы одной и той же подписки ждут один общий запрос к серверам.
+
+    Returns:
+        dict: Запись кэша с полями body, etag, tg_id, expires_at
+    """
+    cache_key = (email, query_string)
+    if entry := get_cached_subscription(cache_key):
+        return entry
+
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_build_subscription(cache_key, tg_id, cluster_name, query_string))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+
+async def _build_subscription(cache_key: tuple[str, str], tg_id, cluster_name: str, query_string: str) -> dict:
+    email = cache_key[0]
+    servers = await get_servers_from_db()
+    cluster_servers = servers.get(cluster_name, [])
+
+    urls = [
+        f"{server['subscription_url']}/{email}" for server in cluster_servers
+    ]
+
+    combined_subscriptions = await combine_unique_lines(urls, tg_id, query_string)
+
+    body = base64.b64encode(
+        "\n".join(sorted(combined_subscriptions)).encode("utf-8")
+    ).decode("utf-8")
+
+    entry = {
+        "body": body,
+        "etag": f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"',
+        "tg_id": tg_id,
+        "expires_at": time.monotonic() + SUBSCRIPTION_CACHE_TTL,
+    }
+    if combined_subscriptions:
+        _store_subscription(cache_key, entry)
+    return entry
+
+
+def subscription_headers(etag: str | None = None) -> dict:
+    encoded_project_name = f"{PROJECT_NAME} - {SUB_MESSAGE}"
+    headers = {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Content-Disposition": "inline",
+        "profile-update-interval": "7",
+        "profile-title": "base64:"
+        + base64.b64encode(encoded_project_name.encode("utf-8")).decode("utf-8"),
+    }
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = f"private, max-age={SUBSCRIPTION_CACHE_TTL}"
+    return headers
+
+
 transition_date = datetime.strptime(TRANSITION_DATE_STR, "%Y-%m-%d %H:%M:%S")
 transition_timestamp_ms = int(transition_date.timestamp() * 1000)
 transition_timestamp_ms_adjusted = transition_timestamp_ms - (3 * 60 * 60 * 1000)
@@ -91,10 +231,7 @@ async def handle_old_subscription(request):
 
     logger.info(f"Обработка запроса для старого клиента с email: {email}")
 
-    # Инициализируем пул соединений
-    await init_db_pool()
-
-    async with db_pool.acquire() as conn:
+    async with acquire_connection() as conn:
         key_info = await conn.fetchrow(
             "SELECT created_at, server_id FROM keys WHERE email = $1", email
         )
@@ -145,17 +282,8 @@ async def handle_old_subscription(request):
         "\n".join(combined_subscriptions).encode("utf-8")
     ).decode("utf-8")
 
-    encoded_project_name = f"{PROJECT_NAME} - {SUB_MESSAGE}"
-    headers = {
-        "Content-Type": "text/plain; charset=utf-8",
-        "Content-Disposition": "inline",
-        "profile-update-interval": "7",
-        "profile-title": "base64:"
-        + base64.b64encode(encoded_project_name.encode("utf-8")).decode("utf-8"),
-    }
-
     logger.info(f"Возвращаем объединенные подписки для email: {email}")
-    return web.Response(text=base64_encoded, headers=headers)
+    return web.Response(text=base64_encoded, headers=subscription_headers())
 
 
 async def handle_new_subscription(request):
@@ -171,13 +299,14 @@ async def handle_new_subscription(request):
 
     logger.info(f"Обработка запроса для нового клиента: email={email}, tg_id={tg_id}")
 
-    # Инициализируем пул соединений
-    await init_db_pool()
+    query_string = normalize_query(request.query_string)
+    entry = get_cached_subscription((email, query_string))
 
-    async with db_pool.acquire() as conn:
-        client_data = await conn.fetchrow(
-            "SELECT tg_id, server_id FROM keys WHERE email = $1", email
-        )
+    if not entry:
+        async with acquire_connection() as conn:
+            client_data = await conn.fetchrow(
+                "SELECT tg_id, server_id FROM keys WHERE email = $1", email
+            )
 
         if not client_data:
             logger.warning(f"Клиент с email {email} не найден в базе.")
@@ -196,31 +325,20 @@ async def handle_new_subscription(request):
                 status=403,
             )
 
-    servers = await get_servers_from_db()
-    cluster_servers = servers.get(cluster_name, [])
-
-    urls = [
-        f"{server['subscription_url']}/{email}" for server in cluster_servers
-    ]
-
-    query_string = request.query_string
-    logger.info(f"Извлечен query string: {query_string}")
-
-    combined_subscriptions = await combine_unique_lines(urls, tg_id, query_string)
-
-    base64_encoded = base64.b64encode(
-        "\n".join(combined_subscriptions).encode("utf-8")
-    ).decode("utf-8")
+        logger.info(f"Извлечен query string: {query_string}")
+        entry = await build_subscription(email, stored_tg_id, cluster_name, query_string)
+    elif str(tg_id) != str(entry["tg_id"]):
+        logger.warning(f"Неверный tg_id для клиента с email {email}.")
+        return web.Response(
+            text="❌ Неверные данные. Получите свой ключ в боте.",
+            status=403,
+        )
 
-    encoded_project_name = f"{PROJECT_NAME} - {SUB_MESSAGE}"
+    headers = subscription_headers(entry["etag"])
 
-    headers = {
-        "Content-Type": "text/plain; charset=utf-8",
-        "Content-Disposition": "inline",
-        "profile-update-interval": "7",
-        "profile-title": "base64:"
-        + base64.b64encode(encoded_project_name.encode("utf-8")).decode("utf-8"),
-    }
+    if entry["etag"] in request.headers.get("If-None-Match", ""):
+        logger.info(f"Подписка для email {email} не изменилась, возвращаем 304")
+        return web.Response(status=304, headers={"ETag": entry["etag"], "Cache-Control": headers["Cache-Control"]})
 
     logger.info(f"Возвращаем объединенные подписки для email: {email}")
-    return web.Response(text=base64_encoded, headers=headers)
+    return web.Response(text=entry["body"], headers=headers)
@@ -4,10 +4,9 @@ from datetime import datetime, timedelta
 from typing import Any
 
 import pytz
-from py3xui import AsyncApi
 
-from client import add_client
-from config import ADMIN_PASSWORD, ADMIN_USERNAME, LIMIT_IP, PUBLIC_LINK, SUPERNODE, TOTAL_GB, TRIAL_TIME
+from client import add_client, get_xui
+from config import LIMIT_IP, PUBLIC_LINK, SUPERNODE, TOTAL_GB, TRIAL_TIME
 from database import get_servers_from_db, store_key, use_trial
 from handlers.texts import INSTRUCTIONS
 from handlers.utils import generate_random_email, get_least_loaded_cluster
@@ -53,11 +52,7 @@ async def create_trial_key(tg_id: int, session: Any):
 
         tasks.append(
             add_client(
-                AsyncApi(
-                    server_info["api_url"],
-                    username=ADMIN_USERNAME,
-                    password=ADMIN_PASSWORD,
-                ),
+                get_xui(server_info["api_url"]),
                 client_id,
                 email,
                 tg_id,
@@ -1,21 +1,19 @@
 import asyncio
+import functools
 import os
+import time
 from datetime import datetime, timedelta
 
 import asyncpg
 import pytz
 from aiogram import Bot, Router, types
-from aiogram.exceptions import TelegramForbiddenError
-from aiogram.types import BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from py3xui import AsyncApi
 
+from client import get_xui, xui_call
 from config import (
-    ADMIN_PASSWORD,
-    ADMIN_USERNAME,
     AUTO_DELETE_EXPIRED_KEYS,
     AUTO_RENEW_KEYS,
-    DATABASE_URL,
     DEV_MODE,
     EXPIRED_KEYS_CHECK_INTERVAL,
     RENEWAL_PLANS,
@@ -23,11 +21,12 @@ from config import (
     TRIAL_TIME,
 )
 from database import (
+    acquire_connection,
     add_blocked_user,
+    add_blocked_users,
     add_notification,
     check_notification_time,
     delete_key,
-    get_balance,
     get_servers_from_db,
     update_balance,
     update_key_expiry,
@@ -35,77 +34,185 @@ from database import (
 from handlers.keys.key_utils import delete_key_from_cluster, renew_key_in_cluster
 from handlers.texts import KEY_EXPIRY_10H, KEY_EXPIRY_24H, KEY_RENEWED
 from logger import logger
+from media import send_photo_cached
+from metrics import loop_duration
+from sender import dispatch, send_limited
+from servers import set_server_online_users
+from workers import is_leader
+
+try:
+    from config import BLOCKED_PROBE_INACTIVE
+except ImportError:
+    BLOCKED_PROBE_INACTIVE = 7 * 86400
+
+try:
+    from config import BLOCKED_PROBE_INTERVAL
+except ImportError:
+    BLOCKED_PROBE_INTERVAL = 7 * 86400
+
+try:
+    from config import BLOCKED_PROBE_BATCH
+except ImportError:
+    BLOCKED_PROBE_BATCH = 500
 
 router = Router()
 
-async def check_users_and_update_blocked(bot: Bot):
-    conn = None
+async def send_notification(bot: Bot, tg_id: int, text: str, keyboard=None, image_name: str | None = None):
+    """
+    Отправляет уведомление с картинкой из img, если она есть, иначе текстом.
+
+    Отправка идет через общий ограничитель частоты sender.send_limited,
+    картинка загружается в Telegram один раз и дальше отправляется по file_id.
+    """
+    if image_name:
+        sent = await send_limited(
+            tg_id,
+            lambda: send_photo_cached(
+                functools.partial(bot.send_photo, tg_id),
+                os.path.join("img", image_name),
+                caption=text,
+                reply_markup=keyboard,
+            ),
+        )
+        if sent:
+            return
+    await send_limited(tg_id, lambda: bot.send_message(tg_id, text, reply_markup=keyboard))
+
+
+async def probe_user(bot: Bot, results: dict[int, str], tg_id: int):
+    """
+    Проверяет, доступен ли пользователь, и записывает в results "ok", "blocked" или "failed".
+
+    "failed" — временная ошибка (сеть, лимиты после всех повторов), пользователя проверят позже.
+    """
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        users = await conn.fetch("SELECT tg_id FROM users")
+        await send_limited(tg_id, lambda: bot.send_chat_action(tg_id, "typing"), kind="probe")
+        results[tg_id] = "ok"
+    except TelegramForbiddenError:
+        results[tg_id] = "blocked"
+    except TelegramBadRequest as e:
+        if "chat not found" in str(e).lower():
+            results[tg_id] = "blocked"
+        else:
+            logger.debug(f"Не удалось проверить пользователя {tg_id}: {e}")
+            results[tg_id] = "ok"
+    except Exception as e:
+        logger.debug(f"Не удалось проверить пользователя {tg_id}, повтор при следующем запуске: {e}")
+        results[tg_id] = "failed"
 
-        for user in users:
-            try:
-                await bot.send_chat_action(user['tg_id'], "typing")
-            except (TelegramForbiddenError,Exception):
-                await conn.execute(
-                    "INSERT INTO blocked_users (tg_id) VALUES ($1) ON CONFLICT (tg_id) DO NOTHING",
-                    user['tg_id']
+
+async def check_users_and_update_blocked(bot: Bot):
+    """
+    Проверяет, не заблокировали ли бота пользователи, которых давно не было видно.
+
+    Проверяются только пользователи без активности BLOCKED_PROBE_INACTIVE секунд, которых
+    не проверяли BLOCKED_PROBE_INTERVAL секунд и которых еще нет в blocked_users: о блокировке
+    активных пользователей бот узнает из ошибок отправки (middlewares.blocked). Пробы идут пачками
+    по BLOCKED_PROBE_BATCH параллельно через sender.send_limited, результаты пишутся пачкой.
+
+    Постоянные ошибки запроса (например PEER_ID_INVALID) тоже считаются проверкой, а пользователи
+    с временными ошибками исключаются из следующих пачек этого запуска и проверяются в следующий раз.
+    """
+    if not await is_leader():
+        return
+    started_at = time.perf_counter()
+    probed_total = blocked_total = 0
+    failed: list[int] = []
+    try:
+        while True:
+            async with acquire_connection() as conn:
+                users = await conn.fetch(
+                    """
+                    SELECT u.tg_id
+                    FROM users u
+                    WHERE u.updated_at < NOW() - make_interval(secs => $1)
+                      AND (u.checked_at IS NULL OR u.checked_at < NOW() - make_interval(secs => $2))
+                      AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.tg_id = u.tg_id)
+                      AND u.tg_id <> ALL($4::bigint[])
+                    ORDER BY u.checked_at NULLS FIRST, u.tg_id
+                    LIMIT $3
+                    """,
+                    float(BLOCKED_PROBE_INACTIVE),
+                    float(BLOCKED_PROBE_INTERVAL),
+                    BLOCKED_PROBE_BATCH,
+                    failed,
                 )
-                logger.info(f"User {user['tg_id']} added to blocked_users")
+            if not users:
+                break
+
+            results: dict[int, str] = {}
+            await dispatch([user["tg_id"] for user in users], functools.partial(probe_user, bot, results))
+
+            checked = [tg_id for tg_id, status in results.items() if status != "failed"]
+            blocked = [tg_id for tg_id, status in results.items() if status == "blocked"]
+            failed += [user["tg_id"] for user in users if results.get(user["tg_id"], "failed") == "failed"]
+
+            async with acquire_connection() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        "UPDATE users SET checked_at = CURRENT_TIMESTAMP WHERE tg_id = ANY($1::bigint[])",
+                        checked,
+                    )
+                    await add_blocked_users(blocked, conn)
+
+            probed_total += len(checked)
+            blocked_total += len(blocked)
+
+        logger.info(
+            f"Проверено неактивных пользователей: {probed_total}, заблокировали бота: {blocked_total}, "
+            f"отложено из-за ошибок: {len(failed)}"
+        )
     except Exception as e:
         logger.error(f"Error in check_users_and_update_blocked: {e}")
-    finally:
-        if conn:
-            await conn.close()
+    loop_duration.observe(time.perf_counter() - started_at, "check_users_and_update_blocked")
 
 
 async def periodic_expired_keys_check(bot: Bot):
     """Периодическая проверка истекших ключей с кастомным интервалом."""
     while True:
-        conn = None
         try:
-            conn = await asyncpg.connect(DATABASE_URL)
-            current_time = int(datetime.utcnow().timestamp() * 1000)
-            await handle_expired_keys(bot, conn, current_time)
-            logger.info("✅ Проверка истекших ключей выполнена.")
+            if not await is_leader():
+                await asyncio.sleep(EXPIRED_KEYS_CHECK_INTERVAL)
+                continue
+            started_at = time.perf_counter()
+            async with acquire_connection() as conn:
+                current_time = int(datetime.utcnow().timestamp() * 1000)
+                await handle_expired_keys(bot, conn, current_time)
+                logger.info("✅ Проверка истекших ключей выполнена.")
+            loop_duration.observe(time.perf_counter() - started_at, "expired_keys_check")
         except Exception as e:
             logger.error(f"❌ Ошибка в periodic_expired_keys_check: {e}")
-        finally:
-            if conn:
-                await conn.close()
 
         await asyncio.sleep(EXPIRED_KEYS_CHECK_INTERVAL)
 
 
 
 async def notify_expiring_keys(bot: Bot):
-    conn = None
+    if not await is_leader():
+        return
+    started_at = time.perf_counter()
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info("Подключение к базе данных успешно.")
+        async with acquire_connection() as conn:
+            logger.info("Подключение к базе данных успешно.")
 
-        current_time = int(datetime.utcnow().timestamp() * 1000)
-        threshold_time_10h = int((datetime.utcnow() + timedelta(hours=10)).timestamp() * 1000)
-        threshold_time_24h = int((datetime.utcnow() + timedelta(days=1)).timestamp() * 1000)
+            current_time = int(datetime.utcnow().timestamp() * 1000)
+            threshold_time_10h = int((datetime.utcnow() + timedelta(hours=10)).timestamp() * 1000)
+            threshold_time_24h = int((datetime.utcnow() + timedelta(days=1)).timestamp() * 1000)
 
-        logger.info("Начало обработки уведомлений.")
+            logger.info("Начало обработки уведомлений.")
 
-        await notify_inactive_trial_users(bot, conn)
-        await asyncio.sleep(0.5)
-        await check_online_users()
-        await asyncio.sleep(0.5)
-        await notify_10h_keys(bot, conn, current_time, threshold_time_10h)
-        await asyncio.sleep(0.5)
-        await notify_24h_keys(bot, conn, current_time, threshold_time_24h)
-        await asyncio.sleep(0.5)
+            await notify_inactive_trial_users(bot, conn)
+            await asyncio.sleep(0.5)
+            await check_online_users()
+            await asyncio.sleep(0.5)
+            await notify_10h_keys(bot, conn, current_time, threshold_time_10h)
+            await asyncio.sleep(0.5)
+            await notify_24h_keys(bot, conn, current_time, threshold_time_24h)
+            await asyncio.sleep(0.5)
 
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомлений: {e}")
-    finally:
-        if conn:
-            await conn.close()
-            logger.info("Соединение с базой данных закрыто.")
+    loop_duration.observe(time.perf_counter() - started_at, "notify_expiring_keys")
 
 
 
@@ -126,34 +233,38 @@ async def is_bot_blocked(bot: Bot, chat_id: int) -> bool:
         return False
 
 
-async def notify_10h_keys(
-    bot: Bot,
-    conn: asyncpg.Connection,
-    current_time: float,
-    threshold_time_10h: float,
-):
-    records = await conn.fetch(
-        """
-        SELECT tg_id, email, expiry_time, client_id, server_id FROM keys 
-        WHERE expiry_time <= $1 AND expiry_time > $2 AND notified = FALSE
-        """,
-        threshold_time_10h,
-        current_time,
-    )
+EXPIRING_KEYS_QUERY = """
+    SELECT k.tg_id, k.email, k.expiry_time, k.client_id, k.server_id, COALESCE(c.balance, 0) AS balance
+    FROM keys k
+    LEFT JOIN connections c ON c.tg_id = k.tg_id
+    WHERE k.expiry_time <= $1 AND k.expiry_time > $2
+"""
 
-    logger.info(f"Найдено {len(records)} ключей для уведомления за 10 часов.")
 
-    for record in records:
-        await process_10h_record(record, bot, conn)
+def split_by_balance(records: list) -> tuple[list, list]:
+    """
+    Делит ключи на продлеваемые с баланса и те, по которым нужно уведомление.
 
-    logger.info("Обработка всех уведомлений за 10 часов завершена.")
+    Баланс берется из выборки и уменьшается в памяти, поэтому несколько ключей
+    одного пользователя не продлеваются сверх его баланса.
 
+    Returns:
+        tuple: (ключи для автопродления, ключи для уведомления)
+    """
+    price = RENEWAL_PLANS["1"]["price"]
+    balances = {}
+    to_renew, to_notify = [], []
+    for record in records:
+        balance = balances.setdefault(record["tg_id"], record["balance"])
+        if AUTO_RENEW_KEYS and balance >= price:
+            balances[record["tg_id"]] = balance - price
+            to_renew.append(record)
+        else:
+            to_notify.append(record)
+    return to_renew, to_notify
 
-async def process_10h_record(record, bot, conn):
-    tg_id = record["tg_id"]
-    email = record["email"]
-    expiry_time = record["expiry_time"]
 
+def format_time_left(expiry_time: int) -> tuple[datetime, str]:
     moscow_tz = pytz.timezone("Europe/Moscow")
 
     expiry_date = datetime.fromtimestamp(expiry_time / 1000, tz=moscow_tz)
@@ -163,52 +274,45 @@ async def process_10h_record(record, bot, conn):
     days_left_message = (
         "Ключ истек" if time_left.total_seconds() <= 0 else f"{time_left.days}" if time_left.days > 0 else f"{time_left.seconds // 3600}"
     )
+    return expiry_date, days_left_message
 
-    message = KEY_EXPIRY_10H.format(
-        email=email,
+
+def build_10h_message(record) -> str:
+    expiry_date, days_left_message = format_time_left(record["expiry_time"])
+    return KEY_EXPIRY_10H.format(
+        email=record["email"],
         expiry_date=expiry_date.strftime("%Y-%m-%d %H:%M:%S"),
         days_left_message=days_left_message,
         price=RENEWAL_PLANS["1"]["price"],
     )
 
-    balance = await get_balance(tg_id)
 
-    if AUTO_RENEW_KEYS and balance >= RENEWAL_PLANS["1"]["price"]:
-        try:
-            await update_balance(tg_id, -RENEWAL_PLANS["1"]["price"])
-            new_expiry_time = int((datetime.utcnow() + timedelta(days=30)).timestamp() * 1000)
-            await update_key_expiry(record["client_id"], new_expiry_time)
+def build_24h_message(record) -> str:
+    expiry_date, days_left_message = format_time_left(record["expiry_time"])
+    return KEY_EXPIRY_24H.format(
+        email=record["email"],
+        days_left_message=days_left_message,
+        expiry_date=expiry_date.strftime("%Y-%m-%d %H:%M:%S"),
+    )
 
-            servers = await get_servers_from_db()
-            for cluster_id in servers:
-                await renew_key_in_cluster(cluster_id, email, record["client_id"], new_expiry_time, TOTAL_GB)
-                logger.info(f"Ключ для пользователя {tg_id} успешно продлен в кластере {cluster_id}.")
-
-            await conn.execute("UPDATE keys SET notified = TRUE WHERE client_id = $1", record["client_id"])
-
-            image_path = os.path.join("img", "notify_10h.jpg")
-            keyboard = types.InlineKeyboardMarkup(
-                inline_keyboard=[[types.InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile")]]
-            )
-
-            if os.path.isfile(image_path):
-                with open(image_path, "rb") as image_file:
-                    await bot.send_photo(
-                        tg_id,
-                        photo=BufferedInputFile(image_file.read(), filename="notify_10h.jpg"),
-                        caption=KEY_RENEWED.format(email=email),
-                        reply_markup=keyboard,
-                    )
-            else:
-                await bot.send_message(tg_id, text=KEY_RENEWED.format(email=email), reply_markup=keyboard)
 
-            logger.info(f"Уведомление об успешном продлении отправлено клиенту {tg_id}.")
+async def notify_10h_keys(
+    bot: Bot,
+    conn: asyncpg.Connection,
+    current_time: float,
+    threshold_time_10h: float,
+):
+    records = await conn.fetch(
+        EXPIRING_KEYS_QUERY + " AND k.notified = FALSE",
+        threshold_time_10h,
+        current_time,
+    )
 
-        except Exception as e:
-            logger.error(f"Ошибка при продлении подписки для клиента {tg_id}: {e}")
-    else:
-        await send_renewal_notification(bot, tg_id, email, message, conn, record["client_id"], "notified")
+    logger.info(f"Найдено {len(records)} ключей для уведомления за 10 часов.")
 
+    await process_expiring_keys(bot, conn, records, "notified", build_10h_message, "notify_10h.jpg")
+
+    logger.info("Обработка всех уведомлений за 10 часов завершена.")
 
 
 async def notify_24h_keys(
@@ -220,108 +324,93 @@ async def notify_24h_keys(
     logger.info("Проверка истекших ключей...")
 
     records_24h = await conn.fetch(
-        """
-        SELECT tg_id, email, expiry_time, client_id, server_id FROM keys 
-        WHERE expiry_time <= $1 AND expiry_time > $2 AND notified_24h = FALSE
-        """,
+        EXPIRING_KEYS_QUERY + " AND k.notified_24h = FALSE",
         threshold_time_24h,
         current_time,
     )
 
     logger.info(f"Найдено {len(records_24h)} ключей для уведомления за 24 часа.")
 
-    for record in records_24h:
-        await process_24h_record(record, bot, conn)
+    await process_expiring_keys(bot, conn, records_24h, "notified_24h", build_24h_message, "notify_24h.jpg")
 
     logger.info("Обработка всех уведомлений за 24 часа завершена.")
 
 
-async def process_24h_record(record, bot, conn):
-    tg_id = record["tg_id"]
-    email = record["email"]
-    expiry_time = record["expiry_time"]
+async def process_expiring_keys(
+    bot: Bot,
+    conn: asyncpg.Connection,
+    records: list,
+    flag: str,
+    build_message,
+    image_name: str,
+):
+    """
+    Продлевает ключи с баланса или отправляет уведомления, затем одним запросом
+    выставляет флаг flag всем обработанным ключам.
+    """
+    servers = await get_servers_from_db()
+    to_renew, to_notify = split_by_balance(records)
+    processed = []
 
-    moscow_tz = pytz.timezone("Europe/Moscow")
+    async def renew(record):
+        if await renew_key_from_balance(bot, record, servers, image_name):
+            processed.append(record["client_id"])
 
-    expiry_date = datetime.fromtimestamp(expiry_time / 1000, tz=moscow_tz)
-    current_date = datetime.now(moscow_tz)
-    time_left = expiry_date - current_date
+    async def notify(record):
+        if await send_renewal_notification(bot, record["tg_id"], record["email"], build_message(record)):
+            processed.append(record["client_id"])
 
-    days_left_message = (
-        "Ключ истек" if time_left.total_seconds() <= 0 else f"{time_left.days}" if time_left.days > 0 else f"{time_left.seconds // 3600}"
-    )
+    await dispatch(to_renew, renew)
+    await dispatch(to_notify, notify)
 
-    message_24h = KEY_EXPIRY_24H.format(
-        email=email,
-        days_left_message=days_left_message,
-        expiry_date=expiry_date.strftime("%Y-%m-%d %H:%M:%S"),
-    )
+    if processed:
+        await conn.execute(f"UPDATE keys SET {flag} = TRUE WHERE client_id = ANY($1::text[])", processed)
 
-    balance = await get_balance(tg_id)
 
-    if AUTO_RENEW_KEYS and balance >= RENEWAL_PLANS["1"]["price"]:
-        try:
-            await update_balance(tg_id, -RENEWAL_PLANS["1"]["price"])
-            new_expiry_time = int((datetime.utcnow() + timedelta(days=30)).timestamp() * 1000)
-            await update_key_expiry(record["client_id"], new_expiry_time)
+async def renew_key_from_balance(bot: Bot, record, servers: dict, image_name: str) -> bool:
+    tg_id = record["tg_id"]
+    email = record["email"]
 
-            servers = await get_servers_from_db()
-            for cluster_id in servers:
-                await renew_key_in_cluster(cluster_id, email, record["client_id"], new_expiry_time, TOTAL_GB)
-                logger.info(f"Ключ для пользователя {tg_id} успешно продлен в кластере {cluster_id}.")
-
-            await conn.execute("UPDATE keys SET notified_24h = TRUE WHERE client_id = $1", record["client_id"])
-
-            image_path = os.path.join("img", "notify_24h.jpg")
-            keyboard = types.InlineKeyboardMarkup(
-                inline_keyboard=[[types.InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile")]]
-            )
-
-            if os.path.isfile(image_path):
-                with open(image_path, "rb") as image_file:
-                    await bot.send_photo(
-                        tg_id,
-                        photo=BufferedInputFile(image_file.read(), filename="notify_24h.jpg"),
-                        caption=KEY_RENEWED.format(email=email),
-                        reply_markup=keyboard,
-                    )
-            else:
-                await bot.send_message(tg_id, text=KEY_RENEWED.format(email=email), reply_markup=keyboard)
+    try:
+        await update_balance(tg_id, -RENEWAL_PLANS["1"]["price"])
+        new_expiry_time = int((datetime.utcnow() + timedelta(days=30)).timestamp() * 1000)
+        await update_key_expiry(record["client_id"], new_expiry_time)
 
-            logger.info(f"Уведомление об успешном продлении отправлено клиенту {tg_id}.")
+        for cluster_id in servers:
+            await renew_key_in_cluster(cluster_id, email, record["client_id"], new_expiry_time, TOTAL_GB)
+            logger.info(f"Ключ для пользователя {tg_id} успешно продлен в кластере {cluster_id}.")
 
+        keyboard = types.InlineKeyboardMarkup(
+            inline_keyboard=[[types.InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile")]]
+        )
+        try:
+            await send_notification(bot, tg_id, KEY_RENEWED.format(email=email), keyboard, image_name)
+            logger.info(f"Уведомление об успешном продлении отправлено клиенту {tg_id}.")
         except Exception as e:
-            logger.error(f"Ошибка при продлении подписки для клиента {tg_id}: {e}")
-    else:
-        await send_renewal_notification(bot, tg_id, email, message_24h, conn, record["client_id"], "notified_24h")
+            logger.error(f"Не удалось отправить уведомление о продлении клиенту {tg_id}: {e}")
+
+        return True
 
+    except Exception as e:
+        logger.error(f"Ошибка при продлении подписки для клиента {tg_id}: {e}")
+        return False
 
-async def send_renewal_notification(bot, tg_id, email, message, conn, client_id, flag):
+
+async def send_renewal_notification(bot, tg_id, email, message) -> bool:
     try:
         keyboard = InlineKeyboardBuilder()
         keyboard.row(types.InlineKeyboardButton(text="🔄 Продлить VPN", callback_data=f"renew_key|{email}"))
         keyboard.row(types.InlineKeyboardButton(text="💳 Пополнить баланс", callback_data="pay"))
         keyboard.row(types.InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile"))
 
-        image_path = os.path.join("img", "notify_24h.jpg")
-
-        if os.path.isfile(image_path):
-            with open(image_path, "rb") as image_file:
-                await bot.send_photo(
-                    tg_id,
-                    photo=BufferedInputFile(image_file.read(), filename="notify_24h.jpg"),
-                    caption=message,
-                    reply_markup=keyboard.as_markup(),
-                )
-        else:
-            await bot.send_message(tg_id, message, reply_markup=keyboard.as_markup())
+        await send_notification(bot, tg_id, message, keyboard.as_markup(), "notify_24h.jpg")
 
         logger.info(f"Уведомление отправлено пользователю {tg_id}.")
-
-        await conn.execute(f"UPDATE keys SET {flag} = TRUE WHERE client_id = $1", client_id)
+        return True
 
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления пользователю {tg_id}: {e}")
+        return False
 
 
 async def notify_inactive_trial_users(bot: Bot, conn: asyncpg.Connection):
@@ -340,7 +429,7 @@ async def notify_inactive_trial_users(bot: Bot, conn: asyncpg.Connection):
     )
     logger.info(f"Найдено {len(inactive_trial_users)} неактивных пользователей.")
 
-    for user in inactive_trial_users:
+    async def notify_user(user):
         tg_id = user["tg_id"]
 
         username = user["username"]
@@ -354,9 +443,10 @@ async def notify_inactive_trial_users(bot: Bot, conn: asyncpg.Connection):
         )
 
         try:
-            can_notify = await check_notification_time(
-                tg_id, "inactive_trial", hours=24, session=conn
-            )
+            async with acquire_connection() as user_conn:
+                can_notify = await check_notification_time(
+                    tg_id, "inactive_trial", hours=24, session=user_conn
+                )
 
             if can_notify:
                 builder = InlineKeyboardBuilder()
@@ -381,17 +471,19 @@ async def notify_inactive_trial_users(bot: Bot, conn: asyncpg.Connection):
                 )
 
                 try:
-                    await bot.send_message(tg_id, message, reply_markup=keyboard)
+                    await send_notification(bot, tg_id, message, keyboard)
                     logger.info(
                         f"Отправлено уведомление неактивному пользователю {tg_id}."
                     )
-                    await add_notification(tg_id, "inactive_trial", session=conn)
+                    async with acquire_connection() as user_conn:
+                        await add_notification(tg_id, "inactive_trial", session=user_conn)
 
                 except TelegramForbiddenError:
                     logger.warning(
                         f"Бот заблокирован пользователем {tg_id}. Добавляем в blocked_users."
                     )
-                    await add_blocked_user(tg_id, conn)
+                    async with acquire_connection() as user_conn:
+                        await add_blocked_user(tg_id, user_conn)
                 except Exception as e:
                     logger.error(
                         f"Ошибка при отправке уведомления пользователю {tg_id}: {e}"
@@ -400,7 +492,7 @@ async def notify_inactive_trial_users(bot: Bot, conn: asyncpg.Connection):
         except Exception as e:
             logger.error(f"Ошибка при обработке пользователя {tg_id}: {e}")
 
-        await asyncio.sleep(1)
+    await dispatch(inactive_trial_users, notify_user)
 
 
 async def handle_expired_keys(bot: Bot, conn: asyncpg.Connection, current_time: float):
@@ -408,22 +500,31 @@ async def handle_expired_keys(bot: Bot, conn: asyncpg.Connection, current_time:
 
     threshold_time = int((datetime.utcnow() + timedelta(minutes=45)).timestamp() * 1000)
 
-    expiring_keys = await conn.fetch(
-        """
-        SELECT tg_id, client_id, expiry_time, email, server_id FROM keys 
-        WHERE expiry_time <= $1 AND expiry_time > $2
-        """,
-        threshold_time,
-        current_time,
-    )
+    expiring_keys = await conn.fetch(EXPIRING_KEYS_QUERY, threshold_time, current_time)
 
     logger.info(f"Найдено {len(expiring_keys)} подписок, срок действия которых скоро истекает.")
 
-    for record in expiring_keys:
-        try:
-            await process_key(record, bot, conn)
-        except Exception as e:
-            logger.error(f"Ошибка при обработке подписки {record['client_id']}: {e}")
+    servers = await get_servers_from_db()
+    to_renew, to_expire = split_by_balance(expiring_keys)
+    renewed = []
+
+    async def renew(record):
+        if await renew_key_from_balance(bot, record, servers, "notify_expired.jpg"):
+            renewed.append(record["client_id"])
+
+    await dispatch(to_renew, renew)
+    await dispatch(to_expire, lambda record: process_key(record, bot, servers))
+
+    if renewed:
+        await conn.execute(
+            """
+            UPDATE keys
+            SET notified = FALSE, notified_24h = FALSE
+            WHERE client_id = ANY($1::text[])
+            """,
+            renewed,
+        )
+        logger.info(f"Флаги notified сброшены для {len(renewed)} продленных ключей.")
 
     expired_keys = await conn.fetch(
         """
@@ -435,34 +536,22 @@ async def handle_expired_keys(bot: Bot, conn: asyncpg.Connection, current_time:
 
     logger.info(f"Найдено {len(expired_keys)} истёкших ключей.")
 
-    for record in expired_keys:
+    async def remove_expired_key(record):
         try:
             await delete_key_from_cluster(record["server_id"], record["email"], record["email"])
-            await conn.execute(
-                "DELETE FROM keys WHERE client_id = $1", record["client_id"]
-            )
+            await delete_key(record["client_id"])
             logger.info(f"Удалён истёкший ключ {record['client_id']} пользователя {record['tg_id']}.")
         except Exception as e:
             logger.error(f"Ошибка при удалении истёкшего ключа {record['client_id']}: {e}")
 
+    await dispatch(expired_keys, remove_expired_key)
 
-async def process_key(record, bot, conn):
+
+async def process_key(record, bot, servers: dict):
+    """Уведомляет об истечении ключа, который не удалось продлить с баланса, и при необходимости удаляет его."""
     tg_id = record["tg_id"]
     client_id = record["client_id"]
     email = record["email"]
-    balance = await get_balance(tg_id)
-    expiry_time = record["expiry_time"]
-
-    moscow_tz = pytz.timezone("Europe/Moscow")
-    expiry_date = datetime.fromtimestamp(expiry_time / 1000, tz=moscow_tz)
-    current_date = datetime.now(moscow_tz)
-    time_left = expiry_date - current_date
-
-    logger.info(
-        f"Время истечения ключа: {expiry_time} (МСК: {expiry_date}), "
-        f"Текущее время (МСК): {current_date}, "
-        f"Оставшееся время: {time_left}"
-    )
 
     keyboard = types.InlineKeyboardMarkup(
         inline_keyboard=[
@@ -474,97 +563,43 @@ async def process_key(record, bot, conn):
         ]
     )
 
-    image_path = os.path.join("img", "notify_expired.jpg")
-
     try:
-        if AUTO_RENEW_KEYS and balance >= RENEWAL_PLANS["1"]["price"]:
-            await update_balance(tg_id, -RENEWAL_PLANS["1"]["price"])
-
-            new_expiry_time = int((datetime.now(moscow_tz) + timedelta(days=30)).timestamp() * 1000)
-            await update_key_expiry(client_id, new_expiry_time)
-
-            servers = await get_servers_from_db()
+        message_expired = f"Ваша подписка {email} истекла. Пополните баланс для продления."
+        try:
+            await send_notification(bot, tg_id, message_expired, keyboard, "notify_expired.jpg")
+            logger.info(f"Уведомление об истечении подписки отправлено пользователю {tg_id}.")
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление об истечении клиенту {tg_id}: {e}")
 
+        if AUTO_DELETE_EXPIRED_KEYS:
             for cluster_id in servers:
-                await renew_key_in_cluster(cluster_id, email, client_id, new_expiry_time, TOTAL_GB)
-                logger.info(f"Ключ для пользователя {tg_id} успешно продлен в кластере {cluster_id}.")
-
-            await conn.execute(
-                """
-                UPDATE keys
-                SET notified = FALSE, notified_24h = FALSE
-                WHERE client_id = $1
-                """,
-                client_id,
-            )
-            logger.info(f"Флаги notified сброшены для клиента {client_id}.")
+                try:
+                    await delete_key_from_cluster(cluster_id, email, client_id)
+                    logger.info(f"Клиент {client_id} удален из кластера {cluster_id}.")
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении клиента {client_id} из кластера {cluster_id}: {e}")
 
             try:
-                if os.path.isfile(image_path):
-                    with open(image_path, "rb") as image_file:
-                        await bot.send_photo(
-                            tg_id,
-                            photo=BufferedInputFile(image_file.read(), filename="notify_expired.jpg"),
-                            caption = KEY_RENEWED.format(email=email),
-                            reply_markup=keyboard,
-                        )
-                else:
-                    await bot.send_message(tg_id, text=KEY_RENEWED, reply_markup=keyboard)
-                logger.info(f"Уведомление об успешном продлении отправлено клиенту {tg_id}.")
+                await delete_key(client_id)
+                logger.info(f"Ключ {client_id} удалён из базы данных.")
             except Exception as e:
-                logger.error(f"Не удалось отправить уведомление о продлении клиенту {tg_id}: {e}")
-
+                logger.error(f"Ошибка при удалении ключа {client_id} из базы данных: {e}")
         else:
-            message_expired = f"Ваша подписка {email} истекла. Пополните баланс для продления."
-            try:
-                if os.path.isfile(image_path):
-                    with open(image_path, "rb") as image_file:
-                        await bot.send_photo(
-                            tg_id,
-                            photo=BufferedInputFile(image_file.read(), filename="notify_expired.jpg"),
-                            caption=message_expired,
-                            reply_markup=keyboard,
-                        )
-                else:
-                    await bot.send_message(tg_id, text=message_expired, reply_markup=keyboard)
-                logger.info(f"Уведомление об истечении подписки отправлено пользователю {tg_id}.")
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление об истечении клиенту {tg_id}: {e}")
-
-            if AUTO_DELETE_EXPIRED_KEYS:
-                servers = await get_servers_from_db()
-
-                for cluster_id in servers:
-                    try:
-                        await delete_key_from_cluster(cluster_id, email, client_id)
-                        logger.info(f"Клиент {client_id} удален из кластера {cluster_id}.")
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении клиента {client_id} из кластера {cluster_id}: {e}")
-
-                try:
-                    await delete_key(client_id)
-                    logger.info(f"Ключ {client_id} удалён из базы данных.")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении ключа {client_id} из базы данных: {e}")
-            else:
-                logger.info(f"Ключ {client_id} НЕ был удалён (AUTO_DELETE_EXPIRED_KEYS=False).")
+            logger.info(f"Ключ {client_id} НЕ был удалён (AUTO_DELETE_EXPIRED_KEYS=False).")
 
     except Exception as e:
         logger.error(f"Ошибка при обработке ключа для клиента {tg_id}: {e}")
 
 
-
 async def check_online_users():
     servers = await get_servers_from_db()
 
     for cluster_id, cluster in servers.items():
         for server_id, server in enumerate(cluster):
-            xui = AsyncApi(
-                server["api_url"], username=ADMIN_USERNAME, password=ADMIN_PASSWORD
-            )
-            await xui.login()
+            xui = get_xui(server["api_url"])
             try:
-                online_users = len(await xui.client.online())
+                online_users = len(await xui_call(xui, xui.client.online))
+                set_server_online_users(server["server_name"], online_users)
                 logger.info(
                     f"Сервер '{server['server_name']}' доступен, текущее количество активных пользователей: {online_users}."
                 )
@@ -1,7 +1,6 @@
 import hashlib
 from typing import Any
 
-import asyncpg
 from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -11,7 +10,6 @@ from aiohttp import web
 from robokassa import HashAlgorithm, Robokassa
 
 from config import (
-    DATABASE_URL,
     ROBOKASSA_ENABLE,
     ROBOKASSA_LOGIN,
     ROBOKASSA_PASSWORD1,
@@ -19,6 +17,7 @@ from config import (
     ROBOKASSA_TEST_MODE,
 )
 from database import (
+    acquire_connection,
     add_connection,
     add_payment,
     check_connection_exists,
@@ -250,9 +249,8 @@ async def handle_custom_amount_input(message: types.Message | types.CallbackQuer
 
     try:
 
-        conn = await asyncpg.connect(DATABASE_URL)
-        user_data = await get_temporary_data(conn, tg_id)
-        await conn.close()
+        async with acquire_connection() as conn:
+            user_data = await get_temporary_data(conn, tg_id)
 
         if not user_data:
             await message.answer("Данные для оплаты не найдены. Попробуйте снова.")
@@ -1,14 +1,13 @@
 import os
 from typing import Any
 
-import asyncpg
 from aiogram import F, Router, types
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BufferedInputFile, InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from config import DATABASE_URL, NEWS_MESSAGE, RENEWAL_PLANS
-from database import get_balance, get_key_count, get_referral_stats, get_trial
+from config import NEWS_MESSAGE, RENEWAL_PLANS
+from database import acquire_connection, get_balance, get_key_count, get_referral_stats, get_trial
 from handlers.buttons.profile import (
     ADD_SUB,
     BALANCE,
@@ -21,6 +20,7 @@ from handlers.buttons.profile import (
     PAYMENT,
 )
 from handlers.texts import get_referral_link, invite_message_send, profile_message_send
+from media import send_photo_cached
 
 router = Router()
 
@@ -47,8 +47,7 @@ async def process_callback_view_profile(
     if balance is None:
         balance = 0
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    try:
+    async with acquire_connection() as conn:
         trial_status = await get_trial(chat_id, conn)
 
         profile_message = profile_message_send(
@@ -86,21 +85,14 @@ async def process_callback_view_profile(
             )
         builder.row(InlineKeyboardButton(text=MAIN_MENU, callback_data="start"))
 
-        if os.path.isfile(image_path):
-            with open(image_path, "rb") as image_file:
-                if is_callback:
-                    await callback_query_or_message.message.answer_photo(
-                        photo=BufferedInputFile(image_file.read(), filename="pic.jpg"),
-                        caption=profile_message,
-                        reply_markup=builder.as_markup(),
-                    )
-                else:
-                    await callback_query_or_message.answer_photo(
-                        photo=BufferedInputFile(image_file.read(), filename="pic.jpg"),
-                        caption=profile_message,
-                        reply_markup=builder.as_markup(),
-                    )
-        else:
+        target_message = callback_query_or_message.message if is_callback else callback_query_or_message
+        sent = await send_photo_cached(
+            target_message.answer_photo,
+            image_path,
+            caption=profile_message,
+            reply_markup=builder.as_markup(),
+        )
+        if not sent:
             if is_callback:
                 await callback_query_or_message.message.answer(
                     text=profile_message,
@@ -111,8 +103,6 @@ async def process_callback_view_profile(
                     text=profile_message,
                     reply_markup=builder.as_markup(),
                 )
-    finally:
-        await conn.close()
 
 
 @router.callback_query(F.data == "balance")
@@ -182,14 +172,13 @@ async def view_tariffs_handler(callback_query: types.CallbackQuery):
         ]
     )
 
-    if os.path.isfile(image_path):
-        with open(image_path, "rb") as image_file:
-            await callback_query.message.answer_photo(
-                photo=BufferedInputFile(image_file.read(), filename="tariffs.jpg"),
-                caption=tariffs_message,
-                reply_markup=builder.as_markup(),
-            )
-    else:
+    sent = await send_photo_cached(
+        callback_query.message.answer_photo,
+        image_path,
+        caption=tariffs_message,
+        reply_markup=builder.as_markup(),
+    )
+    if not sent:
         await callback_query.message.answer(
             text=tariffs_message,
             reply_markup=builder.as_markup(),
@@ -209,14 +198,13 @@ async def invite_handler(callback_query: types.CallbackQuery):
 
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile"))
-    if os.path.isfile(image_path):
-        with open(image_path, "rb") as image_file:
-            await callback_query.message.answer_photo(
-                photo=BufferedInputFile(image_file.read(), filename="pic_invite.jpg"),
-                caption=invite_message,
-                reply_markup=builder.as_markup(),
-            )
-    else:
+    sent = await send_photo_cached(
+        callback_query.message.answer_photo,
+        image_path,
+        caption=invite_message,
+        reply_markup=builder.as_markup(),
+    )
+    if not sent:
         await callback_query.message.answer(
             text=invite_message,
             reply_markup=builder.as_markup(),
@@ -5,7 +5,6 @@ from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import (
-    BufferedInputFile,
     CallbackQuery,
     InlineKeyboardButton,
     Message,
@@ -41,6 +40,7 @@ from handlers.keys.key_management import create_key
 from handlers.keys.trial_key import create_trial_key
 from handlers.texts import INSTRUCTIONS_TRIAL, WELCOME_TEXT, get_about_vpn
 from logger import logger
+from media import send_photo_cached
 
 router = Router()
 
@@ -226,14 +226,13 @@ async def show_start_menu(message: Message, admin: bool, session: Any):
 
     builder.row(InlineKeyboardButton(text="🌐 О VPN", callback_data="about_vpn"))
 
-    if os.path.isfile(image_path):
-        with open(image_path, "rb") as image_from_buffer:
-            await message.answer_photo(
-                photo=BufferedInputFile(image_from_buffer.read(), filename="pic.jpg"),
-                caption=WELCOME_TEXT,
-                reply_markup=builder.as_markup(),
-            )
-    else:
+    sent = await send_photo_cached(
+        message.answer_photo,
+        image_path,
+        caption=WELCOME_TEXT,
+        reply_markup=builder.as_markup(),
+    )
+    if not sent:
         await message.answer(
             text=WELCOME_TEXT,
             reply_markup=builder.as_markup(),
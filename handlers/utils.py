@@ -3,12 +3,21 @@ import random
 import re
 
 import aiohttp
-import asyncpg
 
 from bot import bot
-from config import DATABASE_URL
-from database import get_servers_from_db
+from database import get_key_counts, get_servers_from_db
 from logger import logger
+from servers import get_server_health, server_online_users
+
+try:
+    from config import CLUSTER_MAX_KEYS
+except ImportError:
+    CLUSTER_MAX_KEYS = None
+
+try:
+    from config import SERVER_MAX_ONLINE_USERS
+except ImportError:
+    SERVER_MAX_ONLINE_USERS = None
 
 
 async def get_usd_rate():
@@ -58,28 +67,57 @@ async def get_least_loaded_cluster() -> str:
     """
     Определяет кластер с наименьшей загрузкой.
 
+    Загрузка берется из счетчиков ключей, поэтому выбор не требует чтения всей таблицы keys.
+    Кластеры с недоступными по последней проверке серверами, а также перегруженные
+    по CLUSTER_MAX_KEYS или SERVER_MAX_ONLINE_USERS пропускаются. Если подходящих
+    кластеров нет, выбор делается среди всех.
+
     Returns:
         str: Идентификатор наименее загруженного кластера.
     """
     servers = await get_servers_from_db()
-
-    cluster_loads: dict[str, int] = {cluster_id: 0 for cluster_id in servers.keys()}
-
-    async with asyncpg.create_pool(DATABASE_URL) as pool:
-        async with pool.acquire() as conn:
-            keys = await conn.fetch("SELECT server_id FROM keys")
-            for key in keys:
-                cluster_id = key["server_id"]
-                if cluster_id in cluster_loads:
-                    cluster_loads[cluster_id] += 1
-
-    logger.info(f"Cluster loads after database query: {cluster_loads}")
+    key_counts = await get_key_counts()
+
+    cluster_loads: dict[str, int] = {}
+    available_clusters = []
+    for cluster_id, cluster_servers in servers.items():
+        server_names = [server["server_name"] for server in cluster_servers]
+        cluster_loads[cluster_id] = key_counts.get(cluster_id, 0) + sum(
+            key_counts.get(server_name, 0) for server_name in server_names if server_name != cluster_id
+        )
+
+        unhealthy = [
+            server_name
+            for server_name in server_names
+            if (health := get_server_health(server_name)) is not None and not health["online"]
+        ]
+        if unhealthy:
+            logger.warning(f"Кластер {cluster_id} пропущен: недоступны серверы {unhealthy}")
+            continue
+
+        if CLUSTER_MAX_KEYS and cluster_loads[cluster_id] >= CLUSTER_MAX_KEYS:
+            logger.warning(f"Кластер {cluster_id} пропущен: достигнут лимит ключей {CLUSTER_MAX_KEYS}")
+            continue
+
+        if SERVER_MAX_ONLINE_USERS and any(
+            server_online_users.get(server_name, 0) >= SERVER_MAX_ONLINE_USERS for server_name in server_names
+        ):
+            logger.warning(f"Кластер {cluster_id} пропущен: перегружен активными пользователями")
+            continue
+
+        available_clusters.append(cluster_id)
+
+    logger.info(f"Cluster loads: {cluster_loads}")
 
     if not cluster_loads:
         logger.warning("No clusters found in database or configuration.")
         return "cluster1"
 
-    least_loaded_cluster = min(cluster_loads, key=lambda k: (cluster_loads[k], k))
+    if not available_clusters:
+        logger.warning("Нет доступных кластеров, выбор среди всех кластеров.")
+        available_clusters = list(cluster_loads)
+
+    least_loaded_cluster = min(available_clusters, key=lambda k: (cluster_loads[k], k))
 
     logger.info(f"Least loaded cluster selected: {least_loaded_cluster}")
 
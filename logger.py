@@ -1,10 +1,42 @@
 import logging
 import os
 import sys
+import time
 from datetime import timedelta
 
 from loguru import logger
 
+try:
+    from config import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL = "INFO"
+
+try:
+    from config import LOG_FILE_LEVEL
+except ImportError:
+    LOG_FILE_LEVEL = "DEBUG"
+
+try:
+    from config import LOG_JSON
+except ImportError:
+    LOG_JSON = False
+
+try:
+    from config import LOG_MODULE_LEVELS
+except ImportError:
+    # Например {"handlers.keys.key_management": "WARNING", "aiogram": "INFO"}
+    LOG_MODULE_LEVELS = {}
+
+try:
+    from config import LOG_SAMPLE_LIMIT
+except ImportError:
+    LOG_SAMPLE_LIMIT = 50
+
+try:
+    from config import LOG_SAMPLE_WINDOW
+except ImportError:
+    LOG_SAMPLE_WINDOW = 1.0
+
 log_folder = "logs"
 
 if not os.path.exists(log_folder):
@@ -33,20 +65,88 @@ logging.basicConfig(handlers=[InterceptHandler()], level=0)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+_module_levels = sorted(
+    ((module, logger.level(level).no) for module, level in LOG_MODULE_LEVELS.items()),
+    key=lambda item: len(item[0]),
+    reverse=True,
+)
+_module_level_cache: dict[str, int | None] = {}
+
+_warning_no = logger.level("WARNING").no
+_sample_window_start = 0.0
+_sample_counts: dict[tuple, int] = {}
+_sample_dropped: dict[tuple, int] = {}
+
+
+def _module_level(name: str) -> int | None:
+    """Минимальный уровень из LOG_MODULE_LEVELS для модуля или его ближайшего пакета."""
+    if name not in _module_level_cache:
+        _module_level_cache[name] = next(
+            (level for module, level in _module_levels if name == module or name.startswith(f"{module}.")),
+            None,
+        )
+    return _module_level_cache[name]
+
+
+def _sample(record):
+    """
+    Отбрасывает сообщения ниже WARNING сверх LOG_SAMPLE_LIMIT за LOG_SAMPLE_WINDOW секунд с одной строки кода.
+
+    Число отброшенных сообщений попадает в extra["dropped"] следующего записанного сообщения с той же строки.
+    """
+    global _sample_window_start
+    record["extra"]["sampled_out"] = False
+    if not LOG_SAMPLE_LIMIT or record["level"].no >= _warning_no:
+        return
+
+    now = time.monotonic()
+    if now - _sample_window_start >= LOG_SAMPLE_WINDOW:
+        _sample_window_start = now
+        _sample_counts.clear()
+
+    site = (record["name"], record["line"])
+    count = _sample_counts.get(site, 0) + 1
+    _sample_counts[site] = count
+    if count > LOG_SAMPLE_LIMIT:
+        _sample_dropped[site] = _sample_dropped.get(site, 0) + 1
+        record["extra"]["sampled_out"] = True
+    elif site in _sample_dropped:
+        record["extra"]["dropped"] = _sample_dropped.pop(site)
+
+
+def _make_filter(default_level: str):
+    default_no = logger.level(default_level).no
+
+    def log_filter(record) -> bool:
+        if record["extra"].get("sampled_out"):
+            return False
+        module_level = _module_level(record["name"] or "")
+        return record["level"].no >= (default_no if module_level is None else module_level)
+
+    return log_filter
+
+
+logger.configure(extra={"update_id": "-", "dropped": 0}, patcher=_sample)
+
 logger.add(
     sys.stderr,
-    level="INFO",
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | <cyan>{module}:{function}:{line}</cyan> | <level>{message}</level>",
+    level=0,
+    filter=_make_filter(LOG_LEVEL),
+    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | <cyan>{module}:{function}:{line}</cyan> | <magenta>{extra[update_id]}</magenta> | <level>{message}</level>",
     colorize=True,
+    enqueue=True,
 )
 
 log_file_path = os.path.join(log_folder, "logging.log")
 logger.add(
     log_file_path,
-    level="DEBUG",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {module}:{function}:{line} | {message}",
+    level=0,
+    filter=_make_filter(LOG_FILE_LEVEL),
+    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {module}:{function}:{line} | {extra[update_id]} | {message}",
+    serialize=LOG_JSON,
     rotation=timedelta(minutes=60),
     retention=timedelta(days=3),
+    enqueue=True,
 )
 
 logger = logger
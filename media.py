@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+from config import API_TOKEN
+
+from logger import logger
+
+try:
+    from config import MEDIA_CACHE_FILE
+except ImportError:
+    MEDIA_CACHE_FILE = "media_cache.json"
+
+BOT_ID = API_TOKEN.split(":", 1)[0]
+
+# Ошибки Telegram, после которых сохраненный file_id нужно загрузить заново
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+    "invalid file_id",
+)
+
+_file_ids: dict[str, dict] | None = None
+_file_hashes: dict[str, tuple[float, int, str]] = {}
+_upload_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _load_file_ids() -> dict[str, dict]:
+    global _file_ids
+    if _file_ids is None:
+        try:
+            with open(MEDIA_CACHE_FILE) as file:
+                _file_ids = json.load(file).get(BOT_ID, {})
+        except FileNotFoundError:
+            _file_ids = {}
+        except Exception as e:
+            logger.error(f"Не удалось прочитать кэш file_id {MEDIA_CACHE_FILE}: {e}")
+            _file_ids = {}
+    return _file_ids
+
+
+def _save_file_ids():
+    try:
+        with open(MEDIA_CACHE_FILE) as file:
+            data = json.load(file)
+    except Exception:
+        data = {}
+    data[BOT_ID] = _file_ids
+
+    tmp_path = f"{MEDIA_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, indent=2)
+        os.replace(tmp_path, MEDIA_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить кэш file_id {MEDIA_CACHE_FILE}: {e}")
+
+
+def file_hash(path: str) -> str:
+    """Возвращает sha1 файла, пересчитывая его только при изменении размера или mtime."""
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    with open(path, "rb") as file:
+        digest = hashlib.sha1(file.read()).hexdigest()  # noqa: S324
+    _file_hashes[path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    """Проверяет, что Telegram отклонил именно сохраненный file_id, а не сам запрос."""
+    message = error.message.lower()
+    return any(text in message for text in FILE_ID_ERRORS)
+
+
+def _existing_file_hash(path: str) -> str | None:
+    return file_hash(path) if os.path.isfile(path) else None
+
+
+async def send_photo_cached(
+    send_photo: Callable[..., Awaitable[Message]],
+    image_path: str,
+    **kwargs,
+) -> Message | None:
+    """
+    Отправляет картинку по сохраненному file_id, загружая файл в Telegram только один раз.
+
+    file_id хранится в MEDIA_CACHE_FILE вместе с хэшем файла и перезагружается,
+    если файл изменился или Telegram перестал принимать старый file_id. Остальные ошибки
+    отправки (чат не найден, слишком длинная подпись и т.п.) пробрасываются без перезагрузки.
+
+    Args:
+        send_photo: Метод отправки фото, например message.answer_photo
+            или functools.partial(bot.send_photo, chat_id)
+        image_path (str): Путь к картинке
+        **kwargs: Остальные параметры send_photo (caption, reply_markup и т.д.)
+
+    Returns:
+        Message | None: Отправленное сообщение или None, если файла нет
+    """
+    digest = await asyncio.to_thread(_existing_file_hash, image_path)
+    if digest is None:
+        return None
+
+    file_ids = _file_ids if _file_ids is not None else await asyncio.to_thread(_load_file_ids)
+
+    entry = file_ids.get(image_path)
+    if entry and entry["hash"] == digest:
+        try:
+            return await send_photo(photo=entry["file_id"], **kwargs)
+        except TelegramBadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"file_id для {image_path} больше не действителен, загружаем заново: {e}")
+            if file_ids.pop(image_path, None) is not None:
+                await asyncio.to_thread(_save_file_ids)
+
+    async with _upload_locks[image_path]:
+        entry = file_ids.get(image_path)
+        if entry and entry["hash"] == digest:
+            return await send_photo(photo=entry["file_id"], **kwargs)
+
+        message = await send_photo(photo=FSInputFile(image_path), **kwargs)
+
+        if message and message.photo:
+            file_ids[image_path] = {"hash": digest, "file_id": message.photo[-1].file_id}
+            await asyncio.to_thread(_save_file_ids)
+            logger.info(f"Картинка {image_path} загружена в Telegram и сохранена по file_id")
+        return message
@@ -0,0 +1,255 @@
+import functools
+import os
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+
+from logger import logger
+
+try:
+    from config import METRICS_PORT
+except ImportError:
+    METRICS_PORT = None
+
+try:
+    from config import METRICS_HOST
+except ImportError:
+    METRICS_HOST = "127.0.0.1"
+
+# Порт задается и переменной окружения, чтобы у каждого процесса на одном хосте был свой.
+METRICS_PORT = int(os.getenv("METRICS_PORT", METRICS_PORT or 0)) or None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry: list = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счетчик в формате Prometheus с необязательными метками."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Текущее значение в формате Prometheus с необязательными метками.
+
+    Значения задаются через set либо функцией collect, которая вызывается при каждом
+    запросе метрик и возвращает словарь {метки: значение}.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        self.collect: Callable[[], dict[tuple, float]] | None = None
+        _registry.append(self)
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def set_function(self, collect: Callable[[], dict[tuple, float]]):
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        values = self.values
+        if self.collect is not None:
+            try:
+                values = {**values, **self.collect()}
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрики {self.name}: {e}")
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с необязательными метками."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # метки -> [счетчики по корзинам, сумма, количество]
+        self.values: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (bucket_counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+            inf_labels = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+handler_duration = Histogram(
+    "solobot_handler_duration_seconds", "Время обработки обновления", ("event", "action")
+)
+handler_db_queries = Histogram(
+    "solobot_handler_db_queries", "Число запросов к БД на обновление", ("event", "action"),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50),
+)
+session_handler_calls = Counter(
+    "solobot_session_handler_calls_total", "Вызовы обработчиков, обращавшихся к БД через session", ("handler",)
+)
+session_queries = Counter(
+    "solobot_session_queries_total", "Запросы обработчиков к БД через session", ("handler",)
+)
+session_db_duration = Histogram(
+    "solobot_session_db_duration_seconds", "Время запросов обработчика к БД через session за вызов", ("handler",)
+)
+db_function_duration = Histogram(
+    "solobot_db_function_duration_seconds", "Время выполнения функций database.py", ("function",)
+)
+db_queries = Counter("solobot_db_queries_total", "Запросы к БД по функциям database.py", ("function",))
+db_query_duration = Histogram(
+    "solobot_db_query_duration_seconds", "Время выполнения запросов к БД", ("function",)
+)
+panel_call_duration = Histogram(
+    "solobot_panel_call_duration_seconds", "Время вызова API панели 3x-ui", ("server", "method")
+)
+panel_call_errors = Counter("solobot_panel_call_errors_total", "Ошибки вызовов API панели 3x-ui", ("server", "method"))
+telegram_requests = Counter("solobot_telegram_requests_total", "Запросы к Telegram Bot API", ("method", "result"))
+telegram_request_duration = Histogram(
+    "solobot_telegram_request_duration_seconds", "Время запроса к Telegram Bot API", ("method",)
+)
+telegram_retry_after = Counter("solobot_telegram_retry_after_total", "Ответы RetryAfter от Telegram", ("method",))
+telegram_dead_letters = Counter(
+    "solobot_telegram_dead_letters_total", "Недоставленные отправки в Telegram", ("kind", "error")
+)
+db_pool_connections = Gauge(
+    "solobot_db_pool_connections",
+    "Соединения пула БД: size, idle, in_use, max_size и ожидающие соединения задачи (waiting)",
+    ("state",),
+)
+db_pool_acquire_timeouts = Gauge("solobot_db_pool_acquire_timeouts", "Таймауты получения соединения из пула с запуска")
+db_pool_wait_max = Gauge("solobot_db_pool_wait_max_seconds", "Максимальное ожидание соединения из пула с запуска")
+loop_duration = Histogram(
+    "solobot_background_loop_duration_seconds", "Время одного прохода фоновой задачи", ("loop",)
+)
+
+# Имя функции database.py, выполняющейся в текущей задаче, и счетчик запросов текущего обновления
+current_db_function: ContextVar[str] = ContextVar("current_db_function", default="other")
+current_update_queries: ContextVar[list | None] = ContextVar("current_update_queries", default=None)
+
+
+def record_query(query):
+    """Обработчик asyncpg.Connection.add_query_logger: учитывает запрос в метриках."""
+    function = current_db_function.get()
+    db_queries.inc(function)
+    if query.elapsed is not None:
+        db_query_duration.observe(query.elapsed, function)
+    if (counter := current_update_queries.get()) is not None:
+        counter[0] += 1
+
+
+def track_db_function(func):
+    """Оборачивает функцию database.py: время выполнения и привязка ее запросов к имени функции."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = current_db_function.set(name)
+        started_at = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            db_function_duration.observe(time.perf_counter() - started_at, name)
+            current_db_function.reset(token)
+
+    return wrapper
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+_runner: web.AppRunner | None = None
+
+
+async def start_metrics_server():
+    """Запускает отдельный HTTP-сервер с /metrics на METRICS_HOST:METRICS_PORT, если порт задан."""
+    global _runner
+    if not METRICS_PORT or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,69 @@
+import asyncio
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from database import add_blocked_users
+from logger import logger
+
+try:
+    from config import BLOCKED_FLUSH_INTERVAL
+except ImportError:
+    BLOCKED_FLUSH_INTERVAL = 10
+
+
+class BlockedUsersMiddleware(BaseRequestMiddleware):
+    """
+    Отмечает пользователей, заблокировавших бота, по ответам Telegram на любые запросы бота.
+
+    Если запрос к личному чату завершился TelegramForbiddenError, пользователь попадает
+    в очередь и сохраняется в blocked_users пачкой раз в BLOCKED_FLUSH_INTERVAL секунд.
+    """
+
+    def __init__(self):
+        self._pending: set[int] = set()
+        self._flush_task: asyncio.Task | None = None
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError:
+            chat_id = getattr(method, "chat_id", None)
+            # Положительный chat_id — личный чат с пользователем, у групп и каналов он отрицательный
+            if isinstance(chat_id, int) and chat_id > 0:
+                self._pending.add(chat_id)
+                if self._flush_task is None or self._flush_task.done():
+                    self._flush_task = asyncio.create_task(self._flush_loop())
+            raise
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(BLOCKED_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        """Сохраняет накопленных пользователей в blocked_users одним запросом."""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, set()
+        try:
+            await add_blocked_users(list(pending))
+            logger.info(f"В blocked_users добавлены пользователи, заблокировавшие бота: {len(pending)}")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении заблокировавших бота пользователей: {e}")
+            self._pending |= pending
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
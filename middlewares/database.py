@@ -1,11 +1,75 @@
+import time
 from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
 from typing import Any
 
-import asyncpg
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 
-from config import DATABASE_URL
+from database import acquire_connection
+from logger import logger
+from metrics import session_db_duration, session_handler_calls, session_queries
+
+
+class LazySession:
+    """
+    Прокси соединения с базой данных для одного обработчика.
+
+    Соединение берется из пула только при первом запросе и возвращается
+    в пул методом release. Время, проведенное в запросах, суммируется в db_time.
+    """
+
+    def __init__(self):
+        self._context = None
+        self._conn = None
+        self.db_time = 0.0
+        self.queries = 0
+
+    @property
+    def acquired(self) -> bool:
+        return self._conn is not None
+
+    async def connection(self):
+        """Возвращает реальное соединение, при необходимости забирая его из пула."""
+        if self._conn is None:
+            self._context = acquire_connection()
+            self._conn = await self._context.__aenter__()
+        return self._conn
+
+    async def _timed(self, method: str, *args, **kwargs):
+        conn = await self.connection()
+        started = time.monotonic()
+        try:
+            return await getattr(conn, method)(*args, **kwargs)
+        finally:
+            self.db_time += time.monotonic() - started
+            self.queries += 1
+
+    async def execute(self, *args, **kwargs):
+        return await self._timed("execute", *args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self._timed("executemany", *args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self._timed("fetch", *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self._timed("fetchrow", *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self._timed("fetchval", *args, **kwargs)
+
+    @asynccontextmanager
+    async def transaction(self, **kwargs):
+        conn = await self.connection()
+        async with conn.transaction(**kwargs):
+            yield self
+
+    async def release(self):
+        if self._context is not None:
+            context, self._context, self._conn = self._context, None, None
+            await context.__aexit__(None, None, None)
 
 
 class DatabaseMiddleware(BaseMiddleware):
@@ -15,9 +79,18 @@ class DatabaseMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: dict[str, Any],
     ) -> Any:
-        conn = await asyncpg.connect(DATABASE_URL)
+        session = LazySession()
+        data["session"] = session
         try:
-            data["session"] = conn
             return await handler(event, data)
         finally:
-            await conn.close()
+            await session.release()
+            if session.queries:
+                handler_object = data.get("handler")
+                handler_name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+                session_handler_calls.inc(handler_name)
+                session_queries.inc(handler_name, amount=session.queries)
+                session_db_duration.observe(session.db_time, handler_name)
+                logger.debug(
+                    f"Обработчик {handler_name}: {session.queries} запросов к БД за {session.db_time:.3f} сек."
+                )
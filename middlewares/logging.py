@@ -2,7 +2,7 @@ from collections.abc import Awaitable, Callable
 from typing import Any
 
 from aiogram import BaseMiddleware
-from aiogram.types import CallbackQuery, Message, TelegramObject
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
 
 from logger import logger
 
@@ -41,3 +41,16 @@ class LoggingMiddleware(BaseMiddleware):
             action = f"Обратный вызов: {event.data}"
 
         return {"user_id": user_id, "username": username, "action": action}
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """Добавляет update_id ко всем сообщениям лога, записанным при обработке обновления."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        with logger.contextualize(update_id=event.update_id):
+            return await handler(event, data)
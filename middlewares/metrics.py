@@ -0,0 +1,90 @@
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+from metrics import (
+    current_update_queries,
+    handler_db_queries,
+    handler_duration,
+    telegram_request_duration,
+    telegram_requests,
+    telegram_retry_after,
+)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Время обработки и число запросов к БД на обновление с разбивкой по действиям.
+
+    Действие — имя сработавшего обработчика, его записывает HandlerNameMiddleware.
+    Меток столько же, сколько зарегистрированных обработчиков: произвольные
+    callback_data и текст команд в метки не попадают, а обновления, которые не
+    обработал ни один обработчик, учитываются как "other".
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        event_type = type(event).__name__
+        action = data["metrics_action"] = ["other"]
+        queries = [0]
+        token = current_update_queries.set(queries)
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_duration.observe(time.perf_counter() - started_at, event_type, action[0])
+            handler_db_queries.observe(queries[0], event_type, action[0])
+            current_update_queries.reset(token)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Сообщает MetricsMiddleware имя обработчика, выбранного для обновления."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        action = data.get("metrics_action")
+        handler_object = data.get("handler")
+        if action is not None and handler_object is not None:
+            action[0] = getattr(handler_object.callback, "__name__", "other")
+        return await handler(event, data)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Число, время и результат запросов к Telegram Bot API по методам."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        api_method = method.__api_method__
+        started_at = time.perf_counter()
+        result = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            result = "retry_after"
+            telegram_retry_after.inc(api_method)
+            raise
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            telegram_requests.inc(api_method, result)
+            telegram_request_duration.observe(time.perf_counter() - started_at, api_method)
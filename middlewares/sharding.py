@@ -0,0 +1,73 @@
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+import aiohttp
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from logger import logger
+from workers import WORKER_INDEX, WORKER_URLS, serves_updates, shard_for
+
+try:
+    from config import WORKER_SECRET_TOKEN
+except ImportError:
+    WORKER_SECRET_TOKEN = None
+
+_session: aiohttp.ClientSession | None = None
+
+
+async def close_forward_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+class ShardingMiddleware(BaseMiddleware):
+    """
+    Распределяет обновления между воркерами из WORKER_URLS по id чата.
+
+    Telegram присылает обновления на любой воркер за балансировщиком. Обновление
+    чужого чата пересылается на вебхук воркера-владельца, поэтому все обновления
+    одного чата обрабатываются одним процессом по порядку. Если владелец недоступен,
+    обновление обрабатывается на месте.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        chat_id = chat.id if chat else user.id if user else None
+
+        if not WORKER_URLS or chat_id is None:
+            return await handler(event, data)
+
+        shard = shard_for(chat_id)
+        if shard == WORKER_INDEX and serves_updates():
+            return await handler(event, data)
+
+        if await self._forward(shard, event):
+            return None
+        return await handler(event, data)
+
+    async def _forward(self, shard: int, event: Update) -> bool:
+        global _session
+        if _session is None:
+            _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": WORKER_SECRET_TOKEN} if WORKER_SECRET_TOKEN else {}
+        try:
+            async with _session.post(
+                WORKER_URLS[shard],
+                data=event.model_dump_json(exclude_unset=True, by_alias=True),
+                headers={"Content-Type": "application/json", **headers},
+            ) as response:
+                response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось переслать обновление {event.update_id} воркеру {shard}: {e}")
+            return False
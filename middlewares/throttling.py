@@ -1,13 +1,97 @@
+import time
+from collections import OrderedDict
 from collections.abc import Awaitable, Callable
 from typing import Any
 
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+from config import ADMIN_ID
 
+from logger import logger
 
-class ThrottleMiddleware(BaseMiddleware):
-    def __init__(self, limit: int):
-        self.limit = limit
+try:
+    from config import THROTTLE_LIMITS
+except ImportError:
+    # Группа: (токенов в секунду, максимум токенов подряд)
+    THROTTLE_LIMITS = {
+        "navigation": (2, 6),
+        "payment": (0.5, 3),
+        "key_creation": (0.2, 2),
+    }
+
+try:
+    from config import THROTTLE_MAX_ENTRIES
+except ImportError:
+    THROTTLE_MAX_ENTRIES = 100000
+
+try:
+    from config import THROTTLE_TTL
+except ImportError:
+    THROTTLE_TTL = 600
+
+THROTTLE_GROUPS = {
+    "payment": (
+        "pay",
+        "enter_custom_amount",
+        "enter_custom_donate_amount",
+        "crypto_amount|",
+        "robokassa_amount|",
+        "stars_amount|",
+        "yookassa_amount|",
+        "yoomoney_amount",
+        "renew_plan|",
+        "donate",
+        "gift|",
+        "confirm_gift|",
+        "activate_coupon",
+    ),
+    "key_creation": (
+        "create_key",
+        "connect_vpn",
+        "select_country|",
+        "select_plan_",
+        "update_subscription|",
+        "delete_key|",
+        "confirm_delete|",
+    ),
+}
+
+TOO_FAST_TEXT = "⏳ Слишком часто. Подождите немного и попробуйте снова."
+
+
+def get_throttle_group(event: TelegramObject) -> str:
+    """Определяет группу лимитов по callback_data нажатой кнопки."""
+    if isinstance(event, CallbackQuery) and event.data:
+        for group, prefixes in THROTTLE_GROUPS.items():
+            if event.data.startswith(prefixes):
+                return group
+    return "navigation"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту действий пользователя по алгоритму token bucket.
+
+    У каждого пользователя свое ведро на каждую группу из THROTTLE_LIMITS. Ведра хранятся
+    в LRU не больше THROTTLE_MAX_ENTRIES штук и удаляются после THROTTLE_TTL секунд простоя,
+    поэтому память не растет с числом пользователей.
+
+    Регистрируется внешним middleware на уровне update до FSMContextMiddleware: отклоненное
+    обновление не читает состояние FSM и не трогает базу данных, а получает только короткий
+    ответ "слишком часто", один раз на серию.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, tuple[float, float]] | None = None,
+        max_entries: int = THROTTLE_MAX_ENTRIES,
+        ttl: float = THROTTLE_TTL,
+    ):
+        self.limits = limits or THROTTLE_LIMITS
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (user_id, группа) -> [токены, время обновления, предупрежден ли пользователь]
+        self._buckets: OrderedDict[tuple[int, str], list] = OrderedDict()
 
     async def __call__(
         self,
@@ -15,5 +99,60 @@ class ThrottleMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: dict[str, Any],
     ) -> Any:
-        #todo
-        return await handler(event, data)
+        target = event.event if isinstance(event, Update) else event
+        user = getattr(target, "from_user", None)
+        if user is None or self._is_admin(user.id):
+            return await handler(event, data)
+
+        group = get_throttle_group(target)
+        if self._try_acquire(user.id, group):
+            return await handler(event, data)
+
+        await self._reject(target, user.id, group)
+        return None
+
+    def _try_acquire(self, user_id: int, group: str) -> bool:
+        rate, capacity = self.limits.get(group) or self.limits["navigation"]
+        now = time.monotonic()
+        key = (user_id, group)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now, False]
+            self._evict(now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True
+        return False
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_entries and now - bucket[1] < self.ttl:
+                break
+            del self._buckets[key]
+
+    async def _reject(self, event: TelegramObject, user_id: int, group: str):
+        bucket = self._buckets[(user_id, group)]
+        warned, bucket[2] = bucket[2], True
+        logger.debug(f"Пользователь {user_id} превысил лимит группы {group}")
+
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(TOO_FAST_TEXT)
+            elif isinstance(event, Message) and not warned:
+                await event.answer(TOO_FAST_TEXT)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить пользователю {user_id} о превышении лимита: {e}")
+
+    @staticmethod
+    def _is_admin(user_id: int) -> bool:
+        if isinstance(ADMIN_ID, list):
+            return user_id in ADMIN_ID
+        return user_id == ADMIN_ID
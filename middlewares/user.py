@@ -1,13 +1,51 @@
+import asyncio
+import time
+from collections import OrderedDict
 from collections.abc import Awaitable, Callable
 from typing import Any
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, User
 
-from database import upsert_user
+from database import upsert_user, upsert_users
+from logger import logger
+
+try:
+    from config import USER_CACHE_SIZE
+except ImportError:
+    USER_CACHE_SIZE = 100000
+
+try:
+    from config import USER_FLUSH_INTERVAL
+except ImportError:
+    USER_FLUSH_INTERVAL = 5
+
+try:
+    from config import USER_LAST_SEEN_INTERVAL
+except ImportError:
+    USER_LAST_SEEN_INTERVAL = 300
 
 
 class UserMiddleware(BaseMiddleware):
+    """
+    Сохраняет профиль пользователя в таблицу users.
+
+    Первое обращение пользователя к процессу записывается сразу, чтобы строка в users
+    существовала до обработчиков. Дальше запись нужна только если изменились имя,
+    username или язык, либо с прошлой записи прошло USER_LAST_SEEN_INTERVAL секунд
+    (обновление updated_at). Такие записи копятся и сохраняются пачкой раз в USER_FLUSH_INTERVAL секунд.
+
+    Обе записи удаляют пользователя из blocked_users: раз он снова пишет боту, значит разблокировал его.
+    Поэтому вернувшийся пользователь пропадает из blocked_users не позже чем через
+    USER_LAST_SEEN_INTERVAL + USER_FLUSH_INTERVAL секунд и не удаляется через delete_banned_users.
+    """
+
+    def __init__(self):
+        # tg_id -> (профиль, время последней записи)
+        self._profiles: OrderedDict[int, tuple[tuple, float]] = OrderedDict()
+        self._pending: dict[int, tuple] = {}
+        self._flush_task: asyncio.Task | None = None
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
@@ -19,11 +57,57 @@ class UserMiddleware(BaseMiddleware):
         return await handler(event, data)
 
     async def _process_user(self, user: User) -> None:
-        await upsert_user(
-            tg_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name,
-            language_code=user.language_code,
-            is_bot=user.is_bot,
-        )
+        profile = (user.id, user.username, user.first_name, user.last_name, user.language_code, user.is_bot)
+        now = time.monotonic()
+
+        cached = self._profiles.get(user.id)
+        if cached is None:
+            await upsert_user(
+                tg_id=user.id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                language_code=user.language_code,
+                is_bot=user.is_bot,
+            )
+            self._remember(user.id, profile, now)
+            return
+
+        self._profiles.move_to_end(user.id)
+        cached_profile, written_at = cached
+        if cached_profile == profile and now - written_at < USER_LAST_SEEN_INTERVAL:
+            return
+
+        self._pending[user.id] = profile
+        self._remember(user.id, profile, now)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    def _remember(self, tg_id: int, profile: tuple, written_at: float):
+        self._profiles[tg_id] = (profile, written_at)
+        while len(self._profiles) > USER_CACHE_SIZE:
+            self._profiles.popitem(last=False)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(USER_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        """Сохраняет накопленные изменения профилей одним запросом."""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        try:
+            await upsert_users(list(pending.values()))
+            logger.debug(f"Сохранены профили {len(pending)} пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении профилей пользователей: {e}")
+            self._pending = {**pending, **self._pending}
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,213 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterable
+from typing import Any
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from logger import logger
+from metrics import telegram_dead_letters
+
+try:
+    from config import SEND_GLOBAL_RATE
+except ImportError:
+    SEND_GLOBAL_RATE = 25
+
+try:
+    from config import SEND_CHAT_INTERVAL
+except ImportError:
+    SEND_CHAT_INTERVAL = 1.0
+
+try:
+    from config import SEND_CONCURRENCY
+except ImportError:
+    SEND_CONCURRENCY = 20
+
+try:
+    from config import SEND_MAX_RETRIES
+except ImportError:
+    SEND_MAX_RETRIES = 3
+
+try:
+    from config import SEND_MAX_RETRY_AFTER
+except ImportError:
+    SEND_MAX_RETRY_AFTER = 5
+
+try:
+    from config import DEAD_LETTERS_SIZE
+except ImportError:
+    DEAD_LETTERS_SIZE = 1000
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму token bucket.
+
+    Токены пополняются со скоростью rate в секунду до capacity. acquire сразу резервирует
+    токен, уводя баланс в минус, и спит ровно до момента, когда этот токен пополнится.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> bool:
+        """Забирает токен без ожидания. Возвращает False, если токенов нет."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        try:
+            await asyncio.sleep(-self.tokens / self.rate)
+        except asyncio.CancelledError:
+            self.tokens += 1
+            raise
+
+
+global_bucket = TokenBucket(SEND_GLOBAL_RATE)
+dead_letters: deque = deque(maxlen=DEAD_LETTERS_SIZE)
+
+_chat_next_send: dict[int, float] = {}
+_paused_until = 0.0
+# Сброшено, пока отправки приостановлены после TelegramRetryAfter
+_resumed = asyncio.Event()
+_resumed.set()
+_resume_handle: asyncio.TimerHandle | None = None
+
+
+async def _wait_turn(chat_id: int):
+    await _resumed.wait()
+
+    now = time.monotonic()
+    next_send = _chat_next_send.get(chat_id, 0.0)
+    _chat_next_send[chat_id] = max(now, next_send) + SEND_CHAT_INTERVAL
+    if next_send > now:
+        await asyncio.sleep(next_send - now)
+
+    if len(_chat_next_send) > 10000:
+        for stale_chat_id in [key for key, value in _chat_next_send.items() if value < now]:
+            del _chat_next_send[stale_chat_id]
+
+    await global_bucket.acquire()
+
+
+def _pause(seconds: float):
+    global _paused_until, _resume_handle
+    paused_until = time.monotonic() + seconds
+    if paused_until <= _paused_until:
+        return
+
+    _paused_until = paused_until
+    _resumed.clear()
+    if _resume_handle is not None:
+        _resume_handle.cancel()
+    _resume_handle = asyncio.get_running_loop().call_later(seconds, _resumed.set)
+
+
+def add_dead_letter(chat_id: int, error: Exception, kind: str = "message"):
+    error_type = type(error).__name__
+    dead_letters.append(
+        {"chat_id": chat_id, "kind": kind, "error_type": error_type, "error": str(error), "time": time.time()}
+    )
+    telegram_dead_letters.inc(kind, error_type)
+
+
+def get_dead_letters_summary() -> dict[tuple[str, str], int]:
+    """Число недоставленных отправок в dead_letters по типу отправки и типу ошибки."""
+    summary: dict[tuple[str, str], int] = {}
+    for letter in dead_letters:
+        key = (letter["kind"], letter["error_type"])
+        summary[key] = summary.get(key, 0) + 1
+    return dict(sorted(summary.items(), key=lambda item: item[1], reverse=True))
+
+
+async def send_limited(chat_id: int, send: Callable[[], Awaitable[Any]], kind: str = "message") -> Any:
+    """
+    Выполняет отправку в Telegram с учетом общих и поканальных лимитов.
+
+    На TelegramRetryAfter все отправки приостанавливаются на указанное Telegram время,
+    после чего попытка повторяется, но не больше SEND_MAX_RETRY_AFTER раз. Сетевые ошибки
+    и ошибки сервера повторяются до SEND_MAX_RETRIES раз. Неудачные отправки попадают
+    в dead_letters и в метрику solobot_telegram_dead_letters_total, последние из них
+    показываются в админке ("Управление ботом" → "Недоставленные сообщения").
+
+    Args:
+        chat_id (int): Получатель
+        send: Функция без аргументов, выполняющая запрос, например lambda: bot.send_message(...)
+        kind (str, optional): Тип отправки для dead_letters. По умолчанию "message".
+
+    Raises:
+        TelegramForbiddenError, TelegramBadRequest: Сразу, без повторов
+        Exception: Последняя ошибка, включая TelegramRetryAfter, если попытки исчерпаны
+    """
+    attempt = retry_after_attempt = 0
+    while True:
+        await _wait_turn(chat_id)
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            _pause(e.retry_after)
+            retry_after_attempt += 1
+            if retry_after_attempt > SEND_MAX_RETRY_AFTER:
+                add_dead_letter(chat_id, e, kind)
+                logger.error(f"Telegram {retry_after_attempt} раз ограничил отправку в чат {chat_id}, отправка отменена")
+                raise
+            logger.warning(f"Telegram ограничил отправку, пауза {e.retry_after} сек. (чат {chat_id})")
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            add_dead_letter(chat_id, e, kind)
+            raise
+        except (TelegramNetworkError, TelegramServerError) as e:
+            attempt += 1
+            if attempt > SEND_MAX_RETRIES:
+                add_dead_letter(chat_id, e, kind)
+                logger.error(f"Не удалось отправить сообщение в чат {chat_id} после {attempt} попыток: {e}")
+                raise
+            await asyncio.sleep(2**attempt)
+
+
+async def dispatch(
+    items: Iterable,
+    handler: Callable[[Any], Awaitable[Any]],
+    concurrency: int | None = None,
+):
+    """
+    Обрабатывает элементы несколькими параллельными обработчиками.
+
+    Ошибка в одном элементе логируется и не останавливает остальные.
+
+    Args:
+        items (Iterable): Элементы для обработки
+        handler: Асинхронная функция, вызываемая для каждого элемента
+        concurrency (int, optional): Число одновременных обработчиков. По умолчанию SEND_CONCURRENCY.
+    """
+    iterator = iter(items)
+
+    async def worker():
+        for item in iterator:
+            try:
+                await handler(item)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке {item}: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(concurrency or SEND_CONCURRENCY)))
@@ -1,16 +1,21 @@
 import asyncio
 import re
+import time
+from collections import deque
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
-import asyncpg
+import aiohttp
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from ping3 import ping
 
 from bot import bot
-from config import ADMIN_ID, DATABASE_URL, PING_TIME
-from database import get_servers_from_db
+from config import ADMIN_ID, PING_TIME
+from database import acquire_connection, get_servers_from_db, notify_servers_changed
 from logger import logger
+from metrics import loop_duration
+from workers import is_leader
 
 try:
     from config import CLUSTERS
@@ -20,6 +25,26 @@ except ImportError:
         "Переменная CLUSTERS не найдена в конфигурации. Добавьте сервера через админ-панель!"
     )
 
+try:
+    from config import HEALTH_CHECK_METHODS
+except ImportError:
+    HEALTH_CHECK_METHODS = ("icmp", "tcp", "http")
+
+try:
+    from config import HEALTH_CHECK_CONCURRENCY
+except ImportError:
+    HEALTH_CHECK_CONCURRENCY = 10
+
+try:
+    from config import HEALTH_CHECK_TIMEOUT
+except ImportError:
+    HEALTH_CHECK_TIMEOUT = 3
+
+try:
+    from config import HEALTH_HISTORY_SIZE
+except ImportError:
+    HEALTH_HISTORY_SIZE = 20
+
 
 async def sync_servers_with_db():
     """
@@ -33,66 +58,156 @@ async def sync_servers_with_db():
         return
 
     try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        logger.info("Подключение к базе данных для синхронизации серверов успешно.")
-
-        for cluster_name, servers in CLUSTERS.items():
-            for server_key, server_info in servers.items():
-                exists = await conn.fetchval(
-                    """
-                    SELECT 1 FROM servers
-                    WHERE cluster_name = $1 AND server_name = $2
-                    """,
-                    cluster_name,
-                    server_info["name"],
-                )
-
-                if not exists:
-                    await conn.execute(
+        async with acquire_connection() as conn:
+            logger.info("Подключение к базе данных для синхронизации серверов успешно.")
+            added = 0
+
+            for cluster_name, servers in CLUSTERS.items():
+                for server_key, server_info in servers.items():
+                    exists = await conn.fetchval(
                         """
-                        INSERT INTO servers (cluster_name, server_name, api_url, subscription_url, inbound_id)
-                        VALUES ($1, $2, $3, $4, $5)
+                        SELECT 1 FROM servers
+                        WHERE cluster_name = $1 AND server_name = $2
                         """,
                         cluster_name,
                         server_info["name"],
-                        server_info["API_URL"],
-                        server_info["SUBSCRIPTION"],
-                        server_info["INBOUND_ID"],
-                    )
-                    logger.info(
-                        f"Сервер {server_info['name']} из кластера {cluster_name} добавлен в базу данных."
-                    )
-                else:
-                    logger.info(
-                        f"Сервер {server_info['name']} из кластера {cluster_name} уже существует."
                     )
 
+                    if not exists:
+                        await conn.execute(
+                            """
+                            INSERT INTO servers (cluster_name, server_name, api_url, subscription_url, inbound_id)
+                            VALUES ($1, $2, $3, $4, $5)
+                            """,
+                            cluster_name,
+                            server_info["name"],
+                            server_info["API_URL"],
+                            server_info["SUBSCRIPTION"],
+                            server_info["INBOUND_ID"],
+                        )
+                        added += 1
+                        logger.info(
+                            f"Сервер {server_info['name']} из кластера {cluster_name} добавлен в базу данных."
+                        )
+                    else:
+                        logger.info(
+                            f"Сервер {server_info['name']} из кластера {cluster_name} уже существует."
+                        )
+
+            if added:
+                await notify_servers_changed(conn)
+
     except Exception as e:
         logger.error(f"Ошибка при синхронизации серверов: {e}")
-    finally:
-        if "conn" in locals():
-            await conn.close()
 
 
 last_ping_times = {}
 last_notification_times = {}
+server_health: dict[str, deque] = {}
+server_online_users: dict[str, int] = {}
 
 
-async def ping_server(server_ip: str) -> bool:
+async def ping_server(server_ip: str, timeout: float = 3) -> float | None:
     """
     Функция пинга сервера.
-    Возвращает True, если сервер доступен, иначе False.
+    Пинг выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+    Возвращает задержку в секундах, если сервер доступен, иначе None.
     """
     try:
         logger.debug(f"Пингуем сервер {server_ip}...")
-        response = ping(server_ip, timeout=3)
-        if response is False:
+        response = await asyncio.to_thread(ping, server_ip, timeout=timeout)
+        if not response:
             logger.warning(f"Сервер {server_ip} не отвечает.")
-            return False
-        return True
+            return None
+        return response
     except Exception as e:
         logger.error(f"Ошибка при пинге сервера {server_ip}: {e}")
-        return False
+        return None
+
+
+async def probe_tcp(host: str, port: int, timeout: float = 3) -> float | None:
+    """
+    Проверяет, принимает ли порт панели TCP-соединения.
+    Возвращает время установки соединения в секундах или None.
+    """
+    started = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except Exception as e:
+        logger.warning(f"Порт {port} сервера {host} недоступен: {e}")
+        return None
+    latency = time.monotonic() - started
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception as e:
+        logger.debug(f"Ошибка при закрытии проверочного соединения с сервером {host}:{port}: {e}")
+    return latency
+
+
+async def probe_http(session: aiohttp.ClientSession, api_url: str) -> float | None:
+    """
+    Проверяет, что панель отвечает по HTTP без ошибки сервера.
+    Возвращает время ответа в секундах или None.
+    """
+    started = time.monotonic()
+    try:
+        async with session.get(api_url, ssl=False, allow_redirects=False) as response:
+            if response.status >= 500:
+                logger.warning(f"Панель {api_url} ответила статусом {response.status}")
+                return None
+    except Exception as e:
+        logger.warning(f"Панель {api_url} не отвечает: {e}")
+        return None
+    return time.monotonic() - started
+
+
+async def check_server_health(
+    server: dict, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore
+) -> dict:
+    """
+    Проверяет сервер всеми методами из HEALTH_CHECK_METHODS и сохраняет результат в историю.
+
+    Returns:
+        dict: Время проверки, общий статус (online), задержка и результаты отдельных проверок
+    """
+    api_url = server["api_url"]
+    host = extract_host(api_url)
+    parsed_url = urlsplit(api_url if "://" in api_url else f"http://{api_url}")
+    port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+
+    probes = {}
+    async with semaphore:
+        if "icmp" in HEALTH_CHECK_METHODS:
+            probes["icmp"] = ping_server(host, HEALTH_CHECK_TIMEOUT)
+        if "tcp" in HEALTH_CHECK_METHODS:
+            probes["tcp"] = probe_tcp(host, port, HEALTH_CHECK_TIMEOUT)
+        if "http" in HEALTH_CHECK_METHODS:
+            probes["http"] = probe_http(session, api_url)
+        latencies = dict(zip(probes, await asyncio.gather(*probes.values())))
+
+    successful = [latency for latency in latencies.values() if latency is not None]
+    result = {
+        "time": datetime.now(),
+        "online": bool(latencies) and len(successful) == len(latencies),
+        "latency": min(successful) if successful else None,
+        "probes": latencies,
+    }
+
+    history = server_health.setdefault(server["server_name"], deque(maxlen=HEALTH_HISTORY_SIZE))
+    history.append(result)
+    return result
+
+
+def set_server_online_users(server_name: str, online_users: int):
+    """Запоминает последнее известное количество активных пользователей сервера."""
+    server_online_users[server_name] = online_users
+
+
+def get_server_health(server_name: str) -> dict | None:
+    """Возвращает результат последней проверки сервера или None, если проверок еще не было."""
+    history = server_health.get(server_name)
+    return history[-1] if history else None
 
 
 async def notify_admin(server_name: str):
@@ -147,44 +262,55 @@ async def notify_admin(server_name: str):
 async def check_servers():
     """
     Периодическая проверка серверов с учетом извлечения хоста из `api_url`.
+    Серверы проверяются параллельно, не более HEALTH_CHECK_CONCURRENCY одновременно.
+    Проверку ведет каждый процесс, уведомления администраторам отправляет только ведущий.
     """
     while True:
+        started_at = time.perf_counter()
         servers = await get_servers_from_db()
         current_time = datetime.now()
 
         logger.info(f"Начинаю проверку серверов: {current_time}")
 
-        for cluster_name, cluster_servers in servers.items():
-            logger.debug(f"Проверка кластеров: {cluster_name}")
-            for server in cluster_servers:
-                original_api_url = server["api_url"]
-                server_name = server["server_name"]
+        all_servers = [server for cluster_servers in servers.values() for server in cluster_servers]
+        semaphore = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            results = await asyncio.gather(
+                *(check_server_health(server, session, semaphore) for server in all_servers),
+                return_exceptions=True,
+            )
 
-                server_host = extract_host(original_api_url)
-                logger.debug(
-                    f"Проверка доступности сервера '{server_name}' с хостом {server_host}"
-                )
+        for server, result in zip(all_servers, results):
+            server_name = server["server_name"]
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при проверке сервера {server_name}: {result}")
+                continue
 
-                is_online = await ping_server(server_host)
+            logger.debug(f"Сервер '{server_name}': {result['probes']}")
 
-                if is_online:
+            if result["online"]:
+                last_ping_times[server_name] = current_time
+            else:
+                last_ping_time = last_ping_times.get(server_name)
+                if (
+                    last_ping_time
+                    and current_time - last_ping_time > timedelta(minutes=3)
+                    and await is_leader()
+                ):
+                    logger.warning(
+                        f"Сервер {server_name} не отвечает более 3 минут. Отправляю уведомление."
+                    )
+                    await notify_admin(server_name)
+                elif not last_ping_time:
                     last_ping_times[server_name] = current_time
-                else:
-                    last_ping_time = last_ping_times.get(server_name)
-                    if last_ping_time and current_time - last_ping_time > timedelta(
-                        minutes=3
-                    ):
-                        logger.warning(
-                            f"Сервер {server_name} не отвечает более 3 минут. Отправляю уведомление."
-                        )
-                        await notify_admin(server_name)
-                    elif not last_ping_time:
-                        last_ping_times[server_name] = current_time
-                        logger.info(
-                            f"Сервер {server_name} не отвечал ранее, но теперь зарегистрирован."
-                        )
+                    logger.info(
+                        f"Сервер {server_name} не отвечал ранее, но теперь зарегистрирован."
+                    )
 
         logger.info("Завершена проверка всех серверов.")
+        loop_duration.observe(time.perf_counter() - started_at, "check_servers")
         await asyncio.sleep(PING_TIME)
 
 
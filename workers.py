@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import asyncpg
+
+from logger import logger
+
+try:
+    from config import BOT_ROLE
+except ImportError:
+    BOT_ROLE = "all"
+
+try:
+    from config import WORKER_URLS
+except ImportError:
+    WORKER_URLS = []
+
+try:
+    from config import LEADER_CHECK_INTERVAL
+except ImportError:
+    LEADER_CHECK_INTERVAL = 15
+
+# Роль и номер процесса задаются переменными окружения, так как config.py общий для всех процессов.
+BOT_ROLE = os.getenv("BOT_ROLE", BOT_ROLE)
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+
+SCHEDULER_LOCK_ID = 0x536F6C6F  # "Solo"
+
+_leader_conn: asyncpg.Connection | None = None
+_leader_task: asyncio.Task | None = None
+_elected = asyncio.Event()
+
+
+def serves_updates() -> bool:
+    """Обрабатывает ли процесс обновления пользователей (роли "all" и "web")."""
+    return BOT_ROLE in ("all", "web")
+
+
+def runs_scheduler() -> bool:
+    """Участвует ли процесс в выборах ведущего для периодических задач (роли "all" и "scheduler")."""
+    return BOT_ROLE in ("all", "scheduler")
+
+
+def shard_for(chat_id: int) -> int:
+    """Номер воркера из WORKER_URLS, который обрабатывает обновления чата."""
+    return chat_id % len(WORKER_URLS)
+
+
+async def is_leader() -> bool:
+    """
+    Проверяет, является ли процесс ведущим, то есть должен ли он выполнять периодические задачи.
+
+    Ведущий держит сессионную advisory-блокировку Postgres на отдельном соединении,
+    поэтому во всем кластере периодические задачи выполняет ровно один процесс.
+    Если ведущий падает, блокировка освобождается вместе с его соединением и ее
+    забирает следующий процесс при очередной проверке.
+    """
+    global _leader_task
+    if not runs_scheduler():
+        return False
+
+    if _leader_task is None:
+        _leader_task = asyncio.create_task(_keep_leadership())
+    await _elected.wait()
+    return _leader_conn is not None and not _leader_conn.is_closed()
+
+
+async def _keep_leadership():
+    global _leader_conn
+    # database импортирует workers, поэтому импорт откладывается до запуска выборов
+    from database import connect
+
+    while True:
+        try:
+            if _leader_conn is None or _leader_conn.is_closed():
+                _leader_conn = None
+                conn = await connect()
+                if await conn.fetchval("SELECT pg_try_advisory_lock($1)", SCHEDULER_LOCK_ID):
+                    _leader_conn = conn
+                    logger.info(f"Процесс {os.getpid()} стал ведущим и выполняет периодические задачи")
+                else:
+                    await conn.close()
+            else:
+                await _leader_conn.fetchval("SELECT 1")
+        except Exception as e:
+            logger.error(f"Ошибка при выборе ведущего процесса: {e}")
+            if _leader_conn is not None:
+                _leader_conn.terminate()
+                _leader_conn = None
+                logger.warning(f"Процесс {os.getpid()} потерял роль ведущего")
+
+        _elected.set()
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+
+async def release_leadership():
+    """Останавливает выборы и освобождает блокировку ведущего."""
+    global _leader_conn, _leader_task
+    if _leader_task is not None:
+        _leader_task.cancel()
+        _leader_task = None
+    if _leader_conn is not None:
+        await _leader_conn.close()
+        _leader_conn = None
+    _elected.clear()